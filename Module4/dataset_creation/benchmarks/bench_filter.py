@@ -0,0 +1,65 @@
+"""
+Benchmark of the BasicCodeFilter stats: the original per document `get_basic_stats` against the
+vectorized `get_batch_stats`. Both must give the same keep/drop decision for every document.
+
+Usage:
+    python benchmarks/bench_filter.py --data filtered_data removed --batch_size 64
+"""
+
+import argparse
+import gzip
+import json
+import os
+import sys
+import time
+
+# Add the parent directory (dataset_creation) to sys.path
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from filter import get_basic_stats, get_batch_stats  # noqa: E402
+
+
+def load_texts(folders):
+    texts = []
+    for folder in folders:
+        for file in sorted(os.listdir(folder)):
+            with gzip.open(os.path.join(folder, file), "rt", encoding="utf-8") as f:
+                texts.extend(json.loads(line)["text"] for line in f)
+    return texts
+
+
+def keep(max_line_length, mean_line_length, alphanum_ratio):
+    # default BasicCodeFilter thresholds
+    return not (max_line_length > 1000 or mean_line_length > 100 or alphanum_ratio < 0.25)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--data", nargs="+", default=["filtered_data", "removed"])
+    parser.add_argument("--batch_size", type=int, default=64)
+    args = parser.parse_args()
+
+    texts = [text for text in load_texts(args.data) if text]
+    total_mb = sum(len(text) for text in texts) / 2**20
+    print(f"{len(texts)} documents, {total_mb:.1f}M characters")
+
+    start = time.perf_counter()
+    reference = [keep(*get_basic_stats(text)) for text in texts]
+    reference_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    vectorized = []
+    for i in range(0, len(texts), args.batch_size):
+        for stats in get_batch_stats(texts[i : i + args.batch_size]):
+            vectorized.append(keep(stats["max_line_length"], stats["mean_line_length"], stats["alphanum_ratio"]))
+    vectorized_time = time.perf_counter() - start
+
+    mismatches = sum(a != b for a, b in zip(reference, vectorized))
+    print(f"get_basic_stats: {reference_time:.2f}s ({total_mb / reference_time:.1f}M chars/s)")
+    print(f"get_batch_stats: {vectorized_time:.2f}s ({total_mb / vectorized_time:.1f}M chars/s)")
+    print(f"kept {sum(vectorized)}/{len(texts)}, {mismatches} decisions differ")
+    if mismatches:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
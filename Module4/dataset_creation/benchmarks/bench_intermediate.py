@@ -0,0 +1,88 @@
+"""
+Benchmark of the intermediate format of filtered_data: gzipped jsonl shards against parquet shards (zstd).
+
+The jsonl shards of `--data` are rewritten as parquet with the writer of stage 0, then every shard is read
+with the rank aligned readers of stages 1 and 4:
+- jsonl.gz: decompress and parse every line, text and metadata,
+- parquet: decode every column (what stage 4 reads),
+- parquet text only: decode the text and id columns (what stage 1 reads).
+Reports the disk size of each format and the best read time over `--repeats` runs.
+
+Usage:
+    python benchmarks/bench_intermediate.py --data filtered_data --repeats 3
+"""
+
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+# Add the parent directory (dataset_creation) to sys.path
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import pipeline  # noqa: E402
+from reader import RankAlignedJsonlReader, RankAlignedParquetReader  # noqa: E402
+
+
+def folder_size(folder):
+    return sum(os.path.getsize(os.path.join(folder, file)) for file in os.listdir(folder))
+
+
+def get_ranks(folder):
+    return sorted(int(file.split(".")[0]) for file in os.listdir(folder) if file.endswith(".jsonl.gz"))
+
+
+def convert(input_folder, output_folder, ranks, compression):
+    reader = RankAlignedJsonlReader(input_folder)
+    pipeline.INTERMEDIATE_FORMAT = "parquet"
+    writer = pipeline.get_intermediate_writer(output_folder)
+    writer.compression = compression
+    with writer:
+        for rank in ranks:
+            for document in reader.read_file(reader.file_template.format(rank=rank)):
+                writer.write(document, rank)
+
+
+def time_read(reader, ranks):
+    """Reads every shard, returns the time, number of documents and characters read"""
+    start = time.perf_counter()
+    num_docs = num_chars = 0
+    for rank in ranks:
+        for document in reader.read_file(reader.file_template.format(rank=rank)):
+            num_docs += 1
+            num_chars += len(document.text)
+    return time.perf_counter() - start, num_docs, num_chars
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--data", default="filtered_data", help="folder of {rank:05d}.jsonl.gz shards")
+    parser.add_argument("--compression", default="zstd", help="parquet compression codec")
+    parser.add_argument("--repeats", type=int, default=3)
+    args = parser.parse_args()
+
+    ranks = get_ranks(args.data)
+    with tempfile.TemporaryDirectory() as parquet_folder:
+        start = time.perf_counter()
+        convert(args.data, parquet_folder, ranks, args.compression)
+        print(f"converted {len(ranks)} shards to parquet ({args.compression}) in {time.perf_counter() - start:.2f}s")
+
+        formats = [
+            ("jsonl.gz", RankAlignedJsonlReader(args.data), folder_size(args.data)),
+            ("parquet", RankAlignedParquetReader(parquet_folder), folder_size(parquet_folder)),
+            ("parquet text only", RankAlignedParquetReader(parquet_folder, read_metadata=False), None),
+        ]
+        print(f"{'format':<18} {'disk MB':>8} {'read s':>7} {'docs/s':>9} {'MB/s':>7} {'speedup':>7}")
+        reference = None
+        for name, reader, size in formats:
+            read_time, num_docs, num_chars = min(time_read(reader, ranks) for _ in range(args.repeats))
+            reference = reference or read_time
+            disk = f"{size / 2**20:>8.2f}" if size is not None else f"{'':>8}"
+            print(
+                f"{name:<18} {disk} {read_time:>7.2f} {num_docs / read_time:>9.0f} "
+                f"{num_chars / 2**20 / read_time:>7.1f} {reference / read_time:>6.2f}x"
+            )
+
+
+if __name__ == "__main__":
+    main()
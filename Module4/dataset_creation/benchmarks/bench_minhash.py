@@ -0,0 +1,253 @@
+"""
+Parameter sweep of the MinHash deduplication stages on a corpus with planted near-duplicates.
+
+Every seed document (taken from an already deduplicated folder) gets variants whose words are randomly
+replaced so that their Jaccard similarity to the seed is close to each of `--levels`. The true similarity
+of every pair of a family is measured on the exact shingles used by datatrove, and a pair is a true
+duplicate when it is at least `--threshold`. Seeds of different families are assumed to be distinct.
+
+Each configuration of the grid (n-grams x buckets x hashes per bucket) runs the signature, buckets and
+cluster stages in a fresh process and reports:
+- throughput of the three stages (documents and MB per second),
+- peak memory (max RSS of the process) and disk use of the intermediate files,
+- precision and recall of the documents found in a cluster against the documents having a true duplicate,
+  and the same for pairs of documents in a cluster (lower precision: clusters are transitive).
+
+Usage:
+    python benchmarks/bench_minhash.py --data hf_stack --ngrams 5 --buckets 9 14 20 --hashes 5 8 13
+"""
+
+import argparse
+import contextlib
+import gzip
+import itertools
+import json
+import os
+import random
+import re
+import resource
+import shutil
+import struct
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from datatrove.executor.local import LocalPipelineExecutor
+from datatrove.pipeline.dedup import MinhashDedupSignature
+from datatrove.pipeline.dedup.minhash import MinhashConfig, MinhashDedupBuckets, MinhashDedupCluster
+from datatrove.pipeline.readers import JsonlReader
+from datatrove.utils.hashing import HashConfig
+
+WORD_REGEX = re.compile(r"\w+")
+
+
+def load_seeds(folder, num_seeds, max_chars, seed):
+    texts = []
+    for file in sorted(os.listdir(folder)):
+        with gzip.open(os.path.join(folder, file), "rt", encoding="utf-8") as f:
+            texts.extend(json.loads(line)["text"][:max_chars] for line in f)
+    texts = [text for text in texts if len(WORD_REGEX.findall(text)) >= 50]
+    return random.Random(seed).sample(texts, min(num_seeds, len(texts)))
+
+
+def mutate(text, rate, rng):
+    """Replaces each word with a random identifier with probability `rate`"""
+    return WORD_REGEX.sub(lambda m: f"w{rng.getrandbits(32):x}" if rng.random() < rate else m.group(0), text)
+
+
+def get_mutation_rate(level, n_grams):
+    # a word change breaks the n-grams containing it: kept fraction s ~ (1 - rate)^n and J = s / (2 - s)
+    kept = 2 * level / (1 + level)
+    return 1 - kept ** (1 / n_grams)
+
+
+def build_corpus(seeds, levels, n_grams, seed):
+    """Returns the documents and the family of each one (its seed index)"""
+    rng = random.Random(seed)
+    docs, families = [], []
+    for family, text in enumerate(seeds):
+        docs.append(text)
+        families.append(family)
+        for level in levels:
+            docs.append(mutate(text, get_mutation_rate(level, n_grams), rng))
+            families.append(family)
+    return docs, families
+
+
+def get_true_pairs(docs, families, n_grams, threshold):
+    """Pairs of documents of a family whose Jaccard similarity on datatrove's shingles is >= threshold"""
+    signer = MinhashDedupSignature(output_folder=tempfile.gettempdir(), config=MinhashConfig(n_grams=n_grams))
+    shingles = [set(signer.get_shingles(doc).ravel().tolist()) for doc in docs]
+    pairs, similarities = set(), []
+    members = {}
+    for i, family in enumerate(families):
+        members.setdefault(family, []).append(i)
+    for family_docs in members.values():
+        for i, j in itertools.combinations(family_docs, 2):
+            similarity = len(shingles[i] & shingles[j]) / max(1, len(shingles[i] | shingles[j]))
+            similarities.append(similarity)
+            if similarity >= threshold:
+                pairs.add((i, j))
+    return pairs, similarities
+
+
+def write_corpus(docs, folder, num_shards):
+    """Writes shard r with docs r, r + num_shards, ... and returns the (shard, index in shard) of each doc"""
+    os.makedirs(folder, exist_ok=True)
+    locations = []
+    files = [gzip.open(os.path.join(folder, f"{shard:05d}.jsonl.gz"), "wt") for shard in range(num_shards)]
+    counts = [0] * num_shards
+    for i, text in enumerate(docs):
+        shard = i % num_shards
+        files[shard].write(json.dumps({"text": text, "id": str(i)}) + "\n")
+        locations.append((shard, counts[shard]))
+        counts[shard] += 1
+    for file in files:
+        file.close()
+    return locations
+
+
+def folder_size(folder):
+    return sum(os.path.getsize(os.path.join(root, f)) for root, _, files in os.walk(folder) for f in files)
+
+
+def run_config(workdir, num_shards, n_grams, num_buckets, hashes_per_bucket):
+    """Runs stages 1 to 3 for one configuration, in its own process so that max RSS is per configuration"""
+    config = MinhashConfig(
+        n_grams=n_grams,
+        num_buckets=num_buckets,
+        hashes_per_bucket=hashes_per_bucket,
+        hash_config=HashConfig(precision=64),
+    )
+    out = os.path.join(workdir, f"{n_grams}ng_{num_buckets}b_{hashes_per_bucket}h")
+    stages = [
+        (
+            [
+                JsonlReader(os.path.join(workdir, "corpus")),
+                MinhashDedupSignature(output_folder=f"{out}/signatures", config=config),
+            ],
+            num_shards,
+        ),
+        (
+            [MinhashDedupBuckets(input_folder=f"{out}/signatures", output_folder=f"{out}/buckets", config=config)],
+            num_buckets,
+        ),
+        (
+            [
+                MinhashDedupCluster(
+                    input_folder=f"{out}/buckets",
+                    output_folder=f"{out}/remove_ids",
+                    config=config,
+                    save_cluster_id=True,  # clusters give the found pairs
+                )
+            ],
+            1,
+        ),
+    ]
+    times = []
+    # the task logs are still written to the logging folders, only the console output is silenced
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stderr(devnull):
+        for i, (pipeline, tasks) in enumerate(stages):
+            start = time.perf_counter()
+            LocalPipelineExecutor(
+                pipeline=pipeline, tasks=tasks, workers=1, logging_dir=f"{out}/logs/stage_{i + 1}"
+            ).run()
+            times.append(time.perf_counter() - start)
+
+    clusters = {}
+    for file in os.listdir(f"{out}/remove_ids"):
+        if file.endswith(".clusters"):
+            with open(f"{out}/remove_ids/{file}", "rb") as f:
+                data = f.read()
+            for doc, cluster in struct.iter_unpack("<2I", data):
+                clusters[(int(file.split(".")[0]), doc)] = cluster
+    disk = {name: folder_size(f"{out}/{name}") for name in ("signatures", "buckets", "remove_ids")}
+    shutil.rmtree(out)
+    # ru_maxrss is in KB on Linux
+    return times, clusters, disk, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def get_predicted_pairs(clusters, locations):
+    index = {location: i for i, location in enumerate(locations)}
+    members = {}
+    for location, cluster in clusters.items():
+        members.setdefault(cluster, []).append(index[location])
+    return {tuple(sorted(pair)) for docs in members.values() for pair in itertools.combinations(docs, 2)}
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--data", default="hf_stack", help="deduplicated documents used as seeds")
+    parser.add_argument("--num_seeds", type=int, default=200)
+    parser.add_argument("--max_chars", type=int, default=4000, help="seeds are truncated to this many characters")
+    parser.add_argument("--levels", type=float, nargs="+", default=[0.5, 0.7, 0.8, 0.9, 0.95])
+    parser.add_argument("--threshold", type=float, default=0.8, help="Jaccard similarity of a true duplicate pair")
+    parser.add_argument("--truth_ngrams", type=int, default=5, help="n-grams used for the true similarity")
+    parser.add_argument("--ngrams", type=int, nargs="+", default=[5])
+    parser.add_argument("--buckets", type=int, nargs="+", default=[9, 14, 20])
+    parser.add_argument("--hashes", type=int, nargs="+", default=[5, 8, 13])
+    parser.add_argument("--num_shards", type=int, default=4)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", default=None, help="optional json file for the results")
+    args = parser.parse_args()
+
+    seeds = load_seeds(args.data, args.num_seeds, args.max_chars, args.seed)
+    docs, families = build_corpus(seeds, args.levels, args.truth_ngrams, args.seed)
+    true_pairs, similarities = get_true_pairs(docs, families, args.truth_ngrams, args.threshold)
+    true_docs = {doc for pair in true_pairs for doc in pair}
+    corpus_mb = sum(len(doc.encode("utf-8")) for doc in docs) / 2**20
+    print(
+        f"{len(docs)} documents ({corpus_mb:.1f}MB) in {len(seeds)} families, {len(true_pairs)} of "
+        f"{len(similarities)} family pairs have Jaccard >= {args.threshold}"
+    )
+
+    results = []
+    with tempfile.TemporaryDirectory() as workdir:
+        locations = write_corpus(docs, os.path.join(workdir, "corpus"), args.num_shards)
+        for n_grams, num_buckets, hashes_per_bucket in itertools.product(args.ngrams, args.buckets, args.hashes):
+            with ProcessPoolExecutor(max_workers=1) as pool:
+                times, clusters, disk, peak_mb = pool.submit(
+                    run_config, workdir, args.num_shards, n_grams, num_buckets, hashes_per_bucket
+                ).result()
+            predicted = get_predicted_pairs(clusters, locations)
+            found = len(predicted & true_pairs)
+            predicted_docs = {doc for pair in predicted for doc in pair}
+            found_docs = len(predicted_docs & true_docs)
+            total_time = sum(times)
+            results.append(
+                {
+                    "n_grams": n_grams,
+                    "num_buckets": num_buckets,
+                    "hashes_per_bucket": hashes_per_bucket,
+                    # similarity where a pair has a 50% chance of sharing a bucket
+                    "estimated_threshold": (1 / num_buckets) ** (1 / hashes_per_bucket),
+                    "stage_times": times,
+                    "docs_per_s": len(docs) / total_time,
+                    "mb_per_s": corpus_mb / total_time,
+                    "peak_rss_mb": peak_mb,
+                    "disk_bytes": disk,
+                    "precision": found_docs / len(predicted_docs) if predicted_docs else 1.0,
+                    "recall": found_docs / len(true_docs) if true_docs else 1.0,
+                    "pair_precision": found / len(predicted) if predicted else 1.0,
+                    "pair_recall": found / len(true_pairs) if true_pairs else 1.0,
+                }
+            )
+
+    print(
+        f"{'ngrams':>6} {'buckets':>7} {'hashes':>6} {'thresh':>6} {'docs/s':>8} {'MB/s':>6} "
+        f"{'peak MB':>8} {'disk KB':>8} {'precision':>9} {'recall':>6} {'pair P':>6} {'pair R':>6}"
+    )
+    for r in results:
+        print(
+            f"{r['n_grams']:>6} {r['num_buckets']:>7} {r['hashes_per_bucket']:>6} {r['estimated_threshold']:>6.2f} "
+            f"{r['docs_per_s']:>8.1f} {r['mb_per_s']:>6.2f} {r['peak_rss_mb']:>8.0f} "
+            f"{sum(r['disk_bytes'].values()) / 1024:>8.0f} {r['precision']:>9.3f} {r['recall']:>6.3f} "
+            f"{r['pair_precision']:>6.3f} {r['pair_recall']:>6.3f}"
+        )
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"args": vars(args), "results": results}, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,241 @@
+# coding=utf-8
+# Copyright 2024 Sourab Mangrulkar. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Line level boilerplate removal: license headers, copyright banners and other generated blocks that
+MinHash keeps because the rest of each file differs.
+
+It takes two passes over the deduplicated shards:
+1. `BoilerplateLineCounter` counts, for every normalized line, the number of documents containing it.
+   Each task saves its counts as two sorted numpy arrays (line hashes and document counts),
+2. `BoilerplateStripper` merges the counts of all tasks into a hash table of the frequent lines and strips
+   the spans of consecutive frequent lines from every document, then saves the tokens saved per repo.
+
+Per repo reports of all tasks are summed with `merge_reports`.
+"""
+
+import json
+import re
+from collections import defaultdict
+
+import numpy as np
+from datatrove.data import DocumentsPipeline
+from datatrove.io import DataFolderLike, get_datafolder
+from datatrove.pipeline.base import PipelineStep
+from datatrove.utils.batching import batched
+from datatrove.utils.hashing import HashConfig, create_hash_func
+from datatrove.utils.tokenization import PipelineStepWithTokenizer
+from datatrove.utils.typeshelper import StatHints
+
+
+def normalize_line(line: str) -> str:
+    """Whitespace insensitive form of a line, so that re-indented or re-wrapped copies hash the same"""
+    return " ".join(line.split())
+
+
+class BoilerplateLineCounter(PipelineStep):
+    """
+    First pass: counts the documents containing each normalized line.
+
+    Args:
+        output_folder: folder of the `{rank:05d}.npz` counts of each task
+        min_line_chars: shorter lines (after normalization) are not counted, e.g. `}` or `else:`
+        hash_config: hash function used on the normalized lines
+    """
+
+    type = "🫂 - DEDUP"
+    name = "📜 Boilerplate lines count"
+
+    def __init__(
+        self,
+        output_folder: DataFolderLike,
+        min_line_chars: int = 10,
+        hash_config: HashConfig = HashConfig(precision=64),
+    ):
+        super().__init__()
+        self.output_folder = get_datafolder(output_folder)
+        self.min_line_chars = min_line_chars
+        self.hash_config = hash_config
+
+    def run(self, data: DocumentsPipeline, rank: int = 0, world_size: int = 1):
+        hash_fc = create_hash_func(self.hash_config)
+        doc_hashes = []
+        for doc in data:
+            self.stat_update(StatHints.total)
+            with self.track_time():
+                # a line repeated in a document counts once: a header is frequent because many files have it
+                hashes = {
+                    hash_fc(line)
+                    for line in map(normalize_line, doc.text.splitlines())
+                    if len(line) >= self.min_line_chars
+                }
+                doc_hashes.append(np.fromiter(hashes, dtype=np.uint64, count=len(hashes)))
+
+        with self.track_time():
+            hashes, counts = np.unique(
+                np.concatenate(doc_hashes) if doc_hashes else np.empty(0, dtype=np.uint64), return_counts=True
+            )
+            self.stat_update("unique_lines", value=len(hashes))
+            with self.output_folder.open(f"{rank:05d}.npz", mode="wb") as f:
+                np.savez(f, hashes=hashes, counts=counts.astype(np.uint32))
+
+
+class BoilerplateStripper(PipelineStepWithTokenizer):
+    """
+    Second pass: removes the spans of lines found in at least `min_docs` documents of the corpus.
+
+    A span is a run of at least `min_span_lines` frequent lines, possibly separated by short lines (blank
+    lines, lone comment markers or braces), so that a single common line is kept. Lines matching
+    `keep_lines` are never stripped: by default the import statements, without which the rest of the
+    file would use undefined names. Documents left empty are dropped.
+
+    Args:
+        counts_folder: folder with the counts of `BoilerplateLineCounter`
+        report_folder: folder of the `{rank:05d}.json` per repo report of each task
+        min_docs: a line is boilerplate when at least this many documents contain it
+        min_span_lines: minimum number of frequent lines of a stripped span
+        min_line_chars: same as `BoilerplateLineCounter`
+        keep_lines: regex of the lines to keep even when frequent, None to strip them too
+        hash_config: same as `BoilerplateLineCounter`
+        tokenizer_name_or_path: tokenizer used to count the tokens saved
+        batch_size: number of documents whose stripped spans are tokenized at once
+    """
+
+    type = "✂️ - FORMAT"
+    name = "📜 Boilerplate strip"
+
+    def __init__(
+        self,
+        counts_folder: DataFolderLike,
+        report_folder: DataFolderLike,
+        min_docs: int = 100,
+        min_span_lines: int = 3,
+        min_line_chars: int = 10,
+        keep_lines: str | None = r"\s*(import|from\s+\S+\s+import)\s",
+        hash_config: HashConfig = HashConfig(precision=64),
+        tokenizer_name_or_path: str = "gpt2",
+        batch_size: int = 1000,
+    ):
+        super().__init__(tokenizer_name_or_path)
+        self.counts_folder = get_datafolder(counts_folder)
+        self.report_folder = get_datafolder(report_folder)
+        self.min_docs = min_docs
+        self.min_span_lines = min_span_lines
+        self.min_line_chars = min_line_chars
+        self.keep_lines = re.compile(keep_lines) if keep_lines else None
+        self.hash_config = hash_config
+        self.batch_size = batch_size
+        self._hash_fc = None
+        self._frequent = None
+
+    def load_frequent_lines(self) -> frozenset[int]:
+        """Sums the counts of every task and keeps the hashes of the lines in at least `min_docs` documents"""
+        all_hashes, all_counts = [], []
+        for file in self.counts_folder.list_files(glob_pattern="*.npz"):
+            with self.counts_folder.open(file, mode="rb") as f:
+                counts = np.load(f)
+                all_hashes.append(counts["hashes"])
+                all_counts.append(counts["counts"])
+        if not all_hashes:
+            return frozenset()
+        hashes, inverse = np.unique(np.concatenate(all_hashes), return_inverse=True)
+        totals = np.bincount(inverse, weights=np.concatenate(all_counts))
+        return frozenset(hashes[totals >= self.min_docs].tolist())
+
+    def strip(self, text: str) -> tuple[str, list[str]]:
+        """Returns the text without its boilerplate spans, and the removed spans"""
+        lines = text.splitlines(keepends=True)
+        # 1: frequent line, 0: short line that can be inside a span, -1: line that ends a span
+        kinds = []
+        for line in lines:
+            normalized = normalize_line(line)
+            if len(normalized) < self.min_line_chars:
+                kinds.append(0)
+            elif self.keep_lines and self.keep_lines.match(line):
+                kinds.append(-1)
+            else:
+                kinds.append(1 if self._hash_fc(normalized) in self._frequent else -1)
+
+        kept, removed = [], []
+        start = 0
+        while start < len(lines):
+            if kinds[start] != 1:
+                kept.append(lines[start])
+                start += 1
+                continue
+            # extend the span over frequent and short lines, up to its last frequent line
+            end = last = start
+            num_frequent = 0
+            while end < len(lines) and kinds[end] >= 0:
+                if kinds[end] == 1:
+                    num_frequent += 1
+                    last = end
+                end += 1
+            if num_frequent >= self.min_span_lines:
+                removed.append("".join(lines[start : last + 1]))
+            else:
+                kept.extend(lines[start : last + 1])
+            start = last + 1
+        return "".join(kept), removed
+
+    def run(self, data: DocumentsPipeline, rank: int = 0, world_size: int = 1) -> DocumentsPipeline:
+        if self._frequent is None:
+            self._hash_fc = create_hash_func(self.hash_config)
+            self._frequent = self.load_frequent_lines()
+        report = defaultdict(lambda: {"documents": 0, "spans": 0, "chars": 0, "tokens": 0})
+
+        for batch in batched(data, self.batch_size):
+            with self.track_time(unit="batch"):
+                stripped = [self.strip(doc.text) for doc in batch]
+                # all the removed spans of the batch are tokenized at once
+                spans = [span for _, removed in stripped for span in removed]
+                span_tokens = iter(len(encoded.ids) for encoded in self.tokenizer.encode_batch(spans))
+            for doc, (text, removed) in zip(batch, stripped):
+                self.stat_update(StatHints.total)
+                if not removed:
+                    self.stat_update(StatHints.forwarded)
+                    yield doc
+                    continue
+                tokens = sum(next(span_tokens) for _ in removed)
+                repo = report[doc.metadata.get("repo_id", "unknown")]
+                repo["documents"] += 1
+                repo["spans"] += len(removed)
+                repo["chars"] += len(doc.text) - len(text)
+                repo["tokens"] += tokens
+                self.stat_update("boilerplate_tokens", value=tokens)
+                if not text.strip():
+                    self.stat_update(StatHints.dropped)
+                    continue
+                self.stat_update(StatHints.forwarded)
+                doc.text = text
+                if "token_count" in doc.metadata:
+                    # set by `TokenAccounting` with the same tokenizer, up to the tokens merged across span edges
+                    doc.metadata["token_count"] -= tokens
+                yield doc
+
+        with self.report_folder.open(f"{rank:05d}.json", mode="w") as f:
+            json.dump(report, f, indent=2)
+
+
+def merge_reports(report_folder: DataFolderLike) -> dict:
+    """Sums the per repo reports of all tasks, repos with the most tokens saved first"""
+    report_folder = get_datafolder(report_folder)
+    merged = defaultdict(lambda: {"documents": 0, "spans": 0, "chars": 0, "tokens": 0})
+    for file in report_folder.list_files(glob_pattern="*.json"):
+        with report_folder.open(file) as f:
+            for repo, counts in json.load(f).items():
+                for key, value in counts.items():
+                    merged[repo][key] += value
+    return dict(sorted(merged.items(), key=lambda item: -item[1]["tokens"]))
@@ -5,17 +5,31 @@ This script fetches repositories from the Hugging Face GitHub organization, sort
 number of "stars" (a GitHub metric indicating how many users have bookmarked or favorited a repository,
 often used as a proxy for popularity or usefulness), and clones the top N repositories locally.
 
+With `--mode sparse` (the default), each repository is cloned at depth 1 without its blobs, and only the
+files the dataset reader keeps are checked out (see `sparse_mirror_repository`). Clones run on a bounded
+pool with retries and the bytes transferred per repository are saved to `MIRROR_REPORT`.
+
+With `--mode refresh`, the existing mirrors are fetched and fast-forwarded instead (the missing ones are sparse
+mirrored). The old and new commit and the added, modified and deleted paths of each repository are saved to
+`CHANGES_REPORT`, and the added and modified files the dataset reader keeps are listed in `CHANGED_PATHS`.
+`incremental.py` reads the report to update its outputs with the changed files and drop the deleted ones:
+    python incremental.py --changes_report mirror_changes.json
+`CHANGED_PATHS` is a `paths_file` of the reader. A stage 0 reading it must write to its own `output_folder`:
+the shards of `filtered_data` hold every file of the mirror, and the deleted files are not in the list.
+
 Courtesy: Sayak Paul and Chansung Park.
 """
 
+import argparse
+import json
 import os
-from dotenv import load_dotenv
+import shutil
 import subprocess
+import time
+from concurrent.futures import ThreadPoolExecutor
 from multiprocessing import Pool
-from github import Github
 
-# Load environment variables from a .env file if present
-load_dotenv()
+from reader import ANTI_FOMATS, EXCLUDED_DIRS, is_excluded
 
 # Name of the GitHub organization to fetch repositories from
 ORG = "huggingface"
@@ -26,6 +40,15 @@ MIRROR_DIRECTORY = "hf_public_repos"
 # Number of top repositories (by stars) to clone
 TOK_K = 15
 
+# Bytes transferred, files checked out and attempts of each repository of the last sparse mirroring
+# (outside of MIRROR_DIRECTORY, whose files are all read by the dataset pipeline)
+MIRROR_REPORT = "mirror_report.json"
+
+# Old and new commit and changed paths of each repository of the last refresh, and the added or modified
+# files to read again (relative to MIRROR_DIRECTORY, one per line, a `paths_file` of the dataset reader)
+CHANGES_REPORT = "mirror_changes.json"
+CHANGED_PATHS = "changed_paths.txt"
+
 
 def get_repos(username, access_token=None, include_fork=False):
     """
@@ -40,6 +63,8 @@ def get_repos(username, access_token=None, include_fork=False):
     Returns:
         list of tuples: Each tuple contains (repo_name, stargazers_count).
     """
+    from github import Github
+
     g = Github(access_token)
     user = g.get_user(username)
 
@@ -84,10 +109,234 @@ def mirror_repository(repository):
     subprocess.run(["git", "clone", repository_url, repository_path])
 
 
-def mirror_repositories():
+def get_sparse_patterns():
+    """
+    Sparse checkout patterns (gitignore syntax) of the files `reader.is_excluded` keeps: everything but the
+    blocked extensions and the excluded directories, matched anywhere in the tree.
+    """
+    patterns = ["/*"]
+    patterns += [f"!*{extension}" for extension in ANTI_FOMATS]
+    patterns += [f"!*{name}*" for name in EXCLUDED_DIRS if name != ".git"]
+    return patterns
+
+
+def get_directory_size(path):
+    return sum(os.path.getsize(os.path.join(root, file)) for root, _, files in os.walk(path) for file in files)
+
+
+def run_git(*args, cwd=None, input=None):
+    """Runs a git command, raising `subprocess.CalledProcessError` (with its stderr) if it fails"""
+    return subprocess.run(["git", *args], cwd=cwd, input=input, check=True, capture_output=True, text=True).stdout
+
+
+def sparse_mirror_repository(repository_url, repository_path, retries=3, backoff=2.0):
+    """
+    Clones the latest commit of a repository with only the files the dataset reader keeps.
+
+    The clone has depth 1 and no blobs (`--filter=blob:none`), the sparse checkout excludes the blocked
+    extensions and directories, so only the blobs of the kept files are downloaded, when they are checked out.
+    A failed attempt is removed and retried after `backoff * 2**attempt` seconds. Local repositories must be
+    given as `file://` urls, git ignores `--depth` and `--filter` for plain paths.
+
+    Args:
+        repository_url (str): Url of the repository.
+        repository_path (str): Directory to clone it into.
+        retries (int): Number of attempts after the first one.
+        backoff (float): Seconds to wait before the first retry.
+
+    Returns:
+        dict: Bytes transferred (size of the object store after the checkout), files checked out,
+        seconds, attempts and error (None on success) of the repository.
+    """
+    start = time.time()
+    report = {"bytes": 0, "files": 0, "seconds": 0.0, "attempts": 0, "error": None}
+    for attempt in range(retries + 1):
+        if attempt:
+            time.sleep(backoff * 2 ** (attempt - 1))
+        shutil.rmtree(repository_path, ignore_errors=True)
+        report["attempts"] = attempt + 1
+        try:
+            run_git(
+                "clone", "--depth", "1", "--filter=blob:none", "--no-checkout", "--single-branch",
+                repository_url, repository_path,
+            )
+            patterns = "\n".join(get_sparse_patterns()) + "\n"
+            run_git("sparse-checkout", "set", "--no-cone", "--stdin", cwd=repository_path, input=patterns)
+            # fetches the blobs of the files in the sparse checkout only
+            run_git("checkout", cwd=repository_path)
+        except subprocess.CalledProcessError as e:
+            report["error"] = (e.stderr or "").strip() or str(e)
+            print(f"Attempt {attempt + 1} of {repository_url} failed: {report['error']}")
+            continue
+        report["error"] = None
+        report["bytes"] = get_directory_size(os.path.join(repository_path, ".git", "objects"))
+        # "H" entries are checked out, "S" entries are outside of the sparse checkout
+        entries = run_git("ls-files", "-t", cwd=repository_path).splitlines()
+        report["files"] = sum(entry.startswith("H ") for entry in entries)
+        break
+    report["seconds"] = time.time() - start
+    return report
+
+
+def sparse_mirror_repositories(repository_urls, mirror_directory=MIRROR_DIRECTORY, workers=4, retries=3):
+    """
+    Sparse mirrors of several repositories on a pool of `workers` threads (the work is done by git processes).
+
+    Args:
+        repository_urls (dict): Url of each repository, by name (the name of its directory in `mirror_directory`).
+        mirror_directory (str): Directory of the mirrors.
+        workers (int): Maximum number of concurrent clones.
+        retries (int): Attempts after the first one, per repository.
+
+    Returns:
+        dict: The report of `sparse_mirror_repository` of each repository, by name.
+    """
+    os.makedirs(mirror_directory, exist_ok=True)
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {
+            name: executor.submit(sparse_mirror_repository, url, os.path.join(mirror_directory, name), retries)
+            for name, url in repository_urls.items()
+        }
+        return {name: future.result() for name, future in futures.items()}
+
+
+def get_changed_paths(repository_path, old, new):
+    """
+    Added, modified and deleted paths between two commits, from their trees only (no rename detection, so no
+    blob is needed and a renamed file is deleted and added).
+
+    Returns:
+        dict: Sorted lists of "added", "modified" and "deleted" paths, relative to the repository.
+    """
+    changes = {"added": [], "modified": [], "deleted": []}
+    fields = run_git("diff", "--name-status", "--no-renames", "-z", old, new, cwd=repository_path).split("\0")
+    # -z output: status and path alternate
+    for status, path in zip(fields[0::2], fields[1::2]):
+        if status == "A":
+            changes["added"].append(path)
+        elif status == "D":
+            changes["deleted"].append(path)
+        else:
+            # "M" or a type change "T"
+            changes["modified"].append(path)
+    return {kind: sorted(paths) for kind, paths in changes.items()}
+
+
+def refresh_repository(repository_path, retries=3, backoff=2.0):
+    """
+    Fetches the latest commit of the branch of a mirror and fast-forwards it.
+
+    Shallow (sparse) mirrors are fetched at depth 1 and reset to the new commit, their sparse checkout and
+    blob filter are kept so only the new blobs of the kept files are downloaded. Full clones are fast-forwarded
+    and fail if they have diverged. Only the fetch is retried, after `backoff * 2**attempt` seconds.
+
+    Args:
+        repository_path (str): Directory of the mirror.
+        retries (int): Number of attempts after the first one.
+        backoff (float): Seconds to wait before the first retry.
+
+    Returns:
+        dict: Old and new commit, the lists of `get_changed_paths`, seconds, attempts and error (None on
+        success, the lists are then empty) of the repository.
+    """
+    start = time.time()
+    report = {"old": None, "new": None, "added": [], "modified": [], "deleted": []}
+    report.update({"seconds": 0.0, "attempts": 0, "error": None})
+    try:
+        report["old"] = run_git("rev-parse", "HEAD", cwd=repository_path).strip()
+        shallow = run_git("rev-parse", "--is-shallow-repository", cwd=repository_path).strip() == "true"
+    except subprocess.CalledProcessError as e:
+        report["error"] = (e.stderr or "").strip() or str(e)
+        return report
+    for attempt in range(retries + 1):
+        if attempt:
+            time.sleep(backoff * 2 ** (attempt - 1))
+        report["attempts"] = attempt + 1
+        try:
+            run_git("fetch", "--no-tags", *(["--depth", "1"] if shallow else []), "origin", cwd=repository_path)
+            report["error"] = None
+            break
+        except subprocess.CalledProcessError as e:
+            report["error"] = (e.stderr or "").strip() or str(e)
+            print(f"Attempt {attempt + 1} of fetching {repository_path} failed: {report['error']}")
+    if report["error"] is None:
+        try:
+            report["new"] = run_git("rev-parse", "FETCH_HEAD", cwd=repository_path).strip()
+            if report["new"] != report["old"]:
+                changes = get_changed_paths(repository_path, report["old"], report["new"])
+                if shallow:
+                    # the history of the new commit is not fetched, there is nothing to merge with
+                    run_git("reset", "-q", "--hard", "FETCH_HEAD", cwd=repository_path)
+                else:
+                    run_git("merge", "-q", "--ff-only", "FETCH_HEAD", cwd=repository_path)
+                report.update(changes)
+        except subprocess.CalledProcessError as e:
+            report["error"] = (e.stderr or "").strip() or str(e)
+    report["seconds"] = time.time() - start
+    return report
+
+
+def refresh_repositories(repository_urls, mirror_directory=MIRROR_DIRECTORY, workers=4, retries=3):
+    """
+    Refreshes the mirrors of several repositories on a pool of `workers` threads, and sparse mirrors the ones
+    that do not exist yet (all their checked out files are then added).
+
+    Args:
+        repository_urls (dict): Url of each repository, by name (the name of its directory in `mirror_directory`).
+        mirror_directory (str): Directory of the mirrors.
+        workers (int): Maximum number of concurrent fetches.
+        retries (int): Attempts after the first one, per repository.
+
+    Returns:
+        dict: The report of `refresh_repository` of each repository, by name.
+    """
+
+    def refresh(name, url):
+        repository_path = os.path.join(mirror_directory, name)
+        if os.path.isdir(os.path.join(repository_path, ".git")):
+            return refresh_repository(repository_path, retries)
+        mirror_report = sparse_mirror_repository(url, repository_path, retries)
+        report = {"old": None, "new": None, "added": [], "modified": [], "deleted": []}
+        report.update({key: mirror_report[key] for key in ("seconds", "attempts", "error")})
+        if report["error"] is None:
+            report["new"] = run_git("rev-parse", "HEAD", cwd=repository_path).strip()
+            report["added"] = sorted(run_git("ls-files", "-z", cwd=repository_path).split("\0")[:-1])
+        return report
+
+    os.makedirs(mirror_directory, exist_ok=True)
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {name: executor.submit(refresh, name, url) for name, url in repository_urls.items()}
+        return {name: future.result() for name, future in futures.items()}
+
+
+def write_changed_paths(report, paths_file=CHANGED_PATHS):
+    """
+    Writes the added and modified files of a refresh report that the dataset reader keeps, relative to the
+    mirror directory. Deleted files are only in the report, there is nothing to read for them.
+
+    Returns:
+        list of str: The paths written.
+    """
+    paths = sorted(
+        f"{name}/{path}"
+        for name, repo_report in report.items()
+        for path in repo_report["added"] + repo_report["modified"]
+        if not is_excluded(f"{name}/{path}")
+    )
+    with open(paths_file, "w") as f:
+        f.writelines(f"{path}\n" for path in paths)
+    return paths
+
+
+def mirror_repositories(mode="sparse", workers=4, retries=3):
     """
     Main function to fetch, sort, and clone the top repositories from the organization.
     """
+    from dotenv import load_dotenv
+
+    # Load environment variables from a .env file if present
+    load_dotenv()
+
     # Create the mirror directory if it doesn't exist
     if not os.path.exists(MIRROR_DIRECTORY):
         os.makedirs(MIRROR_DIRECTORY)
@@ -105,6 +354,35 @@ def mirror_repositories():
 
     print(f"Total repositories found: {len(selected_repos)}.")
     print(selected_repos)
+    if mode == "sparse":
+        print("Cloning the latest commit of the repositories, without blocked files.")
+        report = sparse_mirror_repositories(
+            {name: f"https://github.com/{ORG}/{name}.git" for name in selected_repos}, workers=workers, retries=retries
+        )
+        with open(MIRROR_REPORT, "w") as f:
+            json.dump(report, f, indent=2)
+        for name, repo_report in report.items():
+            status = f"failed: {repo_report['error']}" if repo_report["error"] else f"{repo_report['files']} files"
+            print(f"{name}: {repo_report['bytes'] / 2**20:.1f}MB transferred, {status}")
+        print(f"Total: {sum(r['bytes'] for r in report.values()) / 2**20:.1f}MB transferred")
+        return
+    if mode == "refresh":
+        print("Fetching and fast-forwarding the mirrors.")
+        report = refresh_repositories(
+            {name: f"https://github.com/{ORG}/{name}.git" for name in selected_repos}, workers=workers, retries=retries
+        )
+        with open(CHANGES_REPORT, "w") as f:
+            json.dump(report, f, indent=2)
+        for name, repo_report in report.items():
+            if repo_report["error"]:
+                print(f"{name}: failed: {repo_report['error']}")
+            else:
+                counts = ", ".join(f"{len(repo_report[kind])} {kind}" for kind in ("added", "modified", "deleted"))
+                print(f"{name}: {repo_report['old']} -> {repo_report['new']}, {counts}")
+        paths = write_changed_paths(report)
+        print(f"{len(paths)} files to process again listed in {CHANGED_PATHS}")
+        return
+
     # Clone repositories in parallel using multiprocessing
     print("Cloning repositories.")
     with Pool() as pool:
@@ -112,5 +390,14 @@ def mirror_repositories():
 
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--mode", choices=["sparse", "full", "refresh"], default="sparse",
+        help="sparse: depth 1 clones of the kept files only, full: `git clone` with the whole history, "
+        "refresh: fetch and fast-forward the existing mirrors and list the changed files",
+    )
+    parser.add_argument("--workers", type=int, default=4, help="concurrent sparse clones or fetches")
+    parser.add_argument("--retries", type=int, default=3, help="attempts after the first one of a clone or fetch")
+    args = parser.parse_args()
     # Entry point: start the mirroring process
-    mirror_repositories()
+    mirror_repositories(args.mode, args.workers, args.retries)
@@ -0,0 +1,241 @@
+# coding=utf-8
+# Copyright 2024 Sourab Mangrulkar. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Decontamination against local evaluation sets, so that copies of benchmark problems in the mirrored
+repos do not end up in the pretraining data.
+
+The word n-grams of the eval files are added to a Bloom filter, a bit array whose size is set from the
+number of n-grams and the accepted false positive rate (or given directly). Each document is then
+checked in a single streaming pass: its n-gram hashes are computed with numpy and looked up all at once,
+and documents with a large enough fraction (or number) of matching n-grams are dropped or flagged.
+"""
+
+import gzip
+import json
+import math
+import os
+
+import numpy as np
+from datatrove.data import Document
+from datatrove.pipeline.filters.base_filter import BaseFilter
+from datatrove.pipeline.writers.disk_base import DiskWriter
+from datatrove.utils.hashing import HashConfig, create_hash_func
+from datatrove.utils.logging import logger
+from datatrove.utils.text import TextNormConfig, simplify_text
+
+# multiplier of the polynomial rolling hash of the word hashes (an odd 64 bit constant)
+NGRAM_MULTIPLIER = np.uint64(0x9E3779B97F4A7C15)
+
+
+def mix64(values: np.ndarray) -> np.ndarray:
+    """splitmix64 finalizer: spreads the bits of the rolling hashes before they are cut into bit positions"""
+    values = (values ^ (values >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+    values = (values ^ (values >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+    return values ^ (values >> np.uint64(31))
+
+
+def read_eval_texts(path: str, text_keys: tuple[str] | None) -> list[str]:
+    """Texts of a local eval file: each line of jsonl (optionally gzipped), a json list, or a whole text file"""
+    opener = gzip.open if path.endswith(".gz") else open
+    name = path.removesuffix(".gz")
+    with opener(path, "rt", encoding="utf-8") as f:
+        if name.endswith(".jsonl"):
+            records = [json.loads(line) for line in f if line.strip()]
+        elif name.endswith(".json"):
+            records = json.load(f)
+        else:
+            return [f.read()]
+    texts = []
+    for record in records:
+        if isinstance(record, str):
+            texts.append(record)
+            continue
+        # every string field by default: prompts, solutions and tests can all leak
+        keys = text_keys or [key for key, value in record.items() if isinstance(value, str)]
+        texts.extend(record[key] for key in keys if isinstance(record.get(key), str))
+    return texts
+
+
+class NGramBloomFilter:
+    """
+    Bloom filter of word n-gram hashes, with `num_hashes` bit positions per n-gram from double hashing.
+
+    Args:
+        num_bits: size of the bit array
+        num_hashes: bits set (and checked) per n-gram
+    """
+
+    def __init__(self, num_bits: int, num_hashes: int):
+        self.num_bits = num_bits
+        self.num_hashes = num_hashes
+        self.bits = np.zeros((num_bits + 7) // 8, dtype=np.uint8)
+
+    @classmethod
+    def for_capacity(cls, num_items: int, false_positive_rate: float) -> "NGramBloomFilter":
+        """Optimal size and number of hashes for `num_items` n-grams at `false_positive_rate`"""
+        num_bits = max(8, math.ceil(-num_items * math.log(false_positive_rate) / math.log(2) ** 2))
+        num_hashes = max(1, round(num_bits / max(num_items, 1) * math.log(2)))
+        return cls(num_bits, num_hashes)
+
+    def positions(self, hashes: np.ndarray) -> np.ndarray:
+        """(num_hashes, len(hashes)) bit positions: h1 + i * h2, from the two halves of each 64 bit hash"""
+        h1 = hashes & np.uint64(0xFFFFFFFF)
+        h2 = (hashes >> np.uint64(32)) | np.uint64(1)
+        steps = np.arange(self.num_hashes, dtype=np.uint64)[:, None]
+        return (h1[None, :] + steps * h2[None, :]) % np.uint64(self.num_bits)
+
+    def add(self, hashes: np.ndarray):
+        positions = self.positions(hashes).ravel()
+        masks = np.left_shift(1, positions & np.uint64(7)).astype(np.uint8)
+        np.bitwise_or.at(self.bits, positions >> np.uint64(3), masks)
+
+    def contains(self, hashes: np.ndarray) -> np.ndarray:
+        """Boolean mask of the hashes that are (probably) in the filter"""
+        positions = self.positions(hashes)
+        bits = (self.bits[positions >> np.uint64(3)] >> (positions & np.uint64(7)).astype(np.uint8)) & 1
+        return bits.all(axis=0)
+
+    def false_positive_rate(self) -> float:
+        """Expected false positive rate, from the fraction of bits set"""
+        fill = np.unpackbits(self.bits)[: self.num_bits].mean()
+        return float(fill**self.num_hashes)
+
+
+class BloomDecontaminationFilter(BaseFilter):
+    """
+    Drops (or flags) documents sharing word n-grams with local evaluation sets.
+
+    Args:
+        eval_files: local eval files, jsonl/json (optionally gzipped) records or plain text files
+        text_keys: fields of the eval records to index, defaults to every string field
+        n_grams: number of words of an n-gram
+        max_match_fraction: documents with a larger fraction of their n-grams in the eval sets are contaminated
+        min_matches: documents with at least this many matching n-grams are contaminated, whatever their length
+        false_positive_rate: false positive rate the filter is sized for, from the number of eval n-grams
+        num_bits: size of the filter in bits, overrides `false_positive_rate`
+        num_hashes: bits per n-gram when `num_bits` is given, defaults to the optimal number for its size
+        flag_only: keep contaminated documents and only set their `contamination` metadata
+        norm_config: normalization of the text before splitting it into words
+        exclusion_writer: optionally pass in a writer that will save the dropped documents
+        batch_size: number of documents per batch
+    """
+
+    name = "🦠 Bloom Decontamination"
+
+    def __init__(
+        self,
+        eval_files: list[str],
+        text_keys: tuple[str] | None = None,
+        n_grams: int = 13,
+        max_match_fraction: float = 0.5,
+        min_matches: int | None = 50,
+        false_positive_rate: float = 1e-4,
+        num_bits: int | None = None,
+        num_hashes: int | None = None,
+        flag_only: bool = False,
+        norm_config: TextNormConfig = TextNormConfig(),
+        exclusion_writer: DiskWriter = None,
+        batch_size: int = 64,
+    ):
+        super().__init__(exclusion_writer, batch_size)
+        self.eval_files = list(eval_files)
+        self.text_keys = text_keys
+        self.n_grams = n_grams
+        self.max_match_fraction = max_match_fraction
+        self.min_matches = min_matches
+        self.false_positive_rate = false_positive_rate
+        self.num_bits = num_bits
+        self.num_hashes = num_hashes
+        self.flag_only = flag_only
+        self.norm_config = norm_config
+        self._hash_fc = None
+        self._bloom = None
+
+    def ngram_hashes(self, text: str) -> np.ndarray:
+        """Hashes of every word n-gram of the normalized text, a rolling hash over the hashes of its words"""
+        words = simplify_text(text, self.norm_config).split()
+        if len(words) < self.n_grams:
+            return np.empty(0, dtype=np.uint64)
+        word_hashes = np.fromiter(map(self._hash_fc, words), dtype=np.uint64, count=len(words))
+        num_ngrams = len(words) - self.n_grams + 1
+        hashes = np.zeros(num_ngrams, dtype=np.uint64)
+        with np.errstate(over="ignore"):
+            for i in range(self.n_grams):
+                hashes = hashes * NGRAM_MULTIPLIER + word_hashes[i : i + num_ngrams]
+            return mix64(hashes)
+
+    def build(self) -> NGramBloomFilter:
+        """Adds the n-grams of every eval file to a new Bloom filter"""
+        self._hash_fc = create_hash_func(HashConfig(precision=64))
+        hashes = [
+            self.ngram_hashes(text) for path in self.eval_files for text in read_eval_texts(path, self.text_keys)
+        ]
+        hashes = np.unique(np.concatenate(hashes)) if hashes else np.empty(0, dtype=np.uint64)
+        if self.num_bits:
+            num_hashes = self.num_hashes or max(1, round(self.num_bits / max(len(hashes), 1) * math.log(2)))
+            bloom = NGramBloomFilter(self.num_bits, num_hashes)
+        else:
+            bloom = NGramBloomFilter.for_capacity(len(hashes), self.false_positive_rate)
+        bloom.add(hashes)
+        logger.info(
+            f"Bloom filter of {len(hashes)} {self.n_grams}-grams from {len(self.eval_files)} eval files: "
+            f"{bloom.num_bits / 8 / 2**20:.1f}MB, {bloom.num_hashes} hashes, "
+            f"expected false positive rate {bloom.false_positive_rate():.2e}"
+        )
+        return bloom
+
+    @property
+    def bloom(self) -> NGramBloomFilter:
+        """The Bloom filter of the eval n-grams, built on first use"""
+        if self._bloom is None:
+            self._bloom = self.build()
+        return self._bloom
+
+    def filter(self, doc: Document) -> bool | tuple[bool, str]:
+        return self.filter_batch([doc])[0]
+
+    def filter_batch(self, batch: list[Document]) -> list[bool | tuple[bool, str]]:
+        bloom = self.bloom
+        results = []
+        for doc in batch:
+            hashes = self.ngram_hashes(doc.text)
+            self.stat_update("ngrams", value=len(hashes))
+            matches = int(bloom.contains(hashes).sum()) if len(hashes) else 0
+            fraction = matches / len(hashes) if len(hashes) else 0.0
+            contaminated = fraction > self.max_match_fraction or (
+                self.min_matches is not None and matches >= self.min_matches
+            )
+            if not contaminated:
+                results.append(True)
+                continue
+            self.stat_update("contaminated")
+            if self.flag_only:
+                doc.metadata["contamination"] = {"matches": matches, "fraction": fraction}
+                results.append(True)
+            else:
+                self.stat_update("dropped_contaminated_chars", value=len(doc.text))
+                results.append((False, "contaminated"))
+        return results
+
+    def run(self, data, rank: int = 0, world_size: int = 1):
+        # built before the first batch, so that the time per batch (the throughput in the stats) is the scan only
+        self.bloom
+        yield from super().run(data, rank, world_size)
+
+
+def get_eval_files(folder: str) -> list[str]:
+    """Every file of a local folder of eval sets"""
+    return sorted(os.path.join(root, file) for root, _, files in os.walk(folder) for file in files)
@@ -0,0 +1,153 @@
+# coding=utf-8
+# Copyright 2024 Sourab Mangrulkar. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Exact deduplication of byte-identical documents, meant to run right after the code filter so that
+vendored and copied files are removed before the (much more expensive) MinHash stages.
+
+Tasks share a SQLite index mapping each content hash to the id of the first document that claimed it.
+A document is kept only if it owns its hash, which also makes re-running a crashed task idempotent:
+its documents find their own ids in the index and are kept again. A full run starts from an empty index
+(`clear_index`), only incremental runs keep it and release the hashes of the changed files.
+
+Documents read from git objects (`git_reader.GitBlobReader`) already carry a content hash, the git SHA of their
+text (the SHA of their blob when the text was not rewritten): with `key_metadata="blob_sha"` it is used as the key
+instead of hashing the text.
+"""
+
+import os
+import sqlite3
+
+from datatrove.data import Document
+from datatrove.pipeline.filters.base_filter import BaseFilter
+from datatrove.pipeline.writers.disk_base import DiskWriter
+from datatrove.utils.hashing import HashConfig, create_hash_func
+
+INDEX_SCHEMA = "CREATE TABLE IF NOT EXISTS content_hashes (hash INTEGER PRIMARY KEY, doc_id TEXT NOT NULL)"
+
+
+def to_signed(value: int) -> int:
+    """SQLite integers are signed 64 bit."""
+    return value - (1 << 64) if value >= 1 << 63 else value
+
+
+def release_doc_ids(index_path: str, doc_ids: list[str]):
+    """Forgets the hashes owned by `doc_ids`, e.g. because their files changed, so that other copies can claim them."""
+    if not doc_ids or not os.path.exists(index_path):
+        return
+    connection = sqlite3.connect(index_path, timeout=600)
+    try:
+        with connection:
+            connection.executemany("DELETE FROM content_hashes WHERE doc_id = ?", [(doc_id,) for doc_id in doc_ids])
+    finally:
+        connection.close()
+
+
+def clear_index(index_path: str):
+    """Removes the index, so that a full run does not find owners from the documents of an earlier run."""
+    for path in [index_path, f"{index_path}-wal", f"{index_path}-shm"]:
+        if os.path.exists(path):
+            os.remove(path)
+
+
+class ExactDedupFilter(BaseFilter):
+    """
+    Drops documents whose text is identical to a document already claimed by any task.
+
+    Args:
+        index_path: path of the SQLite index shared by all tasks
+        hash_config: hash function used on the document text
+        key_metadata: metadata field holding a hex content hash of the document (e.g. "blob_sha"), whose first
+            64 bits are used as the key instead of hashing the text. Documents without it are hashed
+        exclusion_writer: optionally pass in a writer that will save the dropped documents
+        batch_size: number of documents looked up in the index with a single transaction
+    """
+
+    name = "🎯 Exact Dedup"
+
+    def __init__(
+        self,
+        index_path: str = "exact_dedup/index.sqlite",
+        hash_config: HashConfig = HashConfig(precision=64),
+        key_metadata: str | None = None,
+        exclusion_writer: DiskWriter = None,
+        batch_size: int = 256,
+    ):
+        super().__init__(exclusion_writer, batch_size)
+        self.index_path = index_path
+        self.hash_config = hash_config
+        self.key_metadata = key_metadata
+        self._connection = None
+        self._hash_fc = None
+
+    def connect(self) -> sqlite3.Connection:
+        if self._connection is None:
+            os.makedirs(os.path.dirname(os.path.abspath(self.index_path)), exist_ok=True)
+            self._connection = sqlite3.connect(self.index_path, timeout=600, isolation_level=None)
+            self._connection.execute("PRAGMA journal_mode=WAL")
+            self._connection.execute("PRAGMA synchronous=NORMAL")
+            self._connection.execute(INDEX_SCHEMA)
+            self._hash_fc = create_hash_func(self.hash_config)
+        return self._connection
+
+    def get_key(self, doc: Document) -> int:
+        if self.key_metadata and doc.metadata.get(self.key_metadata):
+            return int(doc.metadata[self.key_metadata][:16], 16)
+        return self._hash_fc(doc.text)
+
+    def filter(self, doc: Document) -> bool | tuple[bool, str]:
+        return self.filter_batch([doc])[0]
+
+    def filter_batch(self, batch: list[Document]) -> list[bool | tuple[bool, str]]:
+        connection = self.connect()
+        hashes = [to_signed(self.get_key(doc)) for doc in batch]
+        # claim the hashes not seen yet and read back the owner of every hash in one transaction
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            connection.executemany(
+                "INSERT OR IGNORE INTO content_hashes (hash, doc_id) VALUES (?, ?)",
+                [(content_hash, doc.id) for content_hash, doc in zip(hashes, batch)],
+            )
+            owners = {}
+            unique_hashes = list(set(hashes))
+            for i in range(0, len(unique_hashes), 500):
+                chunk = unique_hashes[i : i + 500]
+                owners.update(
+                    connection.execute(
+                        f"SELECT hash, doc_id FROM content_hashes WHERE hash IN ({','.join('?' * len(chunk))})",
+                        chunk,
+                    )
+                )
+            connection.execute("COMMIT")
+        except Exception:
+            connection.execute("ROLLBACK")
+            raise
+
+        results = []
+        for content_hash, doc in zip(hashes, batch):
+            if owners[content_hash] == doc.id:
+                results.append(True)
+            else:
+                self.stat_update("exact_duplicate_bytes", value=len(doc.text.encode("utf-8")))
+                results.append((False, "exact_duplicate"))
+        return results
+
+    def run(self, data, rank: int = 0, world_size: int = 1):
+        try:
+            yield from super().run(data, rank, world_size)
+        finally:
+            if self._connection is not None:
+                self._connection.close()
+                self._connection = None
@@ -13,12 +13,235 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import re
+import time
+
+import numpy as np
 from datatrove.data import Document
 from datatrove.pipeline.filters.base_filter import BaseFilter
 from datatrove.pipeline.writers.disk_base import DiskWriter
 
+NEWLINE = ord("\n")
+# Character classes, as bit flags, looked up once per character
+ALNUM = 1  # counted as alphanumeric: str.isalpha() or str.isdigit()
+BASE64 = 2  # can be part of a base64 blob
+ASCII_CLASSES = np.array(
+    [
+        (ALNUM if chr(c).isalpha() or chr(c).isdigit() else 0)
+        | (BASE64 if chr(c).isalnum() or chr(c) in "+/=\n" else 0)
+        for c in range(128)
+    ],
+    dtype=np.uint8,
+)
+# minimum length of a run of base64 characters counted as encoded data
+MIN_BASE64_LENGTH = 64
+
+
+def _code_points(text):
+    """Returns a NumPy view of the characters of `text`, one element per character."""
+    if text.isascii():
+        return np.frombuffer(text.encode("ascii"), dtype=np.uint8)
+    return np.frombuffer(text.encode("utf-32-le"), dtype=np.uint32)
+
+
+def _char_classes(chars):
+    """Returns the class flags of every character of `chars`."""
+    if chars.dtype == np.uint8:
+        return ASCII_CLASSES[chars]
+    is_ascii = chars < 128
+    classes = np.zeros(len(chars), dtype=np.uint8)
+    classes[is_ascii] = ASCII_CLASSES[chars[is_ascii]]
+    # only look up each distinct non ascii character once
+    unique, inverse = np.unique(chars[~is_ascii], return_inverse=True)
+    unique_alnum = np.array([chr(c).isalpha() or chr(c).isdigit() for c in unique.tolist()], dtype=np.uint8)
+    classes[~is_ascii] = unique_alnum[inverse] * ALNUM
+    return classes
+
+
+def get_batch_stats(texts):
+    """
+    Computes cheap text statistics for many documents with a few vectorized passes over a single buffer.
+
+    The texts are joined with newlines, so that every line of the buffer belongs to exactly one document,
+    and per document values are reduced over the segments of the buffer.
+
+    Args:
+        texts (list): The texts of the documents.
+
+    Returns:
+        list: One dict per text with num_chars, num_lines, max_line_length, mean_line_length,
+        alphanum_count, alphanum_ratio and the total and max length of base64 like runs
+        (base64_chars, max_base64_length).
+    """
+    if not texts:
+        return []
+    # a separator also ends the last text, so that every segment (even of an empty text) is in the buffer
+    chars = _code_points("\n".join(texts) + "\n")
+    num_chars = np.array([len(text) for text in texts], dtype=np.int64)
+    starts = np.zeros(len(texts), dtype=np.int64)
+    starts[1:] = np.cumsum(num_chars + 1)[:-1]
+    ends = starts + num_chars
+
+    classes = _char_classes(chars)
+    # each segment also holds the newline separator that follows the text, which is not alphanumeric
+    alnum_count = np.add.reduceat(classes & ALNUM, starts, dtype=np.int64)
+
+    # every newline, including the separators, ends a line: line i spans (newlines[i-1], newlines[i])
+    newlines = np.flatnonzero(chars == NEWLINE)
+    line_ends = np.append(newlines, len(chars))
+    line_lengths = np.diff(line_ends, prepend=-1) - 1
+    num_lines = np.searchsorted(newlines, ends) - np.searchsorted(newlines, starts) + 1
+    first_line = np.zeros(len(texts), dtype=np.int64)
+    first_line[1:] = np.cumsum(num_lines)[:-1]
+    max_line_length = np.maximum.reduceat(line_lengths, first_line)
+
+    # runs of at least MIN_BASE64_LENGTH base64 characters, the separators between texts end a run
+    base64_mask = (classes & BASE64) != 0
+    base64_mask[ends] = False
+    padded = np.zeros(len(base64_mask) + 2, dtype=bool)
+    padded[1:-1] = base64_mask
+    edges = np.flatnonzero(padded[1:] != padded[:-1])
+    run_starts, run_lengths = edges[::2], edges[1::2] - edges[::2]
+    long_runs = run_lengths >= MIN_BASE64_LENGTH
+    run_starts, run_lengths = run_starts[long_runs], run_lengths[long_runs]
+    run_texts = np.searchsorted(starts, run_starts, side="right") - 1
+    base64_chars = np.bincount(run_texts, weights=run_lengths, minlength=len(texts))
+    max_base64_length = np.zeros(len(texts), dtype=np.int64)
+    np.maximum.at(max_base64_length, run_texts, run_lengths)
+
+    stats = []
+    for i in range(len(texts)):
+        n_chars, n_lines = int(num_chars[i]), int(num_lines[i])
+        stats.append(
+            {
+                "num_chars": n_chars,
+                "num_lines": n_lines,
+                "max_line_length": int(max_line_length[i]),
+                "mean_line_length": (n_chars - n_lines + 1) / n_lines,
+                "alphanum_count": int(alnum_count[i]),
+                "alphanum_ratio": int(alnum_count[i]) / n_chars if n_chars else 0.0,
+                "base64_chars": int(base64_chars[i]),
+                "max_base64_length": int(max_base64_length[i]),
+            }
+        )
+    return stats
+
+
+def get_text_stats(text):
+    """
+    Computes the text statistics of a single document, see `get_batch_stats`.
+
+    Args:
+        text (str): The text of the document.
+
+    Returns:
+        dict: The statistics of the text.
+    """
+    return get_batch_stats([text])[0]
+
+
+# Key of the cached per document stats in `doc.metadata`
+STATS_KEY = "code_stats"
+# Markers of generated files, looked for in the first lines only
+AUTOGEN_MARKERS = (
+    "auto-generated",
+    "autogenerated",
+    "automatically generated",
+    "do not edit",
+)
+AUTOGEN_HEADER_LINES = 5
+LICENSE_MARKERS = (
+    "license",
+    "licence",
+    "copyright",
+    "permission is hereby granted",
+    "all rights reserved",
+)
+# license files are matched on their whole name: LICENSE, LICENSE.md or COPYING.txt, not license_utils.py
+LICENSE_FILES = ("LICENSE", "LICENCE", "COPYING", "NOTICE")
+LICENSE_FILE_EXTENSIONS = ("", "txt", "md", "rst")
+COMMENT_PREFIXES = ("#", "//", "/*", "*", "<!--", "--", ";", "%")
+MINIFIED_EXTENSIONS = ("js", "mjs", "css", "scss", "less", "map")
+# hex byte arrays and unicode escape runs, base64 blobs are found in get_batch_stats
+HEX_DATA_REGEX = re.compile(r"(?:(?:0x|\\x)[0-9a-fA-F]{2}\b\s*,?\s*){8,}")
+UNICODE_DATA_REGEX = re.compile(r"(?:\\u[0-9a-fA-F]{4}){8,}")
+MIN_ENCODED_LITERALS = 8
+# Threshold overrides per file extension, None disables a threshold
+DEFAULT_EXTENSION_THRESHOLDS = {
+    "ipynb": {"max_line_length": None, "mean_line_length": None, "alphanum": None},
+    "md": {"max_line_length": 3000, "mean_line_length": 300},
+    "mdx": {"max_line_length": 3000, "mean_line_length": 300},
+    "rst": {"max_line_length": 3000, "mean_line_length": 300},
+}
+
+
+def get_extension(filepath):
+    name = filepath.rsplit("/", 1)[-1]
+    return name.rsplit(".", 1)[-1].lower() if "." in name else ""
+
+
+def get_line_prefix(text, num_lines):
+    """Returns the first `num_lines` lines of `text` without splitting the rest of it."""
+    end = -1
+    for _ in range(num_lines):
+        end = text.find("\n", end + 1)
+        if end == -1:
+            return text
+    return text[:end]
+
+
+def is_autogenerated(text):
+    header = get_line_prefix(text, AUTOGEN_HEADER_LINES).lower()
+    return any(marker in header for marker in AUTOGEN_MARKERS)
+
+
+def is_license_file(filepath):
+    stem, _, extension = filepath.rsplit("/", 1)[-1].partition(".")
+    return stem.upper() in LICENSE_FILES and extension.lower() in LICENSE_FILE_EXTENSIONS
+
+
+def get_license_fraction(text, filepath):
+    """
+    Fraction of the text taken by a license header: the leading block of comments and blank
+    lines, if it mentions a license. License files themselves count as fully boilerplate.
+    """
+    if is_license_file(filepath):
+        return 1.0
+    header_end = 0
+    while header_end < len(text):
+        line_end = text.find("\n", header_end)
+        line_end = len(text) if line_end == -1 else line_end + 1
+        line = text[header_end:line_end].strip()
+        if line and not line.startswith(COMMENT_PREFIXES):
+            break
+        header_end = line_end
+    header = text[:header_end].lower()
+    if not any(marker in header for marker in LICENSE_MARKERS):
+        return 0.0
+    return header_end / len(text)
+
+
+def get_encoded_data_stats(text, stats):
+    """
+    Returns the fraction of the text inside encoded data literals (base64, hex arrays and unicode
+    escapes) and the longest such literal. The regexes only run on texts with enough candidates.
+    """
+    if not text:
+        return 0.0, 0
+    total, longest = stats["base64_chars"], stats["max_base64_length"]
+    for regex, prefixes in ((HEX_DATA_REGEX, ("0x", "\\x")), (UNICODE_DATA_REGEX, ("\\u",))):
+        if sum(text.count(prefix) for prefix in prefixes) < MIN_ENCODED_LITERALS:
+            continue
+        for match in regex.finditer(text):
+            length = match.end() - match.start()
+            total += length
+            longest = max(longest, length)
+    return total / len(text), longest
+
 
 def get_basic_stats(text):
+    if not text:
+        return 0, 0.0, 0.0
     line_lengths = [len(line) for line in text.split("\n")]
     max_line_length = max(line_lengths)
     mean_line_length = sum(line_lengths) / len(line_lengths)
@@ -36,13 +259,32 @@ class BasicCodeFilter(BaseFilter):
         mean_line_length_threshold: int | None = 100,
         alphanum_threshold: float | None = 0.25,
         exclusion_writer: DiskWriter = None,
+        batch_size: int = 64,
     ):  # TODO better tune
-        """ """
-        super().__init__(exclusion_writer)
+        """
+        Args:
+            max_line_length_threshold: documents with a longer line are removed
+            mean_line_length_threshold: documents with a longer mean line length are removed
+            alphanum_threshold: documents with a lower fraction of alphanumeric characters are removed
+            exclusion_writer: optionally pass in a writer that will save the dropped documents
+            batch_size: number of documents whose stats are computed together
+        """
+        super().__init__(exclusion_writer, batch_size)
         self.max_line_length_threshold = max_line_length_threshold
         self.mean_line_length_threshold = mean_line_length_threshold
         self.alphanum_threshold = alphanum_threshold
 
+    def needs_stats(self, doc: Document) -> bool:
+        """Notebooks and documents already marked for removal are decided without text stats."""
+        return doc.text != "remove" and "ipynb" not in doc.metadata["file_path"]
+
+    def keep_from_stats(self, stats: dict) -> bool:
+        return not (
+            stats["max_line_length"] > self.max_line_length_threshold
+            or stats["mean_line_length"] > self.mean_line_length_threshold
+            or stats["alphanum_ratio"] < self.alphanum_threshold
+        )
+
     def filter(self, doc: Document) -> bool | tuple[bool, str]:
         """Applies heuristic rules to decide if a document should be REMOVED
         Args:
@@ -52,17 +294,153 @@ class BasicCodeFilter(BaseFilter):
             False if sample.text has lines longer than max line length threshold or
             mean line length threshold or the fraction of alphanumeric charaters is less than the given threshold
         """
-        text = doc.text
-        filepath = doc.metadata["file_path"]
-        keep_sample = True
-        if text == "remove":
-            keep_sample = False
-        elif "ipynb" not in filepath:
-            max_line_length, mean_line_length, alphanum_ratio = get_basic_stats(text)
-            if (
-                max_line_length > self.max_line_length_threshold
-                or mean_line_length > self.mean_line_length_threshold
-                or alphanum_ratio < self.alphanum_threshold
+        return self.filter_batch([doc])[0]
+
+    def filter_batch(self, batch: list[Document]) -> list[bool | tuple[bool, str]]:
+        """Same decisions as `filter`, computing the stats of the whole batch in one call"""
+        results = [doc.text != "remove" for doc in batch]
+        to_check = [i for i, doc in enumerate(batch) if self.needs_stats(doc)]
+        for i, stats in zip(to_check, get_batch_stats([batch[i].text for i in to_check])):
+            results[i] = self.keep_from_stats(stats)
+        return results
+
+
+class CodeQualityFilter(BasicCodeFilter):
+    """
+    StarCoder style code quality heuristics on top of the `BasicCodeFilter` thresholds.
+
+    Every rule only reads a per document stats dict computed once and cached in
+    `doc.metadata[STATS_KEY]`, so adding rules does not add passes over the text. Documents are
+    dropped with the name of the first failing rule as reason, and the dropped characters and the
+    time spent computing each signal are added to the step stats.
+    """
+
+    name = "🧹 Code Quality Filter"
+    RULES = ("unreadable", "autogenerated", "minified", "encoded_data", "license", "line_length", "alphanum")
+
+    def __init__(
+        self,
+        max_line_length_threshold: int | None = 1000,
+        mean_line_length_threshold: int | None = 100,
+        alphanum_threshold: float | None = 0.25,
+        minified_max_line_length: int = 500,
+        max_encoded_data_fraction: float = 0.5,
+        max_encoded_data_length: int = 1024,
+        max_license_fraction: float = 0.8,
+        extension_thresholds: dict | None = None,
+        rules: tuple[str] | None = None,
+        keep_stats: bool = False,
+        exclusion_writer: DiskWriter = None,
+        batch_size: int = 64,
+    ):
+        """
+        Args:
+            max_line_length_threshold: documents with a longer line are removed
+            mean_line_length_threshold: documents with a longer mean line length are removed
+            alphanum_threshold: documents with a lower fraction of alphanumeric characters are removed
+            minified_max_line_length: js/css documents with a longer line are considered minified
+            max_encoded_data_fraction: documents with a larger fraction of base64/hex/unicode literals are removed
+            max_encoded_data_length: documents with a longer base64/hex/unicode literal are removed
+            max_license_fraction: documents whose license header takes a larger fraction are removed
+            extension_thresholds: per extension overrides of max_line_length, mean_line_length and alphanum,
+                defaults to DEFAULT_EXTENSION_THRESHOLDS
+            rules: names of the rules to apply, defaults to all RULES
+            keep_stats: keep the stats in the metadata of the documents after filtering
+            exclusion_writer: optionally pass in a writer that will save the dropped documents
+            batch_size: number of documents whose stats are computed together
+        """
+        super().__init__(
+            max_line_length_threshold,
+            mean_line_length_threshold,
+            alphanum_threshold,
+            exclusion_writer,
+            batch_size,
+        )
+        self.minified_max_line_length = minified_max_line_length
+        self.max_encoded_data_fraction = max_encoded_data_fraction
+        self.max_encoded_data_length = max_encoded_data_length
+        self.max_license_fraction = max_license_fraction
+        self.extension_thresholds = (
+            DEFAULT_EXTENSION_THRESHOLDS if extension_thresholds is None else extension_thresholds
+        )
+        self.rules = self.RULES if rules is None else tuple(rules)
+        unknown = set(self.rules) - set(self.RULES)
+        if unknown:
+            raise ValueError(f"Unknown rules {sorted(unknown)}, available rules are {self.RULES}")
+        self.keep_stats = keep_stats
+
+    def compute_stats(self, batch: list[Document]):
+        """Adds the stats to the metadata of the documents of the batch that do not have them yet."""
+        missing = [doc for doc in batch if STATS_KEY not in doc.metadata and doc.text != "remove"]
+        if not missing:
+            return
+        start = time.perf_counter()
+        all_stats = get_batch_stats([doc.text for doc in missing])
+        self.stat_update("time_text_stats", value=time.perf_counter() - start, unit="batch")
+        timings = dict.fromkeys(("autogenerated", "encoded_data", "license"), 0.0)
+        for doc, stats in zip(missing, all_stats):
+            filepath = doc.metadata["file_path"]
+            stats["extension"] = get_extension(filepath)
+            start = time.perf_counter()
+            stats["autogenerated"] = is_autogenerated(doc.text)
+            timings["autogenerated"] += time.perf_counter() - start
+            start = time.perf_counter()
+            stats["encoded_data_fraction"], stats["max_encoded_data_length"] = get_encoded_data_stats(doc.text, stats)
+            timings["encoded_data"] += time.perf_counter() - start
+            start = time.perf_counter()
+            stats["license_fraction"] = get_license_fraction(doc.text, filepath)
+            timings["license"] += time.perf_counter() - start
+            doc.metadata[STATS_KEY] = stats
+        for signal, seconds in timings.items():
+            self.stat_update(f"time_{signal}", value=seconds, unit="batch")
+
+    def get_threshold(self, stats: dict, name: str, default):
+        return self.extension_thresholds.get(stats["extension"], {}).get(name, default)
+
+    def failed_rule(self, doc: Document) -> str | None:
+        """Returns the name of the first rule the document fails, None if it passes all of them"""
+        if doc.text == "remove":
+            return "unreadable" if "unreadable" in self.rules else None
+        stats = doc.metadata[STATS_KEY]
+        for rule in self.rules:
+            if rule == "autogenerated" and stats["autogenerated"]:
+                return rule
+            if rule == "minified" and stats["extension"] in MINIFIED_EXTENSIONS:
+                if ".min." in doc.metadata["file_path"] or stats["max_line_length"] > self.minified_max_line_length:
+                    return rule
+            if rule == "encoded_data" and (
+                stats["encoded_data_fraction"] > self.max_encoded_data_fraction
+                or stats["max_encoded_data_length"] > self.max_encoded_data_length
             ):
-                keep_sample = False
-        return keep_sample
+                return rule
+            if rule == "license" and stats["license_fraction"] > self.max_license_fraction:
+                return rule
+            if rule == "line_length":
+                max_line_length = self.get_threshold(stats, "max_line_length", self.max_line_length_threshold)
+                mean_line_length = self.get_threshold(stats, "mean_line_length", self.mean_line_length_threshold)
+                if (max_line_length is not None and stats["max_line_length"] > max_line_length) or (
+                    mean_line_length is not None and stats["mean_line_length"] > mean_line_length
+                ):
+                    return rule
+            if rule == "alphanum":
+                alphanum = self.get_threshold(stats, "alphanum", self.alphanum_threshold)
+                if alphanum is not None and stats["alphanum_ratio"] < alphanum:
+                    return rule
+        return None
+
+    def filter_batch(self, batch: list[Document]) -> list[bool | tuple[bool, str]]:
+        self.compute_stats(batch)
+        results = []
+        for doc in batch:
+            rule = self.failed_rule(doc)
+            if rule is None and doc.text == "remove":
+                # the placeholder of unreadable files is always dropped, the "unreadable" rule only counts it
+                results.append(False)
+            elif rule is None:
+                results.append(True)
+            else:
+                self.stat_update(f"dropped_{rule}_chars", value=len(doc.text))
+                results.append((False, rule))
+            if not self.keep_stats:
+                doc.metadata.pop(STATS_KEY, None)
+        return results
@@ -0,0 +1,70 @@
+# coding=utf-8
+# Copyright 2024 Sourab Mangrulkar. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+MinHash signatures computed inside stage 0, while the filtered documents are written.
+
+Stage 1 otherwise reads every shard of `filtered_data` back only to sign it. Placed right before the
+writer of stage 0, `StreamingMinhashDedupSignature` signs each document and passes it on, so task `rank`
+writes `signatures/bucket_XXX/{rank:05d}.minhash.sig` with the same document indices as stage 4 will
+read them in shard `rank`, and stages 2 to 4 run unchanged.
+"""
+
+import struct
+
+from datatrove.data import DocumentsPipeline
+from datatrove.pipeline.dedup import MinhashDedupSignature
+from datatrove.utils.typeshelper import StatHints
+
+
+class StreamingMinhashDedupSignature(MinhashDedupSignature):
+    """
+    `MinhashDedupSignature` that yields its documents to the next step instead of consuming them.
+
+    It must be the last step before the writer: a document dropped after it would shift the indices
+    of the signatures of every later document of the shard.
+
+    Args:
+        output_folder: output folder of the signatures
+        config: minhash configuration (a MinhashConfig object)
+    """
+
+    name = "🎯 MinHash stage 1 (streaming)"
+
+    def run(self, data: DocumentsPipeline, rank: int = 0, world_size: int = 1) -> DocumentsPipeline:
+        buckets = [
+            self.output_folder.open(f"bucket_{bi:03d}/{rank:05d}.minhash.sig", mode="wb")
+            for bi in range(self.config.num_buckets)
+        ]
+        record_format = f"<{self.config.hashes_per_bucket}{self.config.hash_config.struct_format}I"
+        try:
+            for doc_idx, doc in enumerate(data):
+                self.stat_update(StatHints.total)
+                with self.track_time():
+                    shingles = self.get_shingles(doc.text)
+                    if shingles.size != 0:
+                        for bucket, bucket_sig in zip(buckets, self.get_signature(shingles)):
+                            bucket.write(struct.pack(record_format, *bucket_sig, doc_idx))
+                yield doc
+        finally:
+            for file in buckets:
+                file.close()
+
+        # the signature files are complete but unsorted: the parent step only sorts and verifies existing files
+        skip_existing_sigs, self.skip_existing_sigs = self.skip_existing_sigs, True
+        try:
+            super().run(iter(()), rank, world_size)
+        finally:
+            self.skip_existing_sigs = skip_existing_sigs
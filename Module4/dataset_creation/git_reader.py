@@ -0,0 +1,258 @@
+# coding=utf-8
+# Copyright 2024 Sourab Mangrulkar. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Reads the documents of the mirrors from their git object stores instead of their working trees.
+
+`GitBlobReader` lists the tree of a commit of every repo of the mirror directory (`git ls-tree -r -l`), which
+gives the path, size and blob SHA of each file without touching the files. Blocked extensions, excluded
+directories and files over `max_file_size` are skipped from that listing alone, so their blobs are never read
+(nor fetched, in a partial clone). The kept blobs are streamed in batches from a persistent
+`git cat-file --batch` process per repo. The documents have the same id, `file_path` and `repo_id` as the ones
+of `PersonalCopilotDatasetReader`, and the git SHA of their text in `metadata["blob_sha"]`: the SHA of the blob
+from the tree when the text is the blob itself, else (notebooks converted to text, normalized CR line ends) the
+SHA the text would have as a blob. Identical texts have the same SHA, so `ExactDedupFilter(key_metadata="blob_sha")`
+can use it instead of hashing the text.
+"""
+
+import hashlib
+import itertools
+import os
+import subprocess
+
+from datatrove.utils.logging import logger
+
+from reader import SNIFF_BYTES, PersonalCopilotDatasetReader, is_excluded, looks_binary
+
+# a batch of requests (41 bytes each) is written before its answers are read: it has to fit in the
+# pipe buffer (64KB on Linux), or git would block on its full stdout while we block on its full stdin
+MAX_BATCH_OBJECTS = 1024
+
+
+def git_blob_sha(data: bytes) -> str:
+    """SHA of `data` as a git blob, the one `git hash-object` gives"""
+    return hashlib.sha1(b"blob %d\0" % len(data) + data).hexdigest()
+
+
+class CatFileBatch:
+    """
+    A persistent `git cat-file --batch` process, reading objects of a repository by SHA.
+
+    Args:
+        repository_path (str): Directory of the repository (working tree or bare).
+    """
+
+    def __init__(self, repository_path):
+        self.repository_path = repository_path
+        self.process = subprocess.Popen(
+            ["git", "-C", repository_path, "cat-file", "--batch"], stdin=subprocess.PIPE, stdout=subprocess.PIPE
+        )
+
+    def read(self, shas):
+        """
+        Contents of a batch of at most `MAX_BATCH_OBJECTS` objects, in order (None for a missing object).
+        All the requests are written at once, then all the answers are read.
+        """
+        assert len(shas) <= MAX_BATCH_OBJECTS, f"batches are limited to {MAX_BATCH_OBJECTS} objects"
+        self.process.stdin.write("".join(f"{sha}\n" for sha in shas).encode())
+        self.process.stdin.flush()
+        contents = []
+        for sha in shas:
+            # "<sha> <type> <size>\n<content>\n" or "<sha> missing\n"
+            header = self.process.stdout.readline().split()
+            if len(header) != 3:
+                if not header:
+                    raise RuntimeError(f"git cat-file stopped in {self.repository_path}")
+                contents.append(None)
+                continue
+            contents.append(self.process.stdout.read(int(header[2])))
+            self.process.stdout.read(1)
+        return contents
+
+    def close(self):
+        self.process.stdin.close()
+        self.process.wait()
+        self.process.stdout.close()
+
+
+def list_tree(repository_path, revision="HEAD"):
+    """
+    Files of the tree of a commit, from git metadata only.
+
+    Returns:
+        dict: (blob SHA, size in bytes) of each regular file, by path relative to the repository.
+            Symbolic links and submodules are left out.
+    """
+    output = subprocess.run(
+        ["git", "-C", repository_path, "ls-tree", "-r", "-l", "-z", revision],
+        check=True,
+        capture_output=True,
+    ).stdout
+    files = {}
+    for entry in output.decode("utf-8", errors="surrogateescape").split("\0"):
+        if not entry:
+            continue
+        # "<mode> <type> <sha> <size>\t<path>"
+        info, path = entry.split("\t", 1)
+        mode, object_type, sha, size = info.split()
+        if object_type == "blob" and mode != "120000":
+            files[path] = (sha, int(size))
+    return files
+
+
+class GitBlobReader(PersonalCopilotDatasetReader):
+    """
+    `PersonalCopilotDatasetReader` reading the blobs of a commit of each repository of `data_folder` from
+    their object stores, without a checkout.
+
+    Sharding (`balance_by_size` uses the sizes of the trees), `paths_file`, notebook conversion and the
+    document metadata are the ones of `PersonalCopilotDatasetReader`. `prefetch` is not used: the blobs
+    are read in batches of up to `MAX_BATCH_OBJECTS` files or `prefetch_max_bytes` bytes.
+
+    Args:
+        data_folder (DataFolderLike): Local folder of the mirrors, one git repository per subdirectory.
+        revision (str): Commit read in every repository.
+        **kwargs: Arguments of `PersonalCopilotDatasetReader`.
+    """
+
+    name = "🌳 PersonalCopilot (git objects)"
+
+    def __init__(self, data_folder, revision: str = "HEAD", **kwargs):
+        super().__init__(data_folder, **kwargs)
+        self.revision = revision
+        self._blobs = None
+        self._stores = {}
+        # paths of the current shard whose text is not their blob (line ends normalized, empty, binary or not utf-8)
+        self._rewritten = set()
+
+    @property
+    def blobs(self) -> dict:
+        """(blob SHA, size) of every file of every repository, by path relative to `data_folder`"""
+        if self._blobs is None:
+            self._blobs = {}
+            root = self.data_folder.path
+            for name in sorted(os.listdir(root)):
+                repository_path = os.path.join(root, name)
+                if not os.path.exists(os.path.join(repository_path, ".git")):
+                    continue
+                try:
+                    tree = list_tree(repository_path, self.revision)
+                except subprocess.CalledProcessError as e:
+                    logger.warning(f"Cannot list {self.revision} of {repository_path}: {e.stderr.decode().strip()}")
+                    continue
+                self._blobs.update((f"{name}/{path}", blob) for path, blob in tree.items())
+        return self._blobs
+
+    def _file_size(self, filepath: str) -> int:
+        return self.blobs.get(filepath, (None, 0))[1]
+
+    def list_files(self) -> list[str]:
+        """
+        Lists the files of the trees, without the ones `is_excluded` blocks.
+
+        Returns:
+            list: Sorted file paths relative to the data folder.
+        """
+        return sorted(path for path in self.blobs if not is_excluded(path))
+
+    def is_readable(self, filepath: str) -> bool:
+        """Whether the blob of a path is read, from the tree metadata only"""
+        if filepath not in self.blobs or is_excluded(filepath):
+            return False
+        return self.max_file_size is None or self._file_size(filepath) <= self.max_file_size
+
+    def get_batches(self, paths: list[str]):
+        """Consecutive paths of a repository, in batches of `MAX_BATCH_OBJECTS` files or `prefetch_max_bytes`"""
+        batch, batch_bytes = [], 0
+        for path in paths:
+            size = self._file_size(path)
+            over_budget = self.prefetch_max_bytes is not None and batch_bytes + size > self.prefetch_max_bytes
+            if batch and (len(batch) == MAX_BATCH_OBJECTS or over_budget):
+                yield batch
+                batch, batch_bytes = [], 0
+            batch.append(path)
+            batch_bytes += size
+        if batch:
+            yield batch
+
+    def decode(self, data: bytes | None) -> str:
+        """Text of a blob, empty for binary or non utf-8 files (same rules as `read_raw`)"""
+        if data is None or looks_binary(data[:SNIFF_BYTES]):
+            return ""
+        try:
+            return data.decode("utf-8").replace("\r\n", "\n").replace("\r", "\n")
+        except UnicodeDecodeError:
+            return ""
+
+    def read_blobs(self, shard: list[str]):
+        """
+        Reads the blobs of a shard, batch by batch, with the `git cat-file --batch` process of each repository.
+
+        Yields:
+            tuple: (path, content) pairs in the same order as `shard`.
+        """
+        for repository, paths in itertools.groupby(shard, key=lambda path: path.split("/", 1)[0]):
+            paths = list(paths)
+            batches = self.get_batches([path for path in paths if self.is_readable(path)])
+            contents = {}
+            for path in paths:
+                if not self.is_readable(path):
+                    yield path, ""
+                    continue
+                if path not in contents:
+                    # the previous batch is consumed, request the next one
+                    if repository not in self._stores:
+                        self._stores[repository] = CatFileBatch(os.path.join(self.data_folder.path, repository))
+                    batch = next(batches)
+                    blobs = self._stores[repository].read([self.blobs[batch_path][0] for batch_path in batch])
+                    contents = {}
+                    for batch_path, data in zip(batch, blobs):
+                        contents[batch_path] = self.decode(data)
+                        if not contents[batch_path] or b"\r" in data:
+                            self._rewritten.add(batch_path)
+                yield path, contents.pop(path)
+
+    def read_files_shard(self, shard: list[str]):
+        """
+        Reads a list of files from the object stores and yields Documents.
+
+        Args:
+            shard (list): A list of file paths.
+
+        Yields:
+            Document: A datatrove Document object with text and metadata.
+        """
+        self._read_ahead = self.read_blobs(shard)
+        try:
+            # the parent's read-ahead path: read_file takes the contents from `_read_ahead`
+            yield from super(PersonalCopilotDatasetReader, self).read_files_shard(shard)
+        finally:
+            self._read_ahead.close()
+            self._read_ahead = None
+            for store in self._stores.values():
+                store.close()
+            self._stores.clear()
+            self._rewritten.clear()
+
+    def read_file(self, filepath: str):
+        for document in super().read_file(filepath):
+            # the SHA of the tree only identifies the text when the text is the blob
+            is_blob = self.is_readable(filepath) and filepath not in self._rewritten
+            if is_blob and not filepath.endswith("ipynb"):
+                document.metadata["blob_sha"] = self.blobs[filepath][0]
+            else:
+                document.metadata["blob_sha"] = git_blob_sha(document.text.encode("utf-8"))
+            self._rewritten.discard(filepath)
+            yield document
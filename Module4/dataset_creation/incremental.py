@@ -0,0 +1,378 @@
+# coding=utf-8
+# Copyright 2024 Sourab Mangrulkar. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Incremental re-runs of the dataset pipeline.
+
+A SQLite manifest records every input file of `MIRROR_DIRECTORY` (path, size, mtime and content hash)
+together with where its document ended up: a *part* of `filtered_data` and the index of the document in it.
+Parts are numbered contiguously across runs and part P is always read by task P, so its minhash signatures
+(`signatures/bucket_XXX/{P:05d}.minhash.sig`) and its `remove_ids/{P:06d}.remove` file stay valid between runs.
+
+A re-run:
+1. stats every file and only hashes the ones whose size or mtime changed (with the report of
+   `clone_hf_repos.py --mode refresh`, only the added and modified files, and the deleted files of the report),
+2. reads, filters and signs the new and changed files only, writing them as new parts,
+3. marks the documents of changed and deleted files as stale: they are dropped from the cached signatures
+   and added to the `.remove` files of their part,
+4. recomputes the buckets and clusters (which only read signatures) and rebuilds `hf_stack` from all parts.
+
+Usage:
+    python incremental.py
+    python clone_hf_repos.py --mode refresh && python incremental.py --changes_report mirror_changes.json
+"""
+
+import argparse
+import json
+import os
+import shutil
+import sqlite3
+
+import numpy as np
+import xxhash
+from datatrove.executor.local import LocalPipelineExecutor
+
+from exact_dedup import release_doc_ids
+from pipeline import (
+    EXACT_DEDUP_INDEX,
+    INTERMEDIATE_EXTENSIONS,
+    INTERMEDIATE_FORMAT,
+    MIRROR_DIRECTORY,
+    check_mirror_directory,
+    get_available_cores,
+    get_buckets_pipeline,
+    get_cluster_pipeline,
+    get_dedup_filter_pipeline,
+    get_intermediate_reader,
+    get_read_filter_pipeline,
+    get_signature_pipeline,
+    get_total_tasks,
+    minhash_config,
+)
+from reader import PersonalCopilotDatasetReader, is_excluded
+
+MANIFEST_FOLDER = "manifest"
+PARTS_FOLDER = "filtered_data"
+STAGING_FOLDER = "filtered_runs"
+HASH_CHUNK_SIZE = 2**20
+
+MANIFEST_SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    path TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER, content_hash INTEGER,
+    part INTEGER, doc_idx INTEGER, run INTEGER
+);
+CREATE TABLE IF NOT EXISTS parts (part INTEGER PRIMARY KEY, run INTEGER, num_docs INTEGER, signed INTEGER);
+CREATE TABLE IF NOT EXISTS stale (part INTEGER, doc_idx INTEGER, run INTEGER, PRIMARY KEY (part, doc_idx));
+CREATE TABLE IF NOT EXISTS runs (run INTEGER PRIMARY KEY, new INTEGER, changed INTEGER, deleted INTEGER, reprocessed INTEGER);
+"""
+
+
+def hash_file(path):
+    """Content hash of a file, as a signed 64 bit integer so that it fits in SQLite."""
+    hasher = xxhash.xxh3_64()
+    with open(path, "rb") as f:
+        while chunk := f.read(HASH_CHUNK_SIZE):
+            hasher.update(chunk)
+    return hasher.intdigest() - (1 << 63)
+
+
+class Manifest:
+    """
+    Persistent record of the processed input files, the parts they were written to and the stale documents.
+
+    Args:
+        folder: folder of the SQLite manifest and of the per run paths files
+    """
+
+    def __init__(self, folder: str = MANIFEST_FOLDER):
+        os.makedirs(folder, exist_ok=True)
+        self.folder = folder
+        self.connection = sqlite3.connect(os.path.join(folder, "manifest.sqlite"))
+        self.connection.executescript(MANIFEST_SCHEMA)
+
+    def start_run(self) -> int:
+        (last_run,) = self.connection.execute("SELECT MAX(run) FROM runs").fetchone()
+        return 0 if last_run is None else last_run + 1
+
+    def files(self) -> dict:
+        rows = self.connection.execute("SELECT path, size, mtime_ns, content_hash, part, doc_idx FROM files")
+        return {row[0]: row[1:] for row in rows}
+
+    def num_parts(self) -> int:
+        (num_parts,) = self.connection.execute("SELECT COUNT(*) FROM parts").fetchone()
+        return num_parts
+
+    def first_unsigned_part(self) -> int | None:
+        (part,) = self.connection.execute("SELECT MIN(part) FROM parts WHERE signed = 0").fetchone()
+        return part
+
+    def stale_docs(self, run: int | None = None) -> dict:
+        """Returns the sorted stale document indices of each part, optionally only the ones marked in `run`"""
+        query, args = "SELECT part, doc_idx FROM stale", ()
+        if run is not None:
+            query, args = query + " WHERE run = ?", (run,)
+        stale = {}
+        for part, doc_idx in self.connection.execute(query + " ORDER BY part, doc_idx", args):
+            stale.setdefault(part, []).append(doc_idx)
+        return stale
+
+    def scan(self, mirror_directory: str, paths: list[str], deleted: list[str] | None = None):
+        """
+        Compares the files of the mirror with the manifest. Only files whose size or mtime changed are hashed.
+        `paths` lists every file of the mirror, or with `deleted` only the added and modified ones: the other
+        files of the manifest are then unchanged, and the `deleted` ones it holds are deleted.
+
+        Returns:
+            tuple: (new, changed, deleted, unchanged) where new and changed map each path to its
+            (size, mtime_ns, content_hash), and deleted and unchanged are lists of paths.
+        """
+        known = self.files()
+        new, changed, unchanged = {}, {}, []
+        for path in paths:
+            stat = os.stat(os.path.join(mirror_directory, path))
+            record = known.get(path)
+            if record is not None and record[:2] == (stat.st_size, stat.st_mtime_ns):
+                unchanged.append(path)
+                continue
+            content_hash = hash_file(os.path.join(mirror_directory, path))
+            if record is None:
+                new[path] = (stat.st_size, stat.st_mtime_ns, content_hash)
+            elif record[2] == content_hash:
+                # touched but identical, only remember the new mtime
+                self.connection.execute(
+                    "UPDATE files SET size = ?, mtime_ns = ? WHERE path = ?", (stat.st_size, stat.st_mtime_ns, path)
+                )
+                unchanged.append(path)
+            else:
+                changed[path] = (stat.st_size, stat.st_mtime_ns, content_hash)
+        if deleted is None:
+            listed = set(paths)
+            deleted = [path for path in known if path not in listed]
+        else:
+            touched = set(paths) | set(deleted)
+            deleted = [path for path in deleted if path in known]
+            unchanged += [path for path in known if path not in touched]
+        self.connection.commit()
+        return new, changed, deleted, unchanged
+
+    def mark_stale(self, paths: list[str], run: int):
+        """Marks the documents produced by `paths` as stale and forgets where they were written"""
+        known = self.files()
+        self.connection.executemany(
+            "INSERT OR IGNORE INTO stale (part, doc_idx, run) VALUES (?, ?, ?)",
+            [(known[path][3], known[path][4], run) for path in paths if known[path][3] is not None],
+        )
+        self.connection.executemany("UPDATE files SET part = NULL, doc_idx = NULL WHERE path = ?", [(p,) for p in paths])
+        self.connection.commit()
+
+    def register_parts(self, staging_folder: str, processed: dict, deleted: list[str], run: int):
+        """
+        Moves the files written by stage 0 of this run to new parts and records the part and document
+        index of every processed path (NULL if the document was filtered out).
+        """
+        os.makedirs(PARTS_FOLDER, exist_ok=True)
+        locations = {}
+        next_part = self.num_parts()
+        staged = sorted(os.listdir(staging_folder)) if os.path.isdir(staging_folder) else []
+        # documents are numbered like stage 4 numbers them, by reading the part with the same reader
+        reader = get_intermediate_reader(PARTS_FOLDER)
+        for file in staged:
+            part_file = f"{next_part:05d}{INTERMEDIATE_EXTENSIONS[INTERMEDIATE_FORMAT]}"
+            shutil.move(os.path.join(staging_folder, file), os.path.join(PARTS_FOLDER, part_file))
+            num_docs = 0
+            for doc_idx, document in enumerate(reader.read_file(part_file)):
+                locations[document.metadata["file_path"]] = (next_part, doc_idx)
+                num_docs += 1
+            self.connection.execute(
+                "INSERT INTO parts (part, run, num_docs, signed) VALUES (?, ?, ?, 0)", (next_part, run, num_docs)
+            )
+            next_part += 1
+        self.connection.executemany(
+            "INSERT OR REPLACE INTO files (path, size, mtime_ns, content_hash, part, doc_idx, run) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?)",
+            [(path, *record, *locations.get(path, (None, None)), run) for path, record in processed.items()],
+        )
+        self.connection.executemany("DELETE FROM files WHERE path = ?", [(path,) for path in deleted])
+        self.connection.commit()
+        shutil.rmtree(staging_folder, ignore_errors=True)
+
+    def mark_signed(self):
+        self.connection.execute("UPDATE parts SET signed = 1")
+        self.connection.commit()
+
+    def finish_run(self, run: int, new: int, changed: int, deleted: int, reprocessed: int):
+        self.connection.execute(
+            "INSERT INTO runs (run, new, changed, deleted, reprocessed) VALUES (?, ?, ?, ?, ?)",
+            (run, new, changed, deleted, reprocessed),
+        )
+        self.connection.commit()
+
+
+def drop_stale_signatures(stale: dict):
+    """Removes the signatures of stale documents from the cached signature files of their part"""
+    dtype = np.dtype(
+        [(f"field{i + 1}", f"<{minhash_config.hash_config.struct_format}") for i in range(minhash_config.hashes_per_bucket)]
+        + [("doc_idx", "<I")]
+    )
+    for part, doc_indices in stale.items():
+        for bucket in range(minhash_config.num_buckets):
+            path = os.path.join("signatures", f"bucket_{bucket:03d}", f"{part:05d}.minhash.sig")
+            if not os.path.exists(path):
+                continue
+            records = np.fromfile(path, dtype=dtype)
+            # filtering keeps the records sorted
+            records[~np.isin(records["doc_idx"], doc_indices)].tofile(path)
+
+
+def add_stale_to_remove_ids(stale: dict):
+    """Merges the stale documents of each part into the `.remove` file read by MinhashDedupFilter"""
+    os.makedirs("remove_ids", exist_ok=True)
+    for part, doc_indices in stale.items():
+        path = os.path.join("remove_ids", f"{part:06d}.remove")
+        to_remove = np.fromfile(path, dtype="<u4") if os.path.exists(path) else np.zeros(0, dtype="<u4")
+        np.union1d(to_remove, np.array(doc_indices, dtype="<u4")).astype("<u4").tofile(path)
+
+
+def read_changes_report(changes_report: str) -> tuple[list[str], list[str]]:
+    """
+    Files of a `clone_hf_repos.py --mode refresh` report, relative to the mirror directory.
+
+    Returns:
+        tuple: the added and modified files the dataset reader keeps, and the deleted files
+            (the repositories whose refresh failed list none).
+    """
+    with open(changes_report) as f:
+        report = json.load(f)
+    touched, deleted = [], []
+    for name, repo_report in report.items():
+        touched += [f"{name}/{path}" for path in repo_report["added"] + repo_report["modified"]]
+        deleted += [f"{name}/{path}" for path in repo_report["deleted"]]
+    touched = [
+        path for path in touched if not is_excluded(path) and os.path.isfile(os.path.join(MIRROR_DIRECTORY, path))
+    ]
+    return sorted(touched), sorted(deleted)
+
+
+def run_incremental_dataset_generation(manifest_folder: str = MANIFEST_FOLDER, changes_report: str | None = None):
+    check_mirror_directory()
+    manifest = Manifest(manifest_folder)
+    # an interrupted run is resumed with the same number, its completed stage 0 and 1 tasks are skipped
+    run = manifest.start_run()
+    logs = f"logs/incremental/run_{run:04d}"
+
+    if manifest.num_parts() == 0:
+        # outputs of a full (non incremental) run do not follow the part layout
+        for folder in (PARTS_FOLDER, "signatures"):
+            shutil.rmtree(folder, ignore_errors=True)
+    elif not os.path.exists(os.path.join(PARTS_FOLDER, f"00000{INTERMEDIATE_EXTENSIONS[INTERMEDIATE_FORMAT]}")):
+        raise ValueError(
+            f"The parts of {PARTS_FOLDER} were not written as {INTERMEDIATE_FORMAT}, "
+            f"remove {manifest_folder} to start over with INTERMEDIATE_FORMAT={INTERMEDIATE_FORMAT!r}"
+        )
+
+    if changes_report is not None and manifest.num_parts() > 0:
+        # only the files touched by the refresh are compared with the manifest
+        paths, deleted_paths = read_changes_report(changes_report)
+    else:
+        # the first run lists the whole mirror, the report only holds the changes of the last refresh
+        paths, deleted_paths = PersonalCopilotDatasetReader(data_folder=MIRROR_DIRECTORY).list_files(), None
+    new, changed, deleted, unchanged = manifest.scan(MIRROR_DIRECTORY, paths, deleted_paths)
+    known = manifest.files()
+
+    # unchanged files dropped as exact duplicates of a changed or deleted file lost their representative
+    old_hashes = {known[path][2] for path in list(changed) + deleted}
+    orphans = {
+        path: known[path][:3] for path in unchanged if known[path][3] is None and known[path][2] in old_hashes
+    }
+    processed = new | changed | orphans
+    print(
+        f"run {run}: {len(new)} new, {len(changed)} changed, {len(deleted)} deleted, "
+        f"{len(orphans)} re-processed, {len(unchanged) - len(orphans)} unchanged files"
+    )
+
+    manifest.mark_stale(list(changed) + deleted, run)
+    release_doc_ids(EXACT_DEDUP_INDEX, [f"{path}/0" for path in list(changed) + deleted + list(orphans)])
+
+    if processed:
+        paths_file = os.path.join(manifest_folder, f"run_{run:04d}.paths")
+        with open(paths_file, "w") as f:
+            f.writelines(f"{path}\n" for path in sorted(processed))
+        staging_folder = os.path.join(STAGING_FOLDER, f"run_{run:04d}")
+        LocalPipelineExecutor(
+            pipeline=get_read_filter_pipeline(paths_file=paths_file, output_folder=staging_folder),
+            tasks=min(get_total_tasks(sum(record[0] for record in processed.values())), len(processed)),
+            logging_dir=f"{logs}/stage_0",
+        ).run()
+        manifest.register_parts(staging_folder, processed, deleted, run)
+    else:
+        manifest.register_parts("", {}, deleted, run)
+
+    num_parts = manifest.num_parts()
+    if num_parts == 0:
+        print("No documents to process.")
+        return
+
+    # only the new parts (and parts of an interrupted run) are signed
+    first_unsigned = manifest.first_unsigned_part()
+    if first_unsigned is not None:
+        LocalPipelineExecutor(
+            pipeline=get_signature_pipeline(PARTS_FOLDER),
+            tasks=num_parts,
+            workers=min(get_available_cores(), num_parts - first_unsigned),
+            local_tasks=num_parts - first_unsigned,
+            local_rank_offset=first_unsigned,
+            logging_dir=f"{logs}/stage_1",
+        ).run()
+        manifest.mark_signed()
+    drop_stale_signatures(manifest.stale_docs(run))
+
+    # buckets, clusters and the final output are rebuilt from all parts
+    for folder in ("buckets", "remove_ids", "hf_stack", "removed"):
+        shutil.rmtree(folder, ignore_errors=True)
+    if os.path.exists("hf_stack_index.sqlite"):
+        os.remove("hf_stack_index.sqlite")
+    LocalPipelineExecutor(
+        pipeline=get_buckets_pipeline(),
+        tasks=minhash_config.num_buckets,
+        logging_dir=f"{logs}/stage_2",
+        skip_completed=False,
+    ).run()
+    LocalPipelineExecutor(
+        pipeline=get_cluster_pipeline(), tasks=1, logging_dir=f"{logs}/stage_3", skip_completed=False
+    ).run()
+    add_stale_to_remove_ids(manifest.stale_docs())
+    print(
+        LocalPipelineExecutor(
+            pipeline=get_dedup_filter_pipeline(PARTS_FOLDER),
+            tasks=num_parts,
+            workers=min(get_available_cores(), num_parts),
+            logging_dir=f"{logs}/stage_4",
+            skip_completed=False,
+        ).run()
+    )
+    manifest.finish_run(run, len(new), len(changed), len(deleted), len(orphans))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--manifest_folder", default=MANIFEST_FOLDER, help="folder of the manifest of the runs")
+    parser.add_argument(
+        "--changes_report",
+        default=None,
+        help="mirror_changes.json of `clone_hf_repos.py --mode refresh`: only its files are compared with the "
+        "manifest instead of the whole mirror",
+    )
+    args = parser.parse_args()
+    run_incremental_dataset_generation(args.manifest_folder, args.changes_report)
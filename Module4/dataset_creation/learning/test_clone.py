@@ -0,0 +1,124 @@
+# File to test the sparse mirroring offline, against a local bare repository
+import os
+import subprocess
+import sys
+import tempfile
+# Add the parent directory (dataset_creation) to sys.path
+parent_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(parent_dir)
+from clone_hf_repos import refresh_repositories, sparse_mirror_repositories, write_changed_paths
+
+# Files of the test repository, the ones the dataset reader skips must not be checked out
+KEPT = ["main.py", "src/model.py", "README.md"]
+BLOCKED = ["logo.png", "data/train.csv", "src/__pycache__/model.cpython-311.pyc"]
+
+
+def git(*args, cwd):
+    subprocess.run(["git", *args], cwd=cwd, check=True, capture_output=True)
+
+
+def create_bare_repository(folder):
+    """Creates `folder/origin.git` with two commits of KEPT and BLOCKED files, and returns its file:// url"""
+    work = os.path.join(folder, "work")
+    os.makedirs(work)
+    git("init", "-q", cwd=work)
+    for commit in range(2):
+        for path in KEPT + BLOCKED:
+            os.makedirs(os.path.join(work, os.path.dirname(path)), exist_ok=True)
+            with open(os.path.join(work, path), "w") as f:
+                f.write(f"{path} {commit}\n")
+        git("add", "-A", cwd=work)
+        git("-c", "user.name=test", "-c", "user.email=test@test", "commit", "-q", "-m", f"commit {commit}", cwd=work)
+    bare = os.path.join(folder, "origin.git")
+    git("clone", "-q", "--bare", work, bare, cwd=folder)
+    # partial clones need the server to accept filters
+    git("config", "uploadpack.allowFilter", "true", cwd=bare)
+    return f"file://{bare}"
+
+
+def push_changes(folder):
+    """Pushes a commit that modifies, adds and deletes kept and blocked files to `folder/origin.git`"""
+    work = os.path.join(folder, "work")
+    for path in ["main.py", "logo.png"]:
+        with open(os.path.join(work, path), "a") as f:
+            f.write("changed\n")
+    for path in ["src/new.py", "data/new.csv"]:
+        with open(os.path.join(work, path), "w") as f:
+            f.write("new\n")
+    git("rm", "-q", "README.md", cwd=work)
+    git("add", "-A", cwd=work)
+    git("-c", "user.name=test", "-c", "user.email=test@test", "commit", "-q", "-m", "changes", cwd=work)
+    git("push", "-q", os.path.join(folder, "origin.git"), "HEAD", cwd=work)
+
+
+# TESTING FUNCTION
+def test_sparse_mirror():
+    with tempfile.TemporaryDirectory() as folder:
+        url = create_bare_repository(folder)
+        mirror = os.path.join(folder, "mirror")
+        report = sparse_mirror_repositories(
+            {"repo": url, "missing": f"file://{folder}/missing.git"}, mirror_directory=mirror, workers=2, retries=1
+        )
+
+        assert report["repo"]["error"] is None
+        assert report["repo"]["files"] == len(KEPT)
+        assert report["repo"]["bytes"] > 0
+        for path in KEPT:
+            with open(os.path.join(mirror, "repo", path)) as f:
+                assert f.read() == f"{path} 1\n"
+        for path in BLOCKED:
+            assert not os.path.exists(os.path.join(mirror, "repo", path))
+        # the blobs of the blocked files were never downloaded
+        objects = subprocess.run(
+            ["git", "rev-list", "--objects", "--missing=print", "HEAD"],
+            cwd=os.path.join(mirror, "repo"),
+            capture_output=True,
+            text=True,
+        )
+        assert sum(line.startswith("?") for line in objects.stdout.splitlines()) == len(BLOCKED)
+        # depth 1: only the latest commit was fetched
+        log = subprocess.run(["git", "log", "--oneline"], cwd=os.path.join(mirror, "repo"), capture_output=True)
+        assert len(log.stdout.splitlines()) == 1
+
+        # a repository that cannot be cloned is retried, then reported
+        assert report["missing"]["attempts"] == 2
+        assert report["missing"]["error"]
+        assert report["missing"]["bytes"] == 0
+
+
+def test_refresh():
+    with tempfile.TemporaryDirectory() as folder:
+        url = create_bare_repository(folder)
+        mirror = os.path.join(folder, "mirror")
+        sparse_mirror_repositories({"repo": url}, mirror_directory=mirror, retries=0)
+        push_changes(folder)
+        report = refresh_repositories({"repo": url, "other": url}, mirror_directory=mirror, retries=0)
+
+        assert report["repo"]["error"] is None
+        assert report["repo"]["old"] != report["repo"]["new"]
+        assert report["repo"]["added"] == ["data/new.csv", "src/new.py"]
+        assert report["repo"]["modified"] == ["logo.png", "main.py"]
+        assert report["repo"]["deleted"] == ["README.md"]
+        with open(os.path.join(mirror, "repo", "main.py")) as f:
+            assert f.read() == "main.py 1\nchanged\n"
+        assert not os.path.exists(os.path.join(mirror, "repo", "README.md"))
+        # the sparse checkout is kept
+        assert not os.path.exists(os.path.join(mirror, "repo", "data", "new.csv"))
+        # a repository that was not mirrored yet is cloned, all its files are added
+        assert report["other"]["old"] is None
+        assert "src/new.py" in report["other"]["added"]
+
+        paths_file = os.path.join(folder, "changed_paths.txt")
+        paths = write_changed_paths(report, paths_file)
+        assert "repo/main.py" in paths and "repo/src/new.py" in paths and "other/main.py" in paths
+        assert not any(path.endswith((".png", ".csv")) for path in paths)
+
+        # nothing changed since the refresh
+        report = refresh_repositories({"repo": url}, mirror_directory=mirror, retries=0)
+        assert report["repo"]["old"] == report["repo"]["new"]
+        assert report["repo"]["added"] == report["repo"]["modified"] == report["repo"]["deleted"] == []
+
+
+if __name__ == "__main__":
+    test_sparse_mirror()
+    test_refresh()
@@ -0,0 +1,45 @@
+# File to test the rules of the code quality filter on small documents
+import os
+import sys
+# Add the parent directory (dataset_creation) to sys.path
+parent_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(parent_dir)
+from datatrove.data import Document
+from filter import CodeQualityFilter, get_encoded_data_stats, get_license_fraction, get_text_stats
+
+
+def make_doc(text, file_path="repo/main.py"):
+    return Document(text=text, id=f"{file_path}/0", metadata={"file_path": file_path})
+
+
+# TESTING FUNCTION
+def test_license_files():
+    # license files by name, with or without a text extension
+    for path in ["repo/LICENSE", "repo/LICENSE.md", "repo/COPYING.txt", "repo/docs/notice.rst"]:
+        assert get_license_fraction("Some license text\n", path) == 1.0
+    # code files whose name starts like a license file are not
+    for path in ["repo/license_utils.py", "repo/src/notices.py", "repo/license.py"]:
+        assert get_license_fraction("import os\n", path) == 0.0
+
+
+def test_encoded_data():
+    array = "data = {" + ", ".join(f"0x{i:02X}" for i in range(64)) + "}\n"
+    fraction, longest = get_encoded_data_stats(array, get_text_stats(array))
+    assert longest >= 64 * 4
+    assert fraction > 0.9
+    assert get_encoded_data_stats("", get_text_stats("")) == (0.0, 0)
+    doc = make_doc(array, "repo/firmware.c")
+    assert CodeQualityFilter(max_encoded_data_length=128).filter(doc) == (False, "encoded_data")
+
+
+def test_unreadable_placeholder():
+    # the placeholder of unreadable files is dropped whether or not the "unreadable" rule is counted
+    assert CodeQualityFilter().filter(make_doc("remove")) == (False, "unreadable")
+    assert CodeQualityFilter(rules=("alphanum",)).filter(make_doc("remove")) is False
+    assert CodeQualityFilter(rules=("alphanum",)).filter(make_doc("def f():\n    return 1\n")) is True
+
+
+if __name__ == "__main__":
+    test_license_files()
+    test_encoded_data()
+    test_unreadable_placeholder()
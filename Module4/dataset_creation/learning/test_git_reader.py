@@ -0,0 +1,92 @@
+# File to test that reading the git objects gives the same documents as reading the checkout
+import json
+import os
+import subprocess
+import sys
+import tempfile
+# Add the parent directory (dataset_creation) to sys.path
+parent_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(parent_dir)
+from git_reader import GitBlobReader, git_blob_sha
+from reader import PersonalCopilotDatasetReader
+
+FILES = {
+    "main.py": "import os\r\nprint(os.getcwd())\r\n",
+    "main_lf.py": "import os\nprint(os.getcwd())\n",
+    "src/model.py": "class Model:\n    pass\n",
+    "src/copy.py": "class Model:\n    pass\n",
+    "notebook.ipynb": json.dumps(
+        {
+            "metadata": {"kernelspec": {"language": "python"}},
+            "cells": [{"cell_type": "code", "source": ["x = 1"], "outputs": []}],
+        }
+    ),
+    "binary.bin": "\x00\x01\x02",
+    "logo.png": "not an image",
+    "src/__pycache__/model.cpython-311.pyc": "bytecode",
+}
+
+
+def create_mirror(folder):
+    """Two repositories of FILES in `folder/mirror`, committed and checked out"""
+    mirror = os.path.join(folder, "mirror")
+    for name in ["repo_a", "repo_b"]:
+        work = os.path.join(mirror, name)
+        for path, content in FILES.items():
+            os.makedirs(os.path.join(work, os.path.dirname(path)), exist_ok=True)
+            with open(os.path.join(work, path), "w", newline="") as f:
+                f.write(content)
+        subprocess.run(["git", "init", "-q"], cwd=work, check=True)
+        subprocess.run(["git", "add", "-A"], cwd=work, check=True)
+        subprocess.run(
+            ["git", "-c", "user.name=test", "-c", "user.email=test@test", "commit", "-q", "-m", "files"],
+            cwd=work,
+            check=True,
+        )
+    return mirror
+
+
+# TESTING FUNCTION
+def test_git_reader():
+    with tempfile.TemporaryDirectory() as folder:
+        mirror = create_mirror(folder)
+        expected = {doc.id: doc for doc in PersonalCopilotDatasetReader(mirror).run()}
+        reader = GitBlobReader(mirror)
+        # blocked files are skipped from the tree listing alone
+        kept = ["binary.bin", "main.py", "main_lf.py", "notebook.ipynb", "src/copy.py", "src/model.py"]
+        assert reader.list_files() == sorted(f"{name}/{path}" for name in ["repo_a", "repo_b"] for path in kept)
+        docs = {doc.id: doc for doc in reader.run()}
+
+        assert docs.keys() == expected.keys()
+        for doc_id, doc in docs.items():
+            assert doc.text == expected[doc_id].text
+            assert doc.metadata["file_path"] == expected[doc_id].metadata["file_path"]
+            assert doc.metadata["repo_id"] == expected[doc_id].metadata["repo_id"]
+        # identical files have the same blob sha, in the same or another repository
+        assert docs["repo_a/src/model.py/0"].metadata["blob_sha"] == docs["repo_a/src/copy.py/0"].metadata["blob_sha"]
+        assert docs["repo_a/src/model.py/0"].metadata["blob_sha"] == docs["repo_b/src/model.py/0"].metadata["blob_sha"]
+        # the text of a file with CRLF line ends is not its blob: it has the SHA of its text, the blob of its LF copy
+        assert docs["repo_a/main.py/0"].metadata["blob_sha"] == docs["repo_a/main_lf.py/0"].metadata["blob_sha"]
+        assert docs["repo_a/main_lf.py/0"].metadata["blob_sha"] == reader.blobs["repo_a/main_lf.py"][0]
+        notebook_sha = docs["repo_a/notebook.ipynb/0"].metadata["blob_sha"]
+        assert notebook_sha != reader.blobs["repo_a/notebook.ipynb"][0]
+        assert notebook_sha == git_blob_sha(docs["repo_a/notebook.ipynb/0"].text.encode("utf-8"))
+
+        # without a memory budget, the batches are only bounded by their number of objects
+        assert [doc.id for doc in GitBlobReader(mirror, prefetch_max_bytes=None).run()] == list(docs)
+
+        # a shard of a paths file, split by size from the tree metadata
+        paths_file = os.path.join(folder, "paths.txt")
+        with open(paths_file, "w") as f:
+            f.write("repo_b/main.py\nrepo_b/src/model.py\nrepo_a/logo.png\n")
+        reader = GitBlobReader(mirror, paths_file=paths_file, balance_by_size=True)
+        texts = {doc.metadata["file_path"]: doc.text for rank in range(2) for doc in reader.run(rank=rank, world_size=2)}
+        assert texts == {
+            "repo_b/main.py": FILES["main.py"].replace("\r\n", "\n"),
+            "repo_b/src/model.py": FILES["src/model.py"],
+            "repo_a/logo.png": "remove",
+        }
+
+
+if __name__ == "__main__":
+    test_git_reader()
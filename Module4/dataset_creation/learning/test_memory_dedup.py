@@ -0,0 +1,115 @@
+# File to test that the in-memory dedup removes the same documents as stages 1 to 4 on disk
+import gzip
+import json
+import os
+import random
+import sys
+import tempfile
+# Add the parent directory (dataset_creation) to sys.path
+parent_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(parent_dir)
+from datatrove.executor.local import LocalPipelineExecutor
+from datatrove.pipeline.dedup import MinhashDedupSignature
+from datatrove.pipeline.dedup.minhash import (
+    MinhashConfig,
+    MinhashDedupBuckets,
+    MinhashDedupCluster,
+    MinhashDedupFilter,
+)
+from datatrove.pipeline.writers.jsonl import JsonlWriter
+from datatrove.utils.hashing import HashConfig
+from memory_dedup import InMemoryMinhashDedup
+from reader import RankAlignedJsonlReader
+
+# letters only: digits are removed by the text normalization of the shingles
+WORDS = sorted({"".join(random.Random(i).choices("abcdefghijklmnopqrstuvwxyz", k=6)) for i in range(500)})
+NUM_SHARDS = 3
+NUM_ORIGINALS = 20
+
+
+def create_corpus(folder, seed=0):
+    """Shards of random documents, with near-duplicates (a few words changed) planted in the same and other shards"""
+    rng = random.Random(seed)
+    originals = [[rng.choice(WORDS) for _ in range(200)] for _ in range(NUM_ORIGINALS)]
+    shards = [[] for _ in range(NUM_SHARDS)]
+    for i, words in enumerate(originals):
+        shards[i % NUM_SHARDS].append(words)
+        # 0 to 3 copies with 2% of their words changed, some of them in a chain (copy of a copy)
+        for _ in range(i % 4):
+            copy = list(rng.choice([words] + shards[i % NUM_SHARDS][-1:]))
+            for position in rng.sample(range(len(copy)), 4):
+                copy[position] = rng.choice(WORDS)
+            shards[rng.randrange(NUM_SHARDS)].append(copy)
+    os.makedirs(folder)
+    for rank, documents in enumerate(shards):
+        with gzip.open(os.path.join(folder, f"{rank:05d}.jsonl.gz"), "wt") as f:
+            for doc_idx, words in enumerate(documents):
+                f.write(json.dumps({"text": " ".join(words), "id": f"{rank}/{doc_idx}"}) + "\n")
+
+
+def read_ids(folder):
+    ids = set()
+    for file in os.listdir(folder):
+        with gzip.open(os.path.join(folder, file), "rt") as f:
+            ids.update(json.loads(line)["id"] for line in f)
+    return ids
+
+
+def run_disk_dedup(input_folder, folder, config):
+    """Stages 1 to 4 of pipeline.py, returns the kept and removed ids"""
+    steps = [
+        (
+            [RankAlignedJsonlReader(input_folder), MinhashDedupSignature(f"{folder}/signatures", config=config)],
+            NUM_SHARDS,
+        ),
+        ([MinhashDedupBuckets(f"{folder}/signatures", f"{folder}/buckets", config=config)], config.num_buckets),
+        ([MinhashDedupCluster(f"{folder}/buckets", f"{folder}/remove_ids", config=config)], 1),
+        (
+            [
+                RankAlignedJsonlReader(input_folder),
+                MinhashDedupFilter(f"{folder}/remove_ids", exclusion_writer=JsonlWriter(f"{folder}/removed")),
+                JsonlWriter(f"{folder}/kept"),
+            ],
+            NUM_SHARDS,
+        ),
+    ]
+    for stage, (pipeline, tasks) in enumerate(steps):
+        LocalPipelineExecutor(pipeline=pipeline, tasks=tasks, workers=1, logging_dir=f"{folder}/logs/{stage}").run()
+    return read_ids(f"{folder}/kept"), read_ids(f"{folder}/removed")
+
+
+def run_memory_dedup(input_folder, folder, config):
+    """The in-memory dedup of pipeline.py, returns the kept and removed ids"""
+    LocalPipelineExecutor(
+        pipeline=[
+            InMemoryMinhashDedup(
+                RankAlignedJsonlReader(input_folder),
+                output_folder=JsonlWriter(f"{folder}/kept"),
+                exclusion_writer=JsonlWriter(f"{folder}/removed"),
+                config=config,
+            )
+        ],
+        tasks=1,
+        logging_dir=f"{folder}/logs",
+    ).run()
+    return read_ids(f"{folder}/kept"), read_ids(f"{folder}/removed")
+
+
+# TESTING FUNCTION
+def test_same_clusters_as_disk():
+    # same configuration as pipeline.py
+    config = MinhashConfig(hash_config=HashConfig(precision=64))
+    with tempfile.TemporaryDirectory() as folder:
+        create_corpus(os.path.join(folder, "input"))
+        disk_kept, disk_removed = run_disk_dedup(os.path.join(folder, "input"), os.path.join(folder, "disk"), config)
+        memory_kept, memory_removed = run_memory_dedup(
+            os.path.join(folder, "input"), os.path.join(folder, "memory"), config
+        )
+        # one document of each planted cluster is kept, and the same documents are removed (and kept) by both paths
+        assert len(disk_kept) == NUM_ORIGINALS and len(disk_removed) > 0
+        assert memory_removed == disk_removed
+        assert memory_kept == disk_kept
+
+
+if __name__ == "__main__":
+    test_same_clusters_as_disk()
@@ -1,12 +1,13 @@
 
 # File to test the reader with our dummy files
+import json
 import sys
 import os
 # Add the parent directory (dataset_creation) to sys.path
 parent_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 sys.path.append(parent_dir)
 # Now import from reader module
-from reader import PersonalCopilotDatasetReader
+from reader import PersonalCopilotDatasetReader, notebook_to_text, read_ahead, segment
 
 """
 1. The PersonalCopilotDatasetReader constructor requires a DataFolderLike object as its first parameter (not a simple string path)
@@ -35,6 +36,30 @@ def test_reader():
         print(f"Content: {content}...")  # Print first 100 chars
         print("-" * 50)
 
+def test_notebook_to_text():
+
+    # The single pass converter must produce exactly the same text as segment()
+    with open(os.path.join(os.path.dirname(__file__), "dummy_docs", "notebook.ipynb")) as f:
+        notebook = f.read()
+    assert notebook_to_text(notebook) == segment(notebook)
+
+    # Outputs longer than the limit are cut the same way
+    long_output = json.dumps({
+        "metadata": {"kernelspec": {"language": "python"}},
+        "cells": [{"cell_type": "code", "source": ["x"], "outputs": [{"text": ["a" * 600] * 5}]}],
+    })
+    assert notebook_to_text(long_output) == segment(long_output)
+    assert notebook_to_text(long_output).endswith("a[...]")
+
+def test_read_ahead():
+    paths = [f"file_{i}" for i in range(10)]
+    # without a memory budget only the depth bounds the reads, with one the results are the same
+    for max_bytes in [None, 3, 0]:
+        results = list(read_ahead(str.upper, paths, depth=4, max_bytes=max_bytes, size_fn=len))
+        assert results == [(path, path.upper()) for path in paths]
+
 if __name__ == "__main__":
     test_reader()
+    test_notebook_to_text()
+    test_read_ahead()
     
\ No newline at end of file
@@ -0,0 +1,263 @@
+# coding=utf-8
+# Copyright 2024 Sourab Mangrulkar. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+In-memory MinHash deduplication, replacing stages 1 to 4 of the pipeline when the signatures fit in RAM.
+
+Instead of writing signatures, duplicate pairs and remove ids to disk between four executors, a single task:
+1. computes the signatures of batches of documents with NumPy (all permutations of all shingles of the batch
+   at once, then a segmented minimum per document),
+2. finds the duplicate pairs of each bucket (LSH band) by sorting its signatures,
+3. clusters the pairs with a union-find,
+4. reads the input again and writes the documents to keep (and optionally the removed ones), optionally
+   passing every document through a `before_dedup` step and the kept ones through an `after_dedup` step
+   (the token accounting of stage 4).
+
+Shard `{rank:05d}` of the input plays the role of task `rank` of the disk pipeline, and pairs are
+generated and merged in the same order as `MinhashDedupBuckets` and `MinhashDedupCluster` do, so for the same
+`MinhashConfig` the same documents are removed (and kept) as with the disk pipeline.
+"""
+
+import contextlib
+
+import numpy as np
+from datatrove.pipeline.base import PipelineStep
+from datatrove.pipeline.dedup.minhash import MinhashConfig, MinhashDedupSignature
+from datatrove.pipeline.readers.base import BaseDiskReader
+from datatrove.pipeline.writers.disk_base import DiskWriter
+from datatrove.utils.logging import logger
+from datatrove.utils.typeshelper import StatHints
+
+MERSENNE_PRIME = np.uint64((1 << 61) - 1)
+MERSENNE_SHIFT = np.uint64(61)
+
+
+def run_step_with_keys(step: PipelineStep | None, items):
+    """
+    Runs `step` on the documents of (key, document) pairs, in a single task.
+
+    Yields:
+        tuple: the (key, document) pairs of the documents forwarded by the step, in order.
+    """
+    if step is None:
+        yield from items
+        return
+    keys = {}
+
+    def documents():
+        for key, document in items:
+            keys[id(document)] = key
+            yield document
+
+    for document in step.run(documents()):
+        yield keys.pop(id(document)), document
+
+
+def get_signatures(shingles: list[np.ndarray], a: np.ndarray, b: np.ndarray, config: MinhashConfig) -> np.ndarray:
+    """
+    MinHash signatures of a batch of documents, same values as `MinhashDedupSignature.get_signature`.
+
+    Args:
+        shingles: (N, 1) uint64 shingles of each document, none of them empty
+        a, b: (1, num_hashes) permutation parameters
+        config: minhash configuration
+
+    Returns:
+        np.ndarray: (num documents, num_hashes) signatures
+    """
+    offsets = np.cumsum([0] + [len(doc_shingles) for doc_shingles in shingles[:-1]])
+    phv = np.concatenate(shingles) * a
+    phv += b
+    # x % (2**61 - 1) without a division: add the bits above 61 to the low 61 bits, then subtract p at most once
+    high = phv >> MERSENNE_SHIFT
+    phv &= MERSENNE_PRIME
+    phv += high
+    phv[phv >= MERSENNE_PRIME] -= MERSENNE_PRIME
+    if config.hash_config.precision == 32:
+        phv = np.bitwise_and(phv, config.hash_config.max)
+    return np.minimum.reduceat(phv, offsets, axis=0).astype(config.hash_config.np_dtype)
+
+
+def get_bucket_pairs(signatures: np.ndarray, bucket: int, config: MinhashConfig) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Duplicate pairs of one bucket: documents are sorted by (bucket signature, document) like the merged
+    signature files of `MinhashDedupBuckets`, and each document is paired with the previous one if they match.
+    Documents must be numbered in (rank, index in shard) order.
+    """
+    band = signatures[:, bucket * config.hashes_per_bucket : (bucket + 1) * config.hashes_per_bucket]
+    # np.lexsort sorts by the last key first
+    order = np.lexsort((np.arange(len(band)),) + tuple(band[:, i] for i in reversed(range(band.shape[1]))))
+    band = band[order]
+    matches = np.all(band[1:] == band[:-1], axis=1)
+    return order[:-1][matches], order[1:][matches]
+
+
+def get_duplicates(pairs: list[tuple[np.ndarray, np.ndarray]], num_docs: int) -> np.ndarray:
+    """
+    Union-find over the pairs, in order, with union by size like `MinhashDedupCluster`
+    (on ties the root of the first document of the pair stays the root).
+
+    Returns:
+        np.ndarray: boolean mask of the documents to remove (every member of a cluster but its root)
+    """
+    parent = list(range(num_docs))
+    size = [1] * num_docs
+
+    def find(x):
+        root = x
+        while parent[root] != root:
+            root = parent[root]
+        while parent[x] != root:
+            parent[x], x = root, parent[x]
+        return root
+
+    for first, second in pairs:
+        for a, b in zip(first.tolist(), second.tolist()):
+            root_a, root_b = find(a), find(b)
+            if root_a != root_b:
+                if size[root_a] < size[root_b]:
+                    root_a, root_b = root_b, root_a
+                parent[root_b] = root_a
+                size[root_a] += size[root_b]
+    return np.array([find(x) != x for x in range(num_docs)], dtype=bool)
+
+
+class InMemoryMinhashDedup(PipelineStep):
+    """
+    MinHash deduplication of a folder of shards in a single task, without intermediate files.
+
+    Args:
+        reader: reader of the folder with the `{rank:05d}` shards written by stage 0, used to write the output
+        output_folder: writer for the documents to keep, each shard is written with its own rank
+        exclusion_writer: optionally pass in a writer that will save the removed documents
+        config: minhash configuration (a MinhashConfig object)
+        max_batch_shingles: number of shingles whose permutations are computed at once,
+            memory use is about `max_batch_shingles * num_hashes * 8` bytes
+        text_reader: optionally a reader of the same folder that only reads the text, used for the signatures
+        before_dedup: optionally a step run on every document of the input before the duplicates are removed
+            (e.g. `TokenAccounting`)
+        after_dedup: optionally a step run on the documents to keep before they are written
+    """
+
+    type = "🫂 - DEDUP"
+    name = "🎯 MinHash in memory"
+
+    def __init__(
+        self,
+        reader: BaseDiskReader,
+        output_folder: DiskWriter,
+        exclusion_writer: DiskWriter = None,
+        config: MinhashConfig = None,
+        max_batch_shingles: int = 4096,
+        text_reader: BaseDiskReader = None,
+        before_dedup: PipelineStep = None,
+        after_dedup: PipelineStep = None,
+    ):
+        super().__init__()
+        self.reader = reader
+        self.text_reader = text_reader or reader
+        self.output_folder = output_folder
+        self.exclusion_writer = exclusion_writer
+        self.config = config or MinhashConfig()
+        self.max_batch_shingles = max_batch_shingles
+        self.before_dedup = before_dedup
+        self.after_dedup = after_dedup
+        # shingles are computed exactly like the disk pipeline
+        self.signer = MinhashDedupSignature(output_folder=reader.data_folder, config=self.config)
+
+    @staticmethod
+    def read_shards(reader: BaseDiskReader):
+        """Yields (rank, documents of the shard) for every shard of the folder of `reader`, in rank order"""
+        for filepath in reader.data_folder.list_files():
+            yield int(filepath.split("/")[-1].split(".")[0]), reader.read_file(filepath)
+
+    def compute_signatures(self) -> tuple[list[tuple[int, int]], np.ndarray]:
+        """
+        Returns:
+            tuple: the (rank, index in shard) of every document with at least one shingle, in that order,
+            and their signatures
+        """
+        a, b = self.signer.parameters
+        docs, signatures, batch, batch_size = [], [], [], 0
+
+        def flush():
+            nonlocal batch_size
+            if batch:
+                signatures.append(get_signatures(batch, a, b, self.config))
+                batch.clear()
+                batch_size = 0
+
+        for rank, documents in self.read_shards(self.text_reader):
+            for doc_idx, doc in enumerate(documents):
+                self.stat_update(StatHints.total)
+                with self.track_time():
+                    shingles = self.signer.get_shingles(doc.text)
+                    if shingles.size == 0:
+                        continue
+                    docs.append((rank, doc_idx))
+                    if len(shingles) > self.max_batch_shingles:
+                        # a single large document: running minimum over chunks of its shingles
+                        flush()
+                        chunks = range(0, len(shingles), self.max_batch_shingles)
+                        chunk_signatures = [
+                            get_signatures([shingles[i : i + self.max_batch_shingles]], a, b, self.config)
+                            for i in chunks
+                        ]
+                        signatures.append(np.min(chunk_signatures, axis=0))
+                        continue
+                    if batch_size + len(shingles) > self.max_batch_shingles:
+                        flush()
+                    batch.append(shingles)
+                    batch_size += len(shingles)
+        flush()
+        num_hashes = self.config.num_buckets * self.config.hashes_per_bucket
+        if not signatures:
+            return docs, np.zeros((0, num_hashes), dtype=self.config.hash_config.np_dtype)
+        return docs, np.concatenate(signatures)
+
+    def run(self, data=None, rank: int = 0, world_size: int = 1):
+        assert data is None, "In-memory dedup reads its input folder itself"
+        assert world_size == 1, "In-memory dedup runs as a single task"
+        docs, signatures = self.compute_signatures()
+        logger.info(f"Computed {len(docs)} signatures")
+        with self.track_time():
+            pairs = [get_bucket_pairs(signatures, bucket, self.config) for bucket in range(self.config.num_buckets)]
+            self.stat_update("total_matches", value=sum(len(first) for first, _ in pairs))
+            to_remove = get_duplicates(pairs, len(docs))
+        removed = {docs[i] for i in np.flatnonzero(to_remove).tolist()}
+        self.stat_update("to_remove", value=len(removed))
+        logger.info(f"Removing {len(removed)} duplicates")
+
+        with self.output_folder as writer:
+            with self.exclusion_writer if self.exclusion_writer else contextlib.nullcontext() as exc_writer:
+
+                def kept(documents):
+                    for (shard_rank, doc_idx), doc in documents:
+                        if (shard_rank, doc_idx) in removed:
+                            self.stat_update(StatHints.dropped)
+                            if self.exclusion_writer:
+                                exc_writer.write(doc, shard_rank)
+                        else:
+                            self.stat_update(StatHints.forwarded)
+                            yield (shard_rank, doc_idx), doc
+
+                documents = (
+                    ((shard_rank, doc_idx), doc)
+                    for shard_rank, shard in self.read_shards(self.reader)
+                    for doc_idx, doc in enumerate(shard)
+                )
+                documents = kept(run_step_with_keys(self.before_dedup, documents))
+                for (shard_rank, _), doc in run_step_with_keys(self.after_dedup, documents):
+                    writer.write(doc, shard_rank)
@@ -0,0 +1,141 @@
+# coding=utf-8
+# Copyright 2024 Sourab Mangrulkar. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Throughput and resource metrics of the pipeline stages and of each of their steps.
+
+- `measure_task` runs a task and records its wall time, CPU time and peak RSS,
+- `get_step_metrics` turns the datatrove stats of a step (time spent in the step, documents in and out,
+  characters and bytes) into documents, characters and bytes per second,
+- the scheduler puts both in its json report, one file per run.
+
+Comparing two reports shows the throughput change of every step:
+    python metrics.py logs/code_dataset/reports/old.json logs/code_dataset/reports/new.json
+"""
+
+import argparse
+import json
+import resource
+import time
+
+from datatrove.utils.stats import PipelineStats, Stats
+
+
+def reset_peak_rss():
+    """Resets the peak RSS of this process (Linux only), so that it can be measured per task in a reused worker"""
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+    except OSError:
+        pass
+
+
+def get_peak_rss_mb() -> float:
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    # peak of the whole process lifetime, in KB on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def get_cpu_time() -> float:
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
+
+
+def measure_task(fn, *args):
+    """
+    Runs `fn(*args)` and measures it.
+
+    Returns:
+        tuple: the result of `fn` and a dict with the start and end time, CPU time and peak RSS of the task
+    """
+    reset_peak_rss()
+    cpu_start = get_cpu_time()
+    start = time.time()
+    result = fn(*args)
+    end = time.time()
+    return result, {
+        "start": start,
+        "end": end,
+        "cpu_time": get_cpu_time() - cpu_start,
+        "peak_rss_mb": get_peak_rss_mb(),
+    }
+
+
+def get_step_metrics(stats: Stats) -> dict:
+    """
+    Metrics of a pipeline step from its (merged) datatrove stats. Rates are per second of time spent in
+    the step itself, summed over tasks, so steps of the same stage can be compared to find the bottleneck.
+    """
+    values = {name: metric.total for name, metric in stats.stats.items()}
+    step_time = stats.time_stats.total
+    # readers count "documents", filters, writers and dedup steps count "total"
+    docs_in = values.get("total", values.get("documents", 0))
+    docs_out = values.get("forwarded", docs_in)
+    metrics = {
+        "name": stats.name,
+        "time": step_time,
+        "docs_in": docs_in,
+        "docs_out": docs_out,
+        "dropped": values.get("dropped", 0),
+        "chars": values.get("doc_len", 0),
+        "bytes": values.get("input_bytes", 0),
+        "stats": values,
+    }
+    metrics["docs_per_s"] = docs_in / step_time if step_time > 0 else 0.0
+    metrics["chars_per_s"] = metrics["chars"] / step_time if step_time > 0 else 0.0
+    metrics["bytes_per_s"] = metrics["bytes"] / step_time if step_time > 0 else 0.0
+    return metrics
+
+
+def get_stage_metrics(stats: PipelineStats, task_metrics: list[dict]) -> dict:
+    """Metrics of a stage: its tasks' wall, CPU and peak memory, and the metrics of each of its steps"""
+    steps = [get_step_metrics(step_stats) for step_stats in stats.stats]
+    wall_time = max(t["end"] for t in task_metrics) - min(t["start"] for t in task_metrics)
+    return {
+        "wall_time": wall_time,
+        "cpu_time": sum(t["cpu_time"] for t in task_metrics),
+        "peak_rss_mb": max(t["peak_rss_mb"] for t in task_metrics),
+        "docs_in": steps[0]["docs_in"] if steps else 0,
+        "docs_out": steps[-1]["docs_out"] if steps else 0,
+        "docs_per_s": steps[0]["docs_in"] / wall_time if steps and wall_time > 0 else 0.0,
+        "steps": steps,
+    }
+
+
+def compare_reports(old: dict, new: dict):
+    """Prints the documents per second of each step of both runs"""
+    print(f"{'stage':<16} {'step':<44} {'old docs/s':>11} {'new docs/s':>11} {'change':>8}")
+    for stage, new_stage in new["stages"].items():
+        old_steps = {step["name"]: step for step in old["stages"].get(stage, {}).get("steps", [])}
+        for step in new_stage.get("steps", []):
+            old_rate = old_steps.get(step["name"], {}).get("docs_per_s", 0.0)
+            change = f"{step['docs_per_s'] / old_rate - 1:+.0%}" if old_rate else "n/a"
+            print(f"{stage:<16} {step['name'][:44]:<44} {old_rate:>11.1f} {step['docs_per_s']:>11.1f} {change:>8}")
+    print(f"wall time: {old['wall_time']:.1f}s -> {new['wall_time']:.1f}s")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("old", help="json report of the reference run")
+    parser.add_argument("new", help="json report of the run to compare")
+    args = parser.parse_args()
+    with open(args.old) as old_file, open(args.new) as new_file:
+        compare_reports(json.load(old_file), json.load(new_file))
@@ -17,18 +17,34 @@
 This script orchestrates a multi-stage data processing pipeline for creating a deduplicated code dataset
 from open-source repositories (e.g., Hugging Face public repos). The pipeline performs the following steps:
 
-1. Reads and filters raw code data from cloned repositories using custom readers and filters.
-2. Computes MinHash signatures for deduplication, partitioning data into tasks for parallel processing.
+1. Reads and filters raw code data from cloned repositories using custom readers and filters,
+   optionally dropping copies of local eval sets (`EVAL_SETS_FOLDER`), and dropping byte-identical
+   copies with an exact (content hash) deduplication.
+2. Computes MinHash signatures for deduplication, partitioning data into tasks for parallel processing
+   (with `FUSED_SIGNATURES`, in the same pass as step 1 instead of reading the filtered data back).
 3. Groups MinHash signatures into buckets to efficiently find potential duplicate candidates.
 4. Clusters duplicate samples based on MinHash similarity, identifying groups of near-duplicate code.
 5. Removes all but one sample per duplicate cluster, producing a deduplicated dataset and reporting token counts.
+6. Optionally (`BOILERPLATE_DEDUP`), counts the lines repeated across files and strips the spans of frequent
+   lines (license headers, copyright banners), reporting the tokens saved per repo.
+
+The stages are run as a DAG by `scheduler.py`: the signatures of a shard are computed as soon as that shard is
+filtered, a crashed run can be resumed from its completed tasks (`RESUME_RUN`) and the critical path of the run
+is reported. A new run first removes the outputs of the previous one.
 
 The pipeline uses the datatrove library for efficient, parallelized data processing and deduplication.
 DataTrove is a library to process, filter and deduplicate text data at a very large scale.
 
+Each stage is built by a `get_*_pipeline` function so that `incremental.py` can re-run them on the
+new and changed files only.
+
 """
 
-from datatrove.executor.base import PipelineExecutor
+import json
+import math
+import os
+import shutil
+
 from datatrove.executor.local import LocalPipelineExecutor
 from datatrove.pipeline.dedup import MinhashDedupSignature
 from datatrove.pipeline.dedup.minhash import (
@@ -38,51 +54,205 @@ from datatrove.pipeline.dedup.minhash import (
     MinhashDedupFilter,
 )
 from datatrove.utils.hashing import HashConfig
-from datatrove.pipeline.tokens import TokensCounter
-from datatrove.pipeline.readers import JsonlReader
+from datatrove.utils.logging import get_timestamp
 from datatrove.pipeline.writers.jsonl import JsonlWriter
-from reader import PersonalCopilotDatasetReader # Local import
-from filter import BasicCodeFilter
+from datatrove.pipeline.writers.parquet import ParquetWriter
+from git_reader import GitBlobReader
+from reader import PersonalCopilotDatasetReader, RankAlignedJsonlReader, RankAlignedParquetReader # Local import
+from filter import CodeQualityFilter
+from exact_dedup import ExactDedupFilter, clear_index
+from memory_dedup import InMemoryMinhashDedup
+from fused_signature import StreamingMinhashDedupSignature
+from boilerplate import BoilerplateLineCounter, BoilerplateStripper, merge_reports
+from token_accounting import HUGCODER_TOKENIZER, TokenAccounting
+from decontamination import BloomDecontaminationFilter, get_eval_files
+from stack_index import IndexedJsonlWriter
+from scheduler import Stage, run_stages
 
 MIRROR_DIRECTORY = "hf_public_repos"
-TOTAL_TASKS = 16
+TOTAL_TASKS = None  # None: one task per core, fewer when there is little data (see get_total_tasks)
+MIN_BYTES_PER_TASK = 16 * 2**20
+# deduplicate in a single in-memory task instead of stages 1 to 4 (same clusters), when the signatures fit in RAM
+IN_MEMORY_DEDUP = False
+# compute the minhash signatures in stage 0 while the filtered data is written, instead of reading it back in stage 1
+FUSED_SIGNATURES = False
+# strip license headers and other lines repeated across many files from the deduplicated data (stages 5 and 6)
+BOILERPLATE_DEDUP = False
+# local folder of eval sets (jsonl/json records or text files): documents sharing their 13-grams are dropped in stage 0
+EVAL_SETS_FOLDER = None
+# read the HEAD commit of each mirror from its git object store instead of its working tree, the blob SHAs
+# of the texts are then the exact dedup keys (see git_reader.py)
+GIT_OBJECT_READER = False
+LOGGING_DIR = "logs/code_dataset"
+# every run logs to a new `LOGGING_DIR/<timestamp>` folder, set the timestamp of a crashed run to resume it:
+# its completed tasks are skipped, so only resume when the mirror and the options did not change since
+RESUME_RUN = None
+# content hashes claimed by the documents of stage 0, shared by its tasks (and kept by incremental.py)
+EXACT_DEDUP_INDEX = "exact_dedup/index.sqlite"
+# outputs of the stages, removed when a new run starts: the number of tasks follows the data and the cores,
+# so the shards of an earlier run with more tasks would survive next to the new ones (and its signatures
+# would be clustered with them). The part layout of incremental.py (`manifest`) is rebuilt from scratch too
+RUN_OUTPUT_FOLDERS = (
+    "filtered_data",
+    "signatures",
+    "buckets",
+    "remove_ids",
+    "removed",
+    "contaminated",
+    "token_reports",
+    "deduped_data",
+    "boilerplate",
+    "hf_stack",
+    "manifest",
+)
+# task count of a run, saved in its logging folder so that a resumed run keeps the same shards
+RUN_INFO_FILE = "run.json"
+# format of the filtered_data shards read by stages 1 and 4: "parquet" (columnar, zstd) lets stage 1 decode
+# the text column only, "jsonl" writes gzipped jsonl (benchmarks/bench_intermediate.py compares both)
+INTERMEDIATE_FORMAT = "parquet"
+INTERMEDIATE_EXTENSIONS = {"parquet": ".parquet", "jsonl": ".jsonl.gz"}
 
 # you can also change ngrams or the number of buckets and their size here
+# (benchmarks/bench_minhash.py measures the cost and the precision/recall of each setting)
 minhash_config = MinhashConfig(
     # use_64bit_hashes=True
     hash_config=HashConfig(precision=64)
 )  # better precision -> fewer false positives (collisions)
 
-# The directory should already exist with cloned repositories
-import os
-if not os.path.exists(MIRROR_DIRECTORY):
-    raise ValueError(f"Directory {MIRROR_DIRECTORY} does not exist. Please run clone_hf_repos.py first.")
 
+def check_mirror_directory():
+    # The directory should already exist with cloned repositories
+    if not os.path.exists(MIRROR_DIRECTORY):
+        raise ValueError(f"Directory {MIRROR_DIRECTORY} does not exist. Please run clone_hf_repos.py first.")
 
-def run_code_dataset_generation():
-    # stage 0 reads the code data and does basic filtering
-    pipeline_0 = [
+
+def get_available_cores():
+    # cores this process may run on (cgroup/taskset limits), not all the cores of the machine
+    return len(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else os.cpu_count() or 1
+
+
+def get_total_tasks(total_bytes):
+    """Number of tasks of the per shard stages: TOTAL_TASKS if set, else the cores the data volume can keep busy"""
+    if TOTAL_TASKS is not None:
+        return TOTAL_TASKS
+    return max(1, min(get_available_cores(), math.ceil(total_bytes / MIN_BYTES_PER_TASK)))
+
+
+def clear_run_outputs():
+    """Removes the outputs of an earlier run: the stage folders, the document indexes and the exact dedup index"""
+    for folder in RUN_OUTPUT_FOLDERS:
+        shutil.rmtree(folder, ignore_errors=True)
+        if os.path.exists(f"{folder}_index.sqlite"):
+            os.remove(f"{folder}_index.sqlite")
+    clear_index(EXACT_DEDUP_INDEX)
+
+
+def get_run_total_tasks(logs):
+    """
+    Number of tasks of the per shard stages of the run logging to `logs`: sized from the mirror for a new run
+    and saved there, read back when the run is resumed (the sizing may differ by then)
+    """
+    info_path = os.path.join(logs, RUN_INFO_FILE)
+    if RESUME_RUN is not None:
+        if not os.path.exists(info_path):
+            raise ValueError(f"Cannot resume run {RESUME_RUN}: {info_path} does not exist.")
+        with open(info_path) as f:
+            return json.load(f)["total_tasks"]
+    total_tasks = get_total_tasks(get_mirror_size())
+    os.makedirs(logs, exist_ok=True)
+    with open(info_path, "w") as f:
+        json.dump({"total_tasks": total_tasks}, f)
+    return total_tasks
+
+
+def get_mirror_size():
+    """Total size in bytes of the files the reader would read from the mirror"""
+    reader = get_code_reader()
+    return sum(reader.get_file_sizes(reader.list_files()))
+
+
+def get_code_reader(paths_file=None, **kwargs):
+    """Reader of the mirrored files, from the working trees or with GIT_OBJECT_READER from the git objects"""
+    if GIT_OBJECT_READER:
+        return GitBlobReader(data_folder=MIRROR_DIRECTORY, paths_file=paths_file, **kwargs)
+    return PersonalCopilotDatasetReader(data_folder=MIRROR_DIRECTORY, paths_file=paths_file, **kwargs)
+
+
+def get_intermediate_writer(output_folder):
+    """Writer of the shards of stage 0, one `{rank:05d}` file per task"""
+    if INTERMEDIATE_FORMAT == "parquet":
+        return ParquetWriter(
+            output_folder=output_folder,
+            compression="zstd",
+            expand_metadata=True,  # one column per metadata field, so that it can be skipped when reading
+            max_file_size=-1,  # no file rotation: task r of the next stages reads the single file of task r
+            use_content_defined_chunking=False,  # only useful to deduplicate uploads to the Hub
+        )
+    return JsonlWriter(output_folder=output_folder)
+
+
+def get_intermediate_reader(input_folder, text_only=False):
+    """Rank aligned reader of the shards of stage 0, `text_only` skips the metadata columns of parquet shards"""
+    if INTERMEDIATE_FORMAT == "parquet":
+        return RankAlignedParquetReader(input_folder, read_metadata=not text_only)
+    return RankAlignedJsonlReader(input_folder)
+
+
+def get_output_writer(output_folder):
+    """
+    Writer of the deduplicated shards: gzipped jsonl made of independent blocks, with an index of the documents
+    in `{output_folder}_index.sqlite` for random access (see `stack_index.StackIndex`)
+    """
+    return IndexedJsonlWriter(output_folder=output_folder, index_path=f"{output_folder}_index.sqlite")
+
+
+def get_read_filter_pipeline(paths_file=None, output_folder="filtered_data", signatures_folder=None):
+    """
+    Stage 0: reads the code data (optionally only the files in `paths_file`) and does basic filtering,
+    with `signatures_folder` it also writes the minhash signatures of stage 1
+    """
+    pipeline = [
         # PersonalCopilotDatasetReader(data_folder=MIRROR_DIRECTORY)
-        PersonalCopilotDatasetReader(
-            data_folder=MIRROR_DIRECTORY,
-            paths_file=None,
+        get_code_reader(
+            paths_file=paths_file,
             recursive=True,
+            prefetch=8,  # read the next files on a thread pool while the current one is parsed
+            max_file_size=10 * 2**20,  # skip files above 10MB without opening them
+            balance_by_size=True,  # tasks get the same number of bytes rather than of files
+        ),
+        CodeQualityFilter(),  # drop reasons are counted per rule in the stats
+        # byte-identical copies are dropped here, before the expensive minhash stages
+        ExactDedupFilter(
+            index_path=EXACT_DEDUP_INDEX, key_metadata="blob_sha" if GIT_OBJECT_READER else None
         ),
-        BasicCodeFilter(),
-        JsonlWriter(output_folder="filtered_data"), # intermediate folder
+        get_intermediate_writer(output_folder), # intermediate folder
     ]
+    if EVAL_SETS_FOLDER:
+        # before the exact dedup, so that a contaminated document does not claim its content hash
+        pipeline.insert(2, BloomDecontaminationFilter(
+            eval_files=get_eval_files(EVAL_SETS_FOLDER), exclusion_writer=JsonlWriter("contaminated")
+        ))
+    if signatures_folder:
+        # right before the writer, so that signature i of shard r is document i of the shard read by stage 4
+        pipeline.insert(-1, StreamingMinhashDedupSignature(output_folder=signatures_folder, config=minhash_config))
+    return pipeline
 
-    # stage 1 computes minhash signatures for each task (each task gets a set of files)
-    pipeline_1 = [
-        JsonlReader("filtered_data"),
+
+def get_signature_pipeline(input_folder="filtered_data"):
+    """Stage 1: computes minhash signatures for each task (each task gets a set of files)"""
+    return [
+        # task r signs the shard written by task r of stage 0, only the text and ids are needed
+        get_intermediate_reader(input_folder, text_only=True),
         MinhashDedupSignature(
             output_folder="signatures", # this output folder becomes input folder to the next stage
             config=minhash_config,
         ),
     ]
 
-    # stage 2 finds matches between signatures in each bucket
-    pipeline_2 = [
+
+def get_buckets_pipeline():
+    """Stage 2: finds matches between signatures in each bucket"""
+    return [
         MinhashDedupBuckets(
             input_folder="signatures",
             output_folder="buckets",
@@ -90,8 +260,10 @@ def run_code_dataset_generation():
         ),
     ]
 
-    # stage 3 creates clusters of duplicates using the results from all buckets
-    pipeline_3 = [
+
+def get_cluster_pipeline():
+    """Stage 3: creates clusters of duplicates using the results from all buckets"""
+    return [
         MinhashDedupCluster(
             input_folder="buckets",
             output_folder="remove_ids", # tells which ids to remove
@@ -99,43 +271,126 @@ def run_code_dataset_generation():
         ),
     ]
 
-    # Tasks define the number of CPUs
-    # stage 4 reads the original input data and removes all but 1 sample per duplicate cluster
-    # the data must match exactly stage 1, so number of tasks and the input source must be the same
-    pipeline_4 = [
-        JsonlReader("filtered_data"),
-        TokensCounter(),  # nice way to see how many tokens we had before and after deduplication
+
+def get_dedup_filter_pipeline(input_folder="filtered_data", output_folder="hf_stack"):
+    """Stage 4: reads the filtered data and removes all but 1 sample per duplicate cluster"""
+    return [
+        get_intermediate_reader(input_folder),  # same shards as stage 1, with their metadata
+        # tokens with the hugcoder tokenizer per repo, extension and kind, before and after deduplication
+        # (compare them with `python token_accounting.py token_reports/before_dedup token_reports/after_dedup`)
+        TokenAccounting(report_folder="token_reports/before_dedup"),
         MinhashDedupFilter(
             input_folder="remove_ids",
             exclusion_writer=JsonlWriter("removed"),
         ),
-        JsonlWriter(output_folder="hf_stack"), # FINAL CLEAN DATASET
+        TokenAccounting(report_folder="token_reports/after_dedup"),  # reuses the counts, no second encoding
+        get_output_writer(output_folder), # FINAL CLEAN DATASET
     ]
 
-    executor_0: PipelineExecutor = LocalPipelineExecutor(
-        pipeline=pipeline_0, tasks=TOTAL_TASKS
-    )
 
-    executor_1: PipelineExecutor = LocalPipelineExecutor(
-        pipeline=pipeline_1, tasks=TOTAL_TASKS
-    )
+def get_in_memory_dedup_pipeline(input_folder="filtered_data", output_folder="hf_stack"):
+    """Stages 1 to 4 in one task: signatures, buckets and clusters are kept in memory instead of on disk"""
+    return [
+        InMemoryMinhashDedup(
+            get_intermediate_reader(input_folder),
+            text_reader=get_intermediate_reader(input_folder, text_only=True),
+            output_folder=get_output_writer(output_folder),
+            exclusion_writer=JsonlWriter("removed"),
+            config=minhash_config,
+            # the token reports of stage 4, in the pass that writes the output
+            before_dedup=TokenAccounting(report_folder="token_reports/before_dedup"),
+            after_dedup=TokenAccounting(report_folder="token_reports/after_dedup"),
+        ),
+    ]
 
-    executor_2: PipelineExecutor = LocalPipelineExecutor(
-        pipeline=pipeline_2,
-        tasks=minhash_config.num_buckets,
-    )
 
-    executor_3: PipelineExecutor = LocalPipelineExecutor(pipeline=pipeline_3, tasks=1)
+def get_boilerplate_count_pipeline(input_folder="deduped_data"):
+    """Stage 5: counts the documents containing each line, for every shard of the deduplicated data"""
+    return [
+        RankAlignedJsonlReader(input_folder),
+        BoilerplateLineCounter(output_folder="boilerplate/counts"),
+    ]
+
+
+def get_boilerplate_strip_pipeline(input_folder="deduped_data", output_folder="hf_stack"):
+    """Stage 6: strips the spans of lines found in many documents (license headers, banners)"""
+    return [
+        RankAlignedJsonlReader(input_folder),  # same shards as stage 5
+        BoilerplateStripper(
+            counts_folder="boilerplate/counts",
+            report_folder="boilerplate/reports",
+            tokenizer_name_or_path=HUGCODER_TOKENIZER,  # same tokens as the token reports of stage 4
+        ),
+        get_output_writer(output_folder), # FINAL CLEAN DATASET
+    ]
+
 
-    executor_4: PipelineExecutor = LocalPipelineExecutor(
-        pipeline=pipeline_4, tasks=TOTAL_TASKS
-    )
+def run_code_dataset_generation():
+    check_mirror_directory()
+
+    # Tasks define the number of CPUs
+    # stage 4 reads the original input data and removes all but 1 sample per duplicate cluster
+    # the data must match exactly stage 1, so number of tasks and the input source must be the same
+    # each stage logs to a folder of the run, completed tasks are only skipped when the run is resumed
+    # a fused stage 0 logs to its own folder: tasks completed without signatures must not be skipped
+    logs = f"{LOGGING_DIR}/{RESUME_RUN or get_timestamp()}"
+    if RESUME_RUN is None:
+        # shards and hashes of an earlier run would be mixed with the new ones, a resumed run keeps its own
+        clear_run_outputs()
+    total_tasks = get_run_total_tasks(logs)
+    fused = FUSED_SIGNATURES and not IN_MEMORY_DEDUP
+    # with boilerplate removal, the deduplicated data is an intermediate folder and stage 6 writes hf_stack
+    dedup_output = "deduped_data" if BOILERPLATE_DEDUP else "hf_stack"
+    stages = [
+        Stage("read_filter", LocalPipelineExecutor(
+            pipeline=get_read_filter_pipeline(signatures_folder="signatures" if fused else None),
+            tasks=total_tasks,
+            logging_dir=f"{logs}/stage_0" + ("_fused" if fused else ""),
+        )),
+    ]
+    if IN_MEMORY_DEDUP:
+        stages.append(Stage("in_memory_dedup", LocalPipelineExecutor(
+            pipeline=get_in_memory_dedup_pipeline(output_folder=dedup_output),
+            tasks=1,
+            logging_dir=f"{logs}/in_memory_dedup",
+        ), depends="read_filter"))
+    else:
+        if not fused:
+            # the signatures of a shard are computed as soon as stage 0 wrote it
+            stages.append(Stage("signatures", LocalPipelineExecutor(
+                pipeline=get_signature_pipeline(), tasks=total_tasks, logging_dir=f"{logs}/stage_1"
+            ), depends="read_filter", per_shard=True))
+        stages += [
+            Stage("buckets", LocalPipelineExecutor(
+                pipeline=get_buckets_pipeline(), tasks=minhash_config.num_buckets, logging_dir=f"{logs}/stage_2"
+            ), depends="read_filter" if fused else "signatures"),
+            Stage("clusters", LocalPipelineExecutor(
+                pipeline=get_cluster_pipeline(), tasks=1, logging_dir=f"{logs}/stage_3"
+            ), depends="buckets"),
+            Stage("dedup_filter", LocalPipelineExecutor(
+                pipeline=get_dedup_filter_pipeline(output_folder=dedup_output),
+                tasks=total_tasks,
+                logging_dir=f"{logs}/stage_4",
+            ), depends="clusters"),
+        ]
+    if BOILERPLATE_DEDUP:
+        stages += [
+            # the in-memory dedup writes every shard in its single task, stage 4 writes shard r in task r
+            Stage("boilerplate_counts", LocalPipelineExecutor(
+                pipeline=get_boilerplate_count_pipeline(), tasks=total_tasks, logging_dir=f"{logs}/stage_5"
+            ), depends=stages[-1].name, per_shard=not IN_MEMORY_DEDUP),
+            Stage("boilerplate_strip", LocalPipelineExecutor(
+                pipeline=get_boilerplate_strip_pipeline(), tasks=total_tasks, logging_dir=f"{logs}/stage_6"
+            ), depends="boilerplate_counts"),
+        ]
 
-    print(executor_0.run())
-    print(executor_1.run())
-    print(executor_2.run())
-    print(executor_3.run())
-    print(executor_4.run())
+    # a single pool runs every task as soon as its inputs exist, instead of one executor.run() per stage
+    # one report per run, compare two of them with `python metrics.py old.json new.json`
+    report = run_stages(stages, workers=total_tasks, report_path=f"{LOGGING_DIR}/reports/{get_timestamp()}.json")
+    print(f"Done in {report['wall_time']:.1f}s, worker utilization {report['utilization']:.0%}")
+    if BOILERPLATE_DEDUP:
+        for repo, saved in list(merge_reports("boilerplate/reports").items())[:20]:
+            print(f"{repo}: {saved['tokens']} boilerplate tokens removed from {saved['documents']} files")
 
 
 if __name__ == "__main__":
@@ -13,36 +13,160 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-import os
-import pandas as pd
+"""
+Exports the `hf_stack` shards as a Hugging Face dataset, saved to disk and optionally pushed to the Hub.
+
+The shards are decoded by `num_proc` processes, each streaming its shards into Arrow files in batches
+of `writer_batch_size` rows (`Dataset.from_generator`). The dataset is memory mapped from these files,
+so the peak memory does not grow with the corpus. It is then saved with `save_to_disk` in shards of at
+most `max_shard_size`, and pushed from that copy with `--push_to_hub`:
+    python prepare_hf_dataset.py --output_dir hug_stack_dataset --push_to_hub
+"""
+
+import argparse
 import gzip
 import json
-from datasets import Dataset
+import os
+import shutil
+from multiprocessing import Pool
+
+import pyarrow as pa
+from datasets import Dataset, Features, load_from_disk
 
 DATAFOLDER = "hf_stack"
 HF_DATASET_NAME = "hug_stack"
+OUTPUT_DIR = "hug_stack_dataset"
+
+
+def get_shards(data_folder=DATAFOLDER):
+    return sorted(os.path.join(data_folder, file) for file in os.listdir(data_folder) if file.endswith(".jsonl.gz"))
+
 
+def get_field_types(shard):
+    """
+    Arrow types of the fields of the documents of a shard, from every line: top level fields by name and
+    metadata fields by ("metadata", name). A field that is always null has no type.
+    """
+    types, seen = {}, set()
 
-def load_gzip_jsonl(file_path):
-    data = []
-    with gzip.open(file_path, "rt", encoding="utf-8") as f:
+    def add(field, value):
+        types.setdefault(field, set())
+        # the arrow type is only inferred once per python type of the values of a field
+        if value is not None and (field, type(value)) not in seen:
+            seen.add((field, type(value)))
+            types[field].add(pa.array([value]).type)
+
+    with gzip.open(shard, "rt", encoding="utf-8") as f:
         for line in f:
-            data.append(json.loads(line))
-    return data
+            document = json.loads(line)
+            for key, value in document.items():
+                if key == "metadata":
+                    for metadata_key, metadata_value in (value or {}).items():
+                        add(("metadata", metadata_key), metadata_value)
+                else:
+                    add(key, value)
+    return types
+
 
+def get_features(shards, num_proc=1):
+    """
+    Features of the documents, from the fields of every document of every shard: the metadata fields vary
+    with the pipeline options and between documents, and every process has to write the same schema.
+    The types of a field are unified (int and float values give floats), always null fields are strings.
+    """
+    types = {}
+    with Pool(num_proc) as pool:
+        for shard_types in pool.imap(get_field_types, shards):
+            for field, field_types in shard_types.items():
+                types.setdefault(field, set()).update(field_types)
 
-def create_hf_dataset():
-    df = None
-    for file in os.listdir(DATAFOLDER):
-        data = load_gzip_jsonl(os.path.join(DATAFOLDER, file))
-        if df is None:
-            df = pd.DataFrame(data)
+    def unify(field, field_types):
+        if not field_types:
+            return pa.string()
+        schemas = [pa.schema([("value", field_type)]) for field_type in field_types]
+        try:
+            return pa.unify_schemas(schemas, promote_options="permissive").field("value").type
+        except (pa.ArrowInvalid, pa.ArrowTypeError) as e:
+            raise ValueError(f"Field {field} has incompatible types {sorted(map(str, field_types))}") from e
+
+    fields, metadata = [], []
+    for field, field_types in types.items():
+        if isinstance(field, tuple):
+            metadata.append(pa.field(field[1], unify(field, field_types)))
         else:
-            df = pd.concat([df, pd.DataFrame(data)])
+            fields.append(pa.field(field, unify(field, field_types)))
+    if metadata:
+        fields.append(pa.field("metadata", pa.struct(metadata)))
+    return Features.from_arrow_schema(pa.schema(fields))
+
+
+def generate_documents(shards, features):
+    """Documents of the shards, with the fields of `features` (missing fields are None)"""
+    fields = [key for key in features if key != "metadata"]
+    metadata_fields = list(features["metadata"]) if "metadata" in features else []
+    for shard in shards:
+        with gzip.open(shard, "rt", encoding="utf-8") as f:
+            for line in f:
+                document = json.loads(line)
+                metadata = document.pop("metadata", None) or {}
+                # the features come from a pass over the same shards, a new field means they changed since
+                if not document.keys() <= features.keys() or not metadata.keys() <= set(metadata_fields):
+                    unknown = sorted((document.keys() - features.keys()) | (metadata.keys() - set(metadata_fields)))
+                    raise ValueError(f"Fields {unknown} of a document of {shard} are not in the features")
+                row = {key: document.get(key) for key in fields}
+                if metadata_fields:
+                    row["metadata"] = {key: metadata.get(key) for key in metadata_fields}
+                yield row
+
+
+def create_hf_dataset(
+    data_folder=DATAFOLDER,
+    output_dir=OUTPUT_DIR,
+    num_proc=None,
+    max_shard_size="500MB",
+    writer_batch_size=1000,
+    push_to_hub=False,
+    dataset_name=HF_DATASET_NAME,
+):
+    shards = get_shards(data_folder)
+    if not shards:
+        raise ValueError(f"No shards in {data_folder}. Please run pipeline.py first.")
+    num_proc = min(num_proc or os.cpu_count() or 1, len(shards))
+    features = get_features(shards, num_proc)
+
+    # the Arrow files written by the processes, removed once the dataset is saved
+    cache_dir = f"{output_dir.rstrip('/')}_cache"
+    dataset = Dataset.from_generator(
+        generate_documents,
+        features=features,
+        gen_kwargs={"shards": shards, "features": features},  # lists in gen_kwargs are split between processes
+        num_proc=num_proc if num_proc > 1 else None,
+        cache_dir=cache_dir,
+        writer_batch_size=writer_batch_size,
+    )
+    dataset.save_to_disk(output_dir, max_shard_size=max_shard_size, num_proc=num_proc if num_proc > 1 else None)
+    print(f"Saved {len(dataset)} documents from {len(shards)} shards to {output_dir}")
+    del dataset
+    shutil.rmtree(cache_dir, ignore_errors=True)
 
-    dataset = Dataset.from_pandas(df)
-    dataset.push_to_hub(HF_DATASET_NAME, private=False)
+    if push_to_hub:
+        load_from_disk(output_dir).push_to_hub(dataset_name, private=False, max_shard_size=max_shard_size)
 
 
 if __name__ == "__main__":
-    create_hf_dataset()
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--data_folder", default=DATAFOLDER, help="folder of the jsonl.gz shards of pipeline.py")
+    parser.add_argument("--output_dir", default=OUTPUT_DIR, help="folder the dataset is saved to")
+    parser.add_argument("--num_proc", type=int, default=None, help="processes decoding the shards, one per core")
+    parser.add_argument("--max_shard_size", default="500MB", help="size of the saved and pushed Arrow shards")
+    parser.add_argument("--push_to_hub", action="store_true", help="push the saved dataset to the Hub")
+    parser.add_argument("--dataset_name", default=HF_DATASET_NAME, help="name of the dataset on the Hub")
+    args = parser.parse_args()
+    create_hf_dataset(
+        data_folder=args.data_folder,
+        output_dir=args.output_dir,
+        num_proc=args.num_proc,
+        max_shard_size=args.max_shard_size,
+        push_to_hub=args.push_to_hub,
+        dataset_name=args.dataset_name,
+    )
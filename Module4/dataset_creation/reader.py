@@ -17,16 +17,23 @@
 This module provides a custom dataset reader for processing code and notebook files,
 with filtering for unwanted file types and special handling for Jupyter notebooks.
 It includes utilities for segmenting notebook cells, cleaning markdown, and formatting
-the extracted content for downstream processing.
+the extracted content for downstream processing, and rank aligned jsonl and parquet readers
+for the intermediate stages of the pipeline.
 """
 
+import heapq
 import itertools
 import json
+import random
 import re
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from typing import Callable
 
+from datatrove.pipeline.readers import JsonlReader, ParquetReader
 from datatrove.pipeline.readers.base import BaseDiskReader
-from datatrove.io import DataFolderLike
+from datatrove.io import DataFolderLike, get_shard_from_paths_file
+from datatrove.utils.logging import logger
 
 # Block the following formats.
 IMAGE = ["png", "jpg", "jpeg", "gif"]
@@ -55,6 +62,111 @@ OTHERS = [
     "opus",
 ]
 ANTI_FOMATS = tuple(IMAGE + VIDEO + DOC + AUDIO + ARCHIVE + OTHERS)
+# Skip any path containing one of these names (directories are pruned while listing).
+EXCLUDED_DIRS = [".git", "__pycache__", "xcodeproj"]
+# Number of leading bytes inspected to detect binary files.
+SNIFF_BYTES = 8192
+BINARY_SIGNATURES = (
+    b"\x89PNG",  # png
+    b"GIF8",  # gif
+    b"\xff\xd8\xff",  # jpeg
+    b"%PDF",  # pdf
+    b"PK\x03\x04",  # zip, jar, docx, ...
+    b"\x1f\x8b",  # gzip
+    b"BZh",  # bzip2
+    b"\xfd7zXZ",  # xz
+    b"\x7fELF",  # executables
+    b"\x93NUMPY",  # npy
+    b"\x80\x04\x95",  # pickle
+)
+
+
+def is_excluded(path):
+    """
+    Checks whether a path has a blocked extension or lies in an excluded directory.
+
+    Args:
+        path (str): The path of the file, relative to the data folder.
+
+    Returns:
+        bool: True if the file should not be read.
+    """
+    return path.endswith(ANTI_FOMATS) or any(k in path for k in EXCLUDED_DIRS)
+
+
+def looks_binary(head):
+    """
+    Checks the first bytes of a file for a NUL byte or a known binary signature.
+
+    Args:
+        head (bytes): The first `SNIFF_BYTES` bytes of the file.
+
+    Returns:
+        bool: True if the file is binary.
+    """
+    return head.startswith(BINARY_SIGNATURES) or b"\x00" in head
+
+
+def read_ahead(read_fn, paths, depth, max_bytes=None, size_fn=None, max_workers=None):
+    """
+    Reads files on a bounded thread pool while the caller consumes earlier results.
+
+    At most `depth` reads are in flight or waiting to be consumed, and when `size_fn` is given
+    no new read is started once the pending files would exceed `max_bytes` (a single file larger
+    than the budget is still read on its own). Results are yielded in the order of `paths`.
+
+    Args:
+        read_fn (Callable): Function reading a single path and returning its content.
+        paths (list): The paths to read, in the order results should be yielded.
+        depth (int): Maximum number of files read ahead of the consumer.
+        max_bytes (int, optional): Memory budget for files read ahead of the consumer.
+        size_fn (Callable, optional): Function returning the size in bytes of a path.
+        max_workers (int, optional): Number of reader threads, defaults to `depth`.
+
+    Yields:
+        tuple: (path, content) pairs in the same order as `paths`.
+    """
+    pending = deque()
+    pending_bytes = 0
+    paths = iter(paths)
+    next_path = next(paths, None)
+    with ThreadPoolExecutor(max_workers=max_workers or depth) as pool:
+        try:
+            while pending or next_path is not None:
+                while next_path is not None and len(pending) < depth:
+                    size = size_fn(next_path) if size_fn and max_bytes is not None else 0
+                    if max_bytes is not None and pending and pending_bytes + size > max_bytes:
+                        break
+                    pending.append((next_path, size, pool.submit(read_fn, next_path)))
+                    pending_bytes += size
+                    next_path = next(paths, None)
+                path, size, future = pending.popleft()
+                pending_bytes -= size
+                yield path, future.result()
+        finally:
+            for _, _, future in pending:
+                future.cancel()
+
+
+def partition_by_size(sizes, num_shards):
+    """
+    Splits items into `num_shards` shards of similar total size (greedy longest processing time first:
+    the largest remaining item goes to the currently smallest shard).
+
+    Args:
+        sizes (list): Size in bytes of each item.
+        num_shards (int): Number of shards.
+
+    Returns:
+        list: For each shard, the sorted indices of its items.
+    """
+    shards = [[] for _ in range(num_shards)]
+    heap = [(0, shard) for shard in range(num_shards)]
+    for index in sorted(range(len(sizes)), key=lambda i: (-sizes[i], i)):
+        total, shard = heapq.heappop(heap)
+        shards[shard].append(index)
+        heapq.heappush(heap, (total + sizes[index], shard))
+    return [sorted(shard) for shard in shards]
 
 
 def segment_blocks(content):
@@ -146,7 +258,7 @@ def parse_data(cells, types):
         str: The formatted content string with markdown, code, and output.
     """
 
-    content = ""
+    content = []
     if len(types) > 0:
         if types[0] == "code":
             # add dummy markdown
@@ -163,7 +275,7 @@ def parse_data(cells, types):
                     cells[j + 1] for j in range(len(cells) - 1) if j % 2 == 0
                 ]
 
-                content += "<jupyter_start>"
+                content.append("<jupyter_start>")
                 for markdown_block, code_snippet in zip(
                     inner_markdowns, inner_code_snippets
                 ):
@@ -172,8 +284,8 @@ def parse_data(cells, types):
                     )
                     code = "\n".join([snippet[0] for snippet in code_snippet])
                     output = [snippet[1] for snippet in code_snippet][-1]
-                    content += build_content(markdown_block, code, output)
-    return content
+                    content.append(build_content(markdown_block, code, output))
+    return "".join(content)
 
 
 def build_content(markdown, code, output):
@@ -201,6 +313,123 @@ def build_content(markdown, code, output):
     return content
 
 
+NO_OUTPUT = "_____no_output_____"
+MAX_OUTPUT_CHARS = 1000
+
+
+def is_python_notebook(metadata):
+    """
+    Checks whether a notebook runs a Python kernel.
+
+    The kernel language is read from `kernelspec.language` or `language_info.name`. Only notebooks
+    declaring neither fall back to looking for "py" anywhere in the serialized metadata.
+
+    Args:
+        metadata (dict): The notebook level metadata.
+
+    Returns:
+        bool: True if the notebook should be converted.
+    """
+    if isinstance(metadata, dict):
+        for section, key in (("kernelspec", "language"), ("language_info", "name")):
+            language = metadata.get(section)
+            if isinstance(language, dict) and isinstance(language.get(key), str):
+                return "py" in language[key]
+    return "py" in json.dumps(metadata)
+
+
+def join_truncated(parts, limit=MAX_OUTPUT_CHARS):
+    """
+    Joins a cell output, stopping as soon as the result is longer than `limit`.
+
+    Args:
+        parts (str | list): The output text, either a string or a list of lines.
+        limit (int, optional): Length after which the remaining lines are not read.
+
+    Returns:
+        str: The joined output. It is only complete when its length is at most `limit`.
+    """
+    if isinstance(parts, str):
+        return parts
+    pieces, size = [], 0
+    for part in parts:
+        pieces.append(part)
+        size += len(part)
+        if size > limit:
+            break
+    return "".join(pieces)
+
+
+def notebook_to_text(sample, max_output_chars=MAX_OUTPUT_CHARS):
+    """
+    Converts a Jupyter notebook into the `<jupyter_start>` text format in a single pass over its cells.
+
+    Produces the same text as `segment` for the notebooks both convert, but groups cells while iterating,
+    only joins the output of the last cell of each code group and stops joining it at the truncation limit.
+    The notebooks converted differ: the kernel language is checked with `is_python_notebook` instead of
+    looking for "py" anywhere in the serialized metadata, so a notebook declaring another language whose
+    metadata still mentions "py" (e.g. an R kernel with a "pygments_lexer" or a `.py` path) is dropped
+    here but converted by `segment`.
+
+    Args:
+        sample (str): The JSON string of a Jupyter notebook.
+        max_output_chars (int, optional): Length after which cell outputs are truncated.
+
+    Returns:
+        str: The formatted content, or an empty string for non Python or malformed notebooks.
+    """
+    try:
+        notebook = json.loads(sample)
+        if not is_python_notebook(notebook["metadata"]):
+            return ""
+        # consecutive cells of the same type form a group of (source, cell) pairs
+        groups, group_types = [], []
+        for cell in notebook["cells"]:
+            if len(cell["source"]) > 0:
+                source = "".join(cell["source"])
+                cell_type = cell["cell_type"]
+                if not group_types or group_types[-1] != cell_type:
+                    groups.append([])
+                    group_types.append(cell_type)
+                groups[-1].append((source, cell))
+
+        if not groups:
+            return ""
+        if group_types[0] == "code":
+            # add dummy markdown
+            groups.insert(0, None)
+        if group_types[-1] == "markdown":
+            groups.pop()
+        if len(groups) % 2:
+            return ""
+
+        content = ["<jupyter_start>"]
+        for i in range(0, len(groups), 2):
+            markdown_group, code_group = groups[i], groups[i + 1]
+            if markdown_group is None:
+                markdown = "empty"
+            else:
+                markdown = " ".join(clean_markdown(source) for source, _ in markdown_group)
+            code = "\n".join(source for source, _ in code_group)
+
+            output = NO_OUTPUT
+            outputs = code_group[-1][1].get("outputs")
+            if outputs and "text" in outputs[0]:
+                output = join_truncated(outputs[0]["text"], max_output_chars)
+            if len(output) > max_output_chars:
+                output = output[:max_output_chars] + "[...]"
+            elif output == NO_OUTPUT:
+                output = "<empty_output>"
+
+            markdown = markdown.strip()
+            if markdown != "empty":
+                content.append(f"<jupyter_text>{markdown}")
+            content.append(f"<jupyter_code>{code.strip()}<jupyter_output>{output.strip()}")
+        return "".join(content)
+    except Exception:
+        return ""
+
+
 class PersonalCopilotDatasetReader(BaseDiskReader):
     """
     Custom dataset reader for the PersonalCopilot project.
@@ -226,6 +455,11 @@ class PersonalCopilotDatasetReader(BaseDiskReader):
         recursive: bool = True,
         glob_pattern: str | None = None,
         shuffle_files: bool = False,
+        prefetch: int = 0,
+        prefetch_max_bytes: int = 256 * 2**20,
+        prefetch_workers: int | None = None,
+        max_file_size: int | None = None,
+        balance_by_size: bool = False,
     ):
         """
         Initializes the PersonalCopilotDatasetReader.
@@ -244,6 +478,11 @@ class PersonalCopilotDatasetReader(BaseDiskReader):
             recursive (bool, optional): Whether to read files recursively.
             glob_pattern (str, optional): Glob pattern for file selection.
             shuffle_files (bool, optional): Whether to shuffle files before reading.
+            prefetch (int, optional): Number of files to read ahead on a thread pool, 0 disables read-ahead.
+            prefetch_max_bytes (int, optional): Memory budget for files read ahead of the parser, None for no budget.
+            prefetch_workers (int, optional): Number of reader threads, defaults to `prefetch`.
+            max_file_size (int, optional): Files larger than this many bytes are skipped without being opened.
+            balance_by_size (bool, optional): Split files between tasks by total bytes instead of by count.
         """
         super().__init__(
             data_folder,
@@ -261,6 +500,131 @@ class PersonalCopilotDatasetReader(BaseDiskReader):
             shuffle_files,
         )
         self.empty_warning = False
+        self.prefetch = prefetch
+        self.prefetch_max_bytes = prefetch_max_bytes
+        self.prefetch_workers = prefetch_workers
+        self.max_file_size = max_file_size
+        self.balance_by_size = balance_by_size
+        self._read_ahead = None
+
+    def _file_size(self, filepath: str) -> int:
+        try:
+            return self.data_folder.size(filepath)
+        except Exception:
+            return 0
+
+    def get_file_sizes(self, paths: list[str]) -> list[int]:
+        """Sizes in bytes of `paths` (0 for unreadable files), from a stat of each file."""
+        return [self._file_size(path) for path in paths]
+
+    def read_raw(self, filepath: str) -> str:
+        """
+        Reads the raw text of a file, skipping unwanted formats and excluded directories.
+
+        Args:
+            filepath (str): The path to the file to read.
+
+        Returns:
+            str: The file content, or an empty string if the file is skipped or unreadable.
+        """
+        if is_excluded(filepath):
+            return ""
+        if self.max_file_size is not None and self._file_size(filepath) > self.max_file_size:
+            return ""
+        try:
+            with self.data_folder.open(filepath, "rb") as file:
+                head = file.read(SNIFF_BYTES)
+                if looks_binary(head):
+                    return ""
+                data = head + file.read()
+            # same result as reading in text mode with universal newlines
+            return data.decode("utf-8").replace("\r\n", "\n").replace("\r", "\n")
+        except Exception:
+            return ""
+
+    def list_files(self) -> list[str]:
+        """
+        Lists the files of the data folder, pruning excluded directories during the walk
+        instead of listing everything below them.
+
+        Returns:
+            list: Sorted file paths relative to the data folder.
+        """
+        if self.glob_pattern:
+            files = self.data_folder.list_files(recursive=self.recursive, glob_pattern=self.glob_pattern)
+            return [path for path in files if not is_excluded(path)]
+        files = []
+        for root, dirs, filenames in self.data_folder.walk("", maxdepth=None if self.recursive else 1):
+            dirs[:] = [d for d in dirs if not any(k in d for k in EXCLUDED_DIRS)]
+            for name in filenames:
+                path = f"{root}/{name}" if root else name
+                if not is_excluded(path):
+                    files.append(path)
+        return sorted(files)
+
+    def run(self, data=None, rank: int = 0, world_size: int = 1):
+        """
+        Gets this rank's shard (by count or by bytes) of the pruned file listing and reads each file in it, yielding Documents.
+
+        Args:
+            data: Any existing data from previous pipeline stages.
+            rank (int, optional): Rank of the current task.
+            world_size (int, optional): Total number of tasks.
+
+        Yields:
+            Document: A datatrove Document object with text and metadata.
+        """
+        if data:
+            yield from data
+        if self.paths_file:
+            all_files = list(get_shard_from_paths_file(self.paths_file, 0, 1))
+        else:
+            all_files = self.list_files()
+            if not all_files:
+                raise RuntimeError(f"No files found on {self.data_folder.path}!")
+        if self.balance_by_size:
+            # every task computes the same partition, a few huge files no longer make one task much slower
+            sizes = self.get_file_sizes(all_files)
+            shard = partition_by_size(sizes, world_size)[rank]
+            files_shard = [all_files[i] for i in shard]
+            self.stat_update("shard_bytes", value=sum(sizes[i] for i in shard), unit="task")
+        else:
+            files_shard = all_files[rank::world_size]
+        if len(files_shard) == 0:
+            logger.warning(f"No files found on {self.data_folder.path} for {rank=}")
+        if self.shuffle_files:
+            random.shuffle(files_shard)
+        for doc in self.read_files_shard(files_shard):
+            self.update_doc_stats(doc)
+            yield doc
+
+    def read_files_shard(self, shard: list[str]):
+        """
+        Reads a list of files and yields Documents, reading up to `prefetch` files ahead
+        on a thread pool when read-ahead is enabled.
+
+        Args:
+            shard (list): A list of file paths.
+
+        Yields:
+            Document: A datatrove Document object with text and metadata.
+        """
+        if self.prefetch <= 0:
+            yield from super().read_files_shard(shard)
+            return
+        self._read_ahead = read_ahead(
+            self.read_raw,
+            shard,
+            depth=self.prefetch,
+            max_bytes=self.prefetch_max_bytes,
+            size_fn=self._file_size,
+            max_workers=self.prefetch_workers,
+        )
+        try:
+            yield from super().read_files_shard(shard)
+        finally:
+            self._read_ahead.close()
+            self._read_ahead = None
 
     def read_file(self, filepath: str):
         """
@@ -273,26 +637,86 @@ class PersonalCopilotDatasetReader(BaseDiskReader):
         Yields:
             Document: A datatrove Document object with text and metadata.
         """
-        try:
-            if filepath.endswith(ANTI_FOMATS) or any(
-                k in filepath for k in [".git", "__pycache__", "xcodeproj"]
-            ):
-                content = ""
+        # the step time covers reading and converting the file, not only building the document
+        with self.track_time():
+            if self._read_ahead is not None:
+                read_path, content = next(self._read_ahead)
+                assert read_path == filepath, f"read-ahead out of order: {read_path} != {filepath}"
             else:
-                with self.data_folder.open(filepath, "r", encoding="utf-8") as file:
-                    content = file.read()
-                    if filepath.endswith("ipynb"):
-                        content = segment(content)
-        except Exception:
-            content = ""
+                content = self.read_raw(filepath)
+            self.stat_update("input_bytes", value=len(content.encode("utf-8")), unit="input_file")
+            try:
+                if filepath.endswith("ipynb"):
+                    content = notebook_to_text(content)
+            except Exception:
+                content = ""
 
-        if not content:
-            content = "remove"
-        data = {"text": content}
-        with self.track_time():
+            if not content:
+                content = "remove"
+            data = {"text": content}
             document = self.get_document_from_dict(data, filepath, 0)
             document.metadata["file_path"] = document.metadata["file_path"].split(
                 self.data_folder.path
             )[-1][1:]
             document.metadata["repo_id"] = document.metadata["file_path"].split("/")[0]
         yield document
+
+
+class RankAlignedReaderMixin:
+    """
+    Reader where task `rank` reads the single file written by task `rank` of the previous stage.
+
+    The default readers shard the sorted file list with `files[rank::world_size]`, so a task that
+    wrote no file shifts the shards of every later rank and a task can only start once all files
+    exist. Reading `file_template.format(rank=rank)` keeps stage 1 (signatures) and stage 4 (dedup
+    filter) aligned with the shards of stage 0 and lets them start as soon as their own shard is written.
+    """
+
+    file_template: str
+
+    def run(self, data=None, rank: int = 0, world_size: int = 1):
+        if data:
+            yield from data
+        filepath = self.file_template.format(rank=rank)
+        if not self.data_folder.isfile(filepath):
+            # every document of this shard was filtered out
+            logger.warning(f"No file {filepath} on {self.data_folder.path} for {rank=}")
+            return
+        for doc in self.read_files_shard([filepath]):
+            self.update_doc_stats(doc)
+            yield doc
+
+
+class RankAlignedJsonlReader(RankAlignedReaderMixin, JsonlReader):
+    """
+    Rank aligned reader of the gzipped jsonl shards written by `JsonlWriter`.
+
+    Args:
+        data_folder (DataFolderLike): The folder written by the previous stage.
+        file_template (str): Name of the file read by a task, formatted with its rank.
+    """
+
+    name = "🐿 Jsonl (rank aligned)"
+
+    def __init__(self, data_folder: DataFolderLike, file_template: str = "{rank:05d}.jsonl.gz", **kwargs):
+        super().__init__(data_folder, **kwargs)
+        self.file_template = file_template
+
+
+class RankAlignedParquetReader(RankAlignedReaderMixin, ParquetReader):
+    """
+    Rank aligned reader of the parquet shards written by `ParquetWriter`.
+
+    Only the text and id columns are decoded with `read_metadata=False`, the other columns of the
+    file are not even decompressed.
+
+    Args:
+        data_folder (DataFolderLike): The folder written by the previous stage.
+        file_template (str): Name of the file read by a task, formatted with its rank.
+    """
+
+    name = "📒 Parquet (rank aligned)"
+
+    def __init__(self, data_folder: DataFolderLike, file_template: str = "{rank:05d}.parquet", **kwargs):
+        super().__init__(data_folder, **kwargs)
+        self.file_template = file_template
@@ -0,0 +1,254 @@
+# coding=utf-8
+# Copyright 2024 Sourab Mangrulkar. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+DAG runner for the stages of the dataset pipeline.
+
+Instead of calling `executor.run()` for one stage after the other, every (stage, rank) task is scheduled
+on a single pool of worker processes as soon as its inputs exist:
+- a stage with `per_shard=True` only waits for the task with the same rank of the stage it depends on
+  (e.g. the signatures of shard 3 are computed as soon as shard 3 is filtered),
+- other stages wait for every task of the stage they depend on (buckets need all signatures).
+
+Tasks run through the executors' own `_run_for_rank`, so logs, stats and completion markers are the
+usual datatrove ones: a crashed run resumed with the same logging folders skips the completed tasks of every
+stage, and the `stats.json` of a stage still covers all its tasks (the skipped ones from their saved stats).
+Once all tasks are done, a report with the timings of every task, the critical path and the throughput
+and resource use of every stage and step (see `metrics.py`) is saved.
+"""
+
+import json
+import os
+import queue
+import time
+from dataclasses import dataclass
+
+import multiprocess
+from datatrove.executor.local import LocalPipelineExecutor
+from datatrove.utils.logging import logger
+from datatrove.utils.stats import PipelineStats
+
+from metrics import get_stage_metrics, measure_task
+
+# tasks are run with a private method of datatrove's executors (pinned to 0.10.x in requirements.txt)
+if not hasattr(LocalPipelineExecutor, "_run_for_rank"):
+    raise ImportError(
+        "scheduler.py runs tasks with LocalPipelineExecutor._run_for_rank, which this datatrove version does not "
+        "have: install datatrove 0.10.x (see requirements.txt)"
+    )
+
+
+@dataclass
+class Stage:
+    """
+    A stage of the DAG.
+
+    Args:
+        name: name of the stage in the report
+        executor: executor holding the pipeline, number of tasks and logging folder of the stage
+        depends: name of the stage whose outputs this stage reads
+        per_shard: task `rank` only depends on task `rank` of `depends` instead of all of its tasks
+    """
+
+    name: str
+    executor: LocalPipelineExecutor
+    depends: str | None = None
+    per_shard: bool = False
+
+
+def run_task(executor: LocalPipelineExecutor, rank: int, slot: int):
+    return measure_task(executor._run_for_rank, rank, slot)
+
+
+def load_task_stats(executor: LocalPipelineExecutor, rank: int) -> PipelineStats:
+    """Stats saved by task `rank` of `executor` when it completed, in an earlier run"""
+    with executor.logging_dir.open(f"stats/{rank:05d}.json", "r") as f:
+        return PipelineStats.from_json(json.load(f))
+
+
+def get_critical_path(stages: list[Stage], timings: dict) -> list[dict]:
+    """
+    Walks back from the last task to finish, following the dependency that finished last.
+
+    Returns:
+        list: the tasks of the path in execution order, with their duration and the time they spent
+        waiting for a free worker after their inputs were ready
+    """
+    by_name = {stage.name: stage for stage in stages}
+    if not timings:
+        return []
+    task = max(timings, key=lambda t: timings[t]["end"])
+    path = []
+    while task is not None:
+        name, rank = task
+        stage = by_name[name]
+        dependencies = []
+        if stage.depends is not None:
+            ranks = [rank] if stage.per_shard else range(by_name[stage.depends].executor.world_size)
+            dependencies = [(stage.depends, r) for r in ranks if (stage.depends, r) in timings]
+        previous = max(dependencies, key=lambda t: timings[t]["end"], default=None)
+        ready = timings[previous]["end"] if previous is not None else timings[task]["start"]
+        path.append(
+            {
+                "stage": name,
+                "rank": rank,
+                "duration": timings[task]["end"] - timings[task]["start"],
+                "worker_wait": max(0.0, timings[task]["start"] - ready),
+            }
+        )
+        task = previous
+    return path[::-1]
+
+
+def run_stages(stages: list[Stage], workers: int = -1, start_method: str = "forkserver", report_path: str = None):
+    """
+    Runs every task of `stages` on a shared pool of `workers` processes, in dependency order.
+
+    Args:
+        stages: the stages, each one after the stage it depends on
+        workers: number of worker processes, -1 to use the largest number of tasks of a stage
+        start_method: multiprocessing start method of the pool
+        report_path: where to save the json report of the run (timings, critical path, stage and step metrics)
+
+    Returns:
+        dict: the report of the run
+    """
+    names = [stage.name for stage in stages]
+    for i, stage in enumerate(stages):
+        if stage.depends is not None and stage.depends not in names[:i]:
+            raise ValueError(f"Stage {stage.name} depends on {stage.depends}, which is not an earlier stage")
+        if stage.per_shard and stage.executor.world_size != stages[names.index(stage.depends)].executor.world_size:
+            raise ValueError(f"Stage {stage.name} runs per shard, it needs as many tasks as {stage.depends}")
+    by_name = {stage.name: stage for stage in stages}
+    if workers == -1:
+        workers = max(stage.executor.world_size for stage in stages)
+
+    pending = [(stage.name, rank) for stage in stages for rank in range(stage.executor.world_size)]
+    done = {task for task in pending if by_name[task[0]].executor.is_rank_completed(task[1])}
+    if done:
+        logger.info(f"Skipping {len(done)} already completed tasks")
+    skipped = sorted(done)
+    pending = [task for task in pending if task not in done]
+    remaining = {stage.name: sum(task[0] == stage.name for task in pending) for stage in stages}
+    stage_stats = {stage.name: PipelineStats() for stage in stages}
+    for stage in stages:
+        if remaining[stage.name]:
+            stage.executor.save_executor_as_json()
+
+    def is_ready(task):
+        stage = by_name[task[0]]
+        if stage.depends is None:
+            return True
+        if stage.per_shard:
+            return (stage.depends, task[1]) in done
+        return remaining[stage.depends] == 0
+
+    timings = {}
+    results = queue.Queue()
+    free_slots = list(range(workers))
+    running = {}
+    failure = None
+    run_start = time.time()
+    with multiprocess.get_context(start_method).Pool(workers) as pool:
+        while pending or running:
+            # earlier stages first: they gate the most downstream work
+            while failure is None and free_slots and (ready := next(filter(is_ready, pending), None)):
+                pending.remove(ready)
+                slot = free_slots.pop(0)
+                stage = by_name[ready[0]]
+                running[ready] = slot
+                pool.apply_async(
+                    run_task,
+                    (stage.executor, ready[1], slot),
+                    callback=lambda result, task=ready: results.put((task, result, None)),
+                    error_callback=lambda error, task=ready: results.put((task, None, error)),
+                )
+            if not running:
+                break
+            task, result, error = results.get()
+            free_slots.append(running.pop(task))
+            if error is not None:
+                logger.error(f"Task {task[1]} of stage {task[0]} failed: {error}")
+                failure = failure or error
+                continue
+            stats, task_metrics = result
+            timings[task] = {
+                **task_metrics,
+                "start": task_metrics["start"] - run_start,
+                "end": task_metrics["end"] - run_start,
+            }
+            done.add(task)
+            remaining[task[0]] -= 1
+            stage_stats[task[0]] += stats
+            if remaining[task[0]] == 0:
+                executor = by_name[task[0]].executor
+                # the tasks skipped on a resumed run are part of the stage stats, not of the run metrics
+                stats = sum(
+                    (load_task_stats(executor, rank) for name, rank in skipped if name == task[0]),
+                    start=stage_stats[task[0]],
+                )
+                with executor.logging_dir.open("stats.json", "wt") as statsfile:
+                    stats.save_to_disk(statsfile)
+                logger.success(stats.get_repr(f"All {executor.world_size} tasks of {task[0]}"))
+    if failure is not None:
+        raise failure
+
+    wall_time = time.time() - run_start
+    busy_time = sum(timing["end"] - timing["start"] for timing in timings.values())
+    report = {
+        "workers": workers,
+        "wall_time": wall_time,
+        "busy_time": busy_time,
+        "utilization": busy_time / (workers * wall_time) if wall_time > 0 else 0.0,
+        "skipped_tasks": len(done) - len(timings),
+        "stages": {},
+        "critical_path": get_critical_path(stages, timings),
+        "tasks": [{"stage": name, "rank": rank, **timing} for (name, rank), timing in sorted(timings.items())],
+    }
+    for stage in stages:
+        stage_timings = [timing for (name, _), timing in timings.items() if name == stage.name]
+        if stage_timings:
+            durations = sorted(timing["end"] - timing["start"] for timing in stage_timings)
+            report["stages"][stage.name] = get_stage_metrics(stage_stats[stage.name], stage_timings)
+            report["stages"][stage.name] |= {
+                "tasks": len(stage_timings),
+                "start": min(timing["start"] for timing in stage_timings),
+                "end": max(timing["end"] for timing in stage_timings),
+                "busy_time": sum(durations),
+                # runtime spread of the tasks, imbalance is the slowest task over the mean one
+                "min_task_time": durations[0],
+                "median_task_time": durations[len(durations) // 2],
+                "max_task_time": durations[-1],
+                "imbalance": durations[-1] * len(durations) / sum(durations) if sum(durations) > 0 else 1.0,
+            }
+            logger.info(
+                f"{stage.name}: {len(durations)} tasks, task time min {durations[0]:.1f}s / median "
+                f"{durations[len(durations) // 2]:.1f}s / max {durations[-1]:.1f}s "
+                f"(imbalance {report['stages'][stage.name]['imbalance']:.2f})"
+            )
+    steps = [(name, step) for name, stage in report["stages"].items() for step in stage["steps"]]
+    if steps:
+        name, step = max(steps, key=lambda item: item[1]["time"])
+        report["bottleneck"] = {"stage": name, "step": step["name"], "time": step["time"]}
+        logger.info(f"Slowest step: {step['name']} of {name} ({step['time']:.1f}s over all tasks)")
+    logger.info(
+        "Critical path: "
+        + " -> ".join(f"{task['stage']}/{task['rank']} ({task['duration']:.1f}s)" for task in report["critical_path"])
+    )
+    if report_path is not None:
+        os.makedirs(os.path.dirname(os.path.abspath(report_path)), exist_ok=True)
+        with open(report_path, "w") as f:
+            json.dump(report, f, indent=2)
+    return report
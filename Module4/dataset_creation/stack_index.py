@@ -0,0 +1,227 @@
+# coding=utf-8
+# Copyright 2024 Sourab Mangrulkar. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Random access to the documents of the final `hf_stack` shards.
+
+`IndexedJsonlWriter` writes each shard as a series of independent gzip members of a few hundred documents
+(blocks). The shards are still regular `.jsonl.gz` files for every reader, but a block can be decompressed
+on its own from its offset. The id, repo, path, length and token count of every document are saved with
+the location of its block in a SQLite index, and `StackIndex` uses it to fetch single documents, all the
+documents of a repo or a sample of them while only decompressing the blocks that hold them:
+
+    index = StackIndex("hf_stack", "hf_stack_index.sqlite")
+    doc = index.get_by_path("peft/src/peft/peft_model.py")
+    docs = index.sample(repo_id="diffusers", n=10)
+"""
+
+import gzip
+import io
+import json
+import os
+import random
+import sqlite3
+from typing import IO, Callable
+
+from datatrove.io import DataFolderLike, get_datafolder
+from datatrove.pipeline.writers.jsonl import JsonlWriter
+
+INDEX_SCHEMA = """
+CREATE TABLE IF NOT EXISTS documents (
+    shard TEXT NOT NULL, block_offset INTEGER NOT NULL, block_size INTEGER NOT NULL, line INTEGER NOT NULL,
+    id TEXT, repo_id TEXT, file_path TEXT, length INTEGER, token_count INTEGER,
+    PRIMARY KEY (shard, block_offset, line)
+);
+CREATE INDEX IF NOT EXISTS documents_id ON documents (id);
+CREATE INDEX IF NOT EXISTS documents_repo_id ON documents (repo_id);
+CREATE INDEX IF NOT EXISTS documents_file_path ON documents (file_path);
+"""
+COLUMNS = ("shard", "block_offset", "block_size", "line", "id", "repo_id", "file_path", "length", "token_count")
+
+
+def connect(index_path: str) -> sqlite3.Connection:
+    os.makedirs(os.path.dirname(os.path.abspath(index_path)), exist_ok=True)
+    connection = sqlite3.connect(index_path, timeout=600)
+    connection.execute("PRAGMA journal_mode=WAL")
+    connection.executescript(INDEX_SCHEMA)
+    return connection
+
+
+class IndexedJsonlWriter(JsonlWriter):
+    """
+    Jsonl writer of gzipped shards made of independently compressed blocks, with a SQLite index of the documents.
+
+    A task replaces the rows of its shard in the index (a crashed task that is run again, or a new run), even
+    when it writes no document, and removes the rows of the shards past the last task, left by a run with more tasks.
+
+    Args:
+        output_folder: folder of the `{rank:05d}.jsonl.gz` shards
+        index_path: path of the SQLite index, shared by all tasks (outside of `output_folder`, which
+            should only hold shards)
+        block_docs: a block is compressed once it holds this many documents...
+        block_bytes: ... or this many bytes of jsonl
+        compresslevel: gzip compression level of the blocks
+        adapter: a custom function to "adapt" the Document format to the desired output format
+    """
+
+    name = "🐿 Jsonl (indexed)"
+
+    def __init__(
+        self,
+        output_folder: DataFolderLike,
+        index_path: str,
+        block_docs: int = 256,
+        block_bytes: int = 2**20,
+        compresslevel: int = 6,
+        adapter: Callable = None,
+    ):
+        # blocks are compressed here, the file itself is written as is
+        super().__init__(output_folder, output_filename="${rank}.jsonl.gz", compression=None, adapter=adapter)
+        self.index_path = index_path
+        self.block_docs = block_docs
+        self.block_bytes = block_bytes
+        self.compresslevel = compresslevel
+        self._buffers = {}
+        self._rows = {}
+        self._task = None
+
+    def run(self, data, rank: int = 0, world_size: int = 1):
+        self._task = (rank, world_size)
+        yield from super().run(data, rank, world_size)
+
+    def get_stale_shards(self, connection: sqlite3.Connection) -> list[str]:
+        """Shards of the index replaced by the task: its own shard and the ones of ranks >= world_size"""
+        if self._task is None:
+            return []
+        rank, world_size = self._task
+        stale = []
+        for (shard,) in connection.execute("SELECT DISTINCT shard FROM documents"):
+            shard_rank = shard.split(".")[0]
+            if shard == f"{rank:05d}.jsonl.gz" or (shard_rank.isdigit() and int(shard_rank) >= world_size):
+                stale.append(shard)
+        return stale
+
+    def _write(self, document: dict, file_handler: IO, filename: str):
+        if filename not in self._buffers:
+            self._buffers[filename] = (io.BytesIO(), [])
+            self._rows[filename] = []
+        buffer, documents = self._buffers[filename]
+        super()._write(document, buffer, filename)
+        metadata = document.get("metadata", {})
+        documents.append(
+            (
+                document.get("id"),
+                metadata.get("repo_id"),
+                metadata.get("file_path"),
+                len(document.get("text", "")),
+                metadata.get("token_count"),
+            )
+        )
+        if len(documents) >= self.block_docs or buffer.tell() >= self.block_bytes:
+            self.flush_block(filename, file_handler)
+
+    def flush_block(self, filename: str, file_handler: IO):
+        buffer, documents = self._buffers[filename]
+        if not documents:
+            return
+        block = gzip.compress(buffer.getvalue(), compresslevel=self.compresslevel, mtime=0)
+        offset = file_handler.tell()
+        file_handler.write(block)
+        self._rows[filename].extend(
+            (filename, offset, len(block), line, *document) for line, document in enumerate(documents)
+        )
+        self._buffers[filename] = (io.BytesIO(), [])
+
+    def close(self):
+        for filename in list(self._buffers):
+            self.flush_block(filename, self._get_output_file_with_retry(filename))
+        super().close()
+        if self._rows or self._task is not None:
+            connection = connect(self.index_path)
+            try:
+                with connection:
+                    stale = set(self.get_stale_shards(connection)) | set(self._rows)
+                    connection.executemany("DELETE FROM documents WHERE shard = ?", [(shard,) for shard in stale])
+                    for filename, rows in self._rows.items():
+                        connection.executemany(
+                            f"INSERT INTO documents ({', '.join(COLUMNS)}) VALUES ({', '.join('?' * len(COLUMNS))})",
+                            rows,
+                        )
+            finally:
+                connection.close()
+        self._buffers.clear()
+        self._rows.clear()
+        self._task = None
+
+
+class StackIndex:
+    """
+    Lookups in the shards written by `IndexedJsonlWriter`.
+
+    Every method returns the documents as the dicts written in the shards (`text`, `id` and `metadata`),
+    in shard order, and reads each block they are in once.
+
+    Args:
+        data_folder: folder of the shards
+        index_path: SQLite index written with them
+    """
+
+    def __init__(self, data_folder: DataFolderLike = "hf_stack", index_path: str = "hf_stack_index.sqlite"):
+        if not os.path.exists(index_path):
+            raise ValueError(f"No index {index_path}, write the shards with IndexedJsonlWriter first.")
+        self.data_folder = get_datafolder(data_folder)
+        self.connection = sqlite3.connect(index_path)
+
+    def query(self, where: str = "", params: tuple = (), limit: int | None = None) -> list[dict]:
+        """Rows of the index (without the text) matching a SQL condition, e.g. `query("length > ?", (1000,))`"""
+        sql = f"SELECT {', '.join(COLUMNS)} FROM documents"
+        if where:
+            sql += f" WHERE {where}"
+        sql += " ORDER BY shard, block_offset, line"
+        if limit is not None:
+            sql += f" LIMIT {int(limit)}"
+        return [dict(zip(COLUMNS, row)) for row in self.connection.execute(sql, params)]
+
+    def fetch(self, rows: list[dict]) -> list[dict]:
+        """Documents of index rows, decompressing each of their blocks once"""
+        documents = []
+        block, lines = None, None
+        for row in sorted(rows, key=lambda row: (row["shard"], row["block_offset"], row["line"])):
+            if block != (row["shard"], row["block_offset"]):
+                block = (row["shard"], row["block_offset"])
+                with self.data_folder.open(row["shard"], "rb") as f:
+                    f.seek(row["block_offset"])
+                    lines = gzip.decompress(f.read(row["block_size"])).splitlines()
+            documents.append(json.loads(lines[row["line"]]))
+        return documents
+
+    def get(self, doc_id: str) -> dict | None:
+        documents = self.fetch(self.query("id = ?", (doc_id,), limit=1))
+        return documents[0] if documents else None
+
+    def get_by_path(self, file_path: str) -> dict | None:
+        documents = self.fetch(self.query("file_path = ?", (file_path,), limit=1))
+        return documents[0] if documents else None
+
+    def get_repo(self, repo_id: str, limit: int | None = None) -> list[dict]:
+        return self.fetch(self.query("repo_id = ?", (repo_id,), limit=limit))
+
+    def sample(self, n: int, repo_id: str | None = None, seed: int = 0) -> list[dict]:
+        """`n` random documents, of a single repo with `repo_id`"""
+        rows = self.query("repo_id = ?", (repo_id,)) if repo_id else self.query()
+        return self.fetch(random.Random(seed).sample(rows, min(n, len(rows))))
+
+    def close(self):
+        self.connection.close()
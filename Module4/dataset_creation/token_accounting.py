@@ -0,0 +1,148 @@
+# coding=utf-8
+# Copyright 2024 Sourab Mangrulkar. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Token accounting with the tokenizer the model is trained with (`tokenizer_creation/hugcoder`).
+
+`TokenAccounting` encodes documents in batches, each batch on the threads of the tokenizers library, stores
+the count in `metadata["token_count"]` and saves the tokens of each task broken down by repo, file extension
+and kind (notebook or code). A later `TokenAccounting` reuses the stored counts, so counting after
+deduplication does not encode the documents again. The reports of all tasks are summed with `merge_reports`:
+    python token_accounting.py token_reports/before_dedup token_reports/after_dedup
+"""
+
+import argparse
+import json
+import os
+from collections import defaultdict
+
+from datatrove.data import DocumentsPipeline
+from datatrove.io import DataFolderLike, get_datafolder
+from datatrove.utils.batching import batched
+from datatrove.utils.tokenization import PipelineStepWithTokenizer
+
+HUGCODER_TOKENIZER = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "tokenizer_creation", "hugcoder", "tokenizer.json"
+)
+BREAKDOWNS = ("repo_id", "extension", "kind")
+
+
+def get_breakdown_keys(document) -> dict[str, str]:
+    """Repo, file extension and kind of a document, from the metadata set by `PersonalCopilotDatasetReader`"""
+    file_path = document.metadata.get("file_path", "")
+    extension = os.path.splitext(file_path)[1].lower() or "(none)"
+    return {
+        "repo_id": document.metadata.get("repo_id", "unknown"),
+        "extension": extension,
+        "kind": "notebook" if extension == ".ipynb" else "code",
+    }
+
+
+class TokenAccounting(PipelineStepWithTokenizer):
+    """
+    Counts the tokens of each document with the project tokenizer and reports them per repo, extension and kind.
+
+    Args:
+        report_folder: folder of the `{rank:05d}.json` report of each task
+        tokenizer_name_or_path: tokenizer file or name on the hub, the hugcoder tokenizer by default
+        batch_size: number of documents encoded at once
+        num_threads: threads used by the tokenizers library to encode a batch, None for one per core.
+            With several tasks per machine, about `cores / workers` avoids oversubscription
+        reuse_counts: documents that already have a `token_count` (from a previous `TokenAccounting`
+            with the same tokenizer) are not encoded again
+    """
+
+    name = "📊 Token accounting"
+    type = "🔢 - TOKENIZER"
+
+    def __init__(
+        self,
+        report_folder: DataFolderLike,
+        tokenizer_name_or_path: str = HUGCODER_TOKENIZER,
+        batch_size: int = 1000,
+        num_threads: int | None = None,
+        reuse_counts: bool = True,
+    ):
+        super().__init__(tokenizer_name_or_path)
+        self.report_folder = get_datafolder(report_folder)
+        self.batch_size = batch_size
+        self.num_threads = num_threads
+        self.reuse_counts = reuse_counts
+
+    def run(self, data: DocumentsPipeline, rank: int = 0, world_size: int = 1) -> DocumentsPipeline:
+        if self.num_threads:
+            # read by the tokenizers library when its thread pool is created, on the first batch
+            os.environ["RAYON_NUM_THREADS"] = str(self.num_threads)
+            os.environ["TOKENIZERS_PARALLELISM"] = "true"
+        report = {breakdown: defaultdict(lambda: {"documents": 0, "tokens": 0}) for breakdown in BREAKDOWNS}
+
+        for batch in batched(data, self.batch_size):
+            with self.track_time(unit="batch"):
+                to_encode = [
+                    document
+                    for document in batch
+                    if not (self.reuse_counts and "token_count" in document.metadata)
+                ]
+                if to_encode:
+                    encoded_batch = self.tokenizer.encode_batch([document.text for document in to_encode])
+                    for document, encoded in zip(to_encode, encoded_batch):
+                        document.metadata["token_count"] = len(encoded.ids)
+            for document in batch:
+                count = document.metadata["token_count"]
+                self.stat_update("tokens", value=count)
+                for breakdown, key in get_breakdown_keys(document).items():
+                    report[breakdown][key]["documents"] += 1
+                    report[breakdown][key]["tokens"] += count
+                yield document
+
+        with self.report_folder.open(f"{rank:05d}.json", mode="w") as f:
+            json.dump(report, f, indent=2)
+
+
+def merge_reports(report_folder: DataFolderLike) -> dict:
+    """Sums the reports of all tasks, keys with the most tokens first"""
+    report_folder = get_datafolder(report_folder)
+    merged = {breakdown: defaultdict(lambda: {"documents": 0, "tokens": 0}) for breakdown in BREAKDOWNS}
+    for file in report_folder.list_files(glob_pattern="*.json"):
+        with report_folder.open(file) as f:
+            for breakdown, keys in json.load(f).items():
+                for key, counts in keys.items():
+                    merged[breakdown][key]["documents"] += counts["documents"]
+                    merged[breakdown][key]["tokens"] += counts["tokens"]
+    return {
+        breakdown: dict(sorted(keys.items(), key=lambda item: -item[1]["tokens"]))
+        for breakdown, keys in merged.items()
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Prints the tokens per repo, extension and kind of token reports")
+    parser.add_argument("report_folders", nargs="+", help="e.g. token_reports/before_dedup token_reports/after_dedup")
+    parser.add_argument("--top", type=int, default=20, help="number of repos and extensions printed")
+    args = parser.parse_args()
+
+    reports = [merge_reports(folder) for folder in args.report_folders]
+    for breakdown in BREAKDOWNS:
+        print(f"{breakdown:<40} " + " ".join(f"{os.path.basename(f.rstrip('/')):>16}" for f in args.report_folders))
+        # the keys of the first report by decreasing tokens, then the keys only found in the others
+        keys = list(dict.fromkeys(key for report in reports for key in report[breakdown]))
+        for key in keys[: args.top]:
+            tokens = [report[breakdown].get(key, {}).get("tokens", 0) for report in reports]
+            print(f"  {key:<38} " + " ".join(f"{count:>16,}" for count in tokens))
+    print(f"{'total':<40} " + " ".join(f"{sum(c['tokens'] for c in r['kind'].values()):>16,}" for r in reports))
+
+
+if __name__ == "__main__":
+    main()
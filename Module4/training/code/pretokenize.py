@@ -0,0 +1,139 @@
+# coding=utf-8
+# Copyright 2024 Sourab Mangrulkar. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Tokenizes the hf_stack shards once, ahead of training, into memory-mappable token shards.
+
+Each input shard is tokenized by one of `num_proc` processes and written as:
+    {shard}.tokens       the tokens of all its documents, back to back (uint16 when the vocab fits, else uint32)
+    {shard}.offsets.npy  int64 offsets of the documents in the tokens, num_documents + 1 of them
+and `index.json` lists the shards with the tokenizer, dtype and eos token id. `train.py --pretokenized_dir`
+reads them with `PretokenizedConstantLengthDataset`:
+    python code/pretokenize.py --data_folder ../dataset_creation/hf_stack --tokenizer Rogarcia18/hugcoder \
+        --output_dir hug_stack_tokens
+"""
+
+import argparse
+import gzip
+import json
+import os
+from functools import partial
+from multiprocessing import Pool
+
+import numpy as np
+from transformers import AutoTokenizer
+
+INDEX_FILE = "index.json"
+
+# tokenizer of the worker process, loaded once by `init_worker`
+_tokenizer = None
+
+
+def get_token_dtype(vocab_size):
+    return np.uint16 if vocab_size <= np.iinfo(np.uint16).max + 1 else np.uint32
+
+
+def init_worker(tokenizer_name_or_path):
+    global _tokenizer
+    # one tokenizer per process, its own thread pool would only oversubscribe the cores
+    os.environ["TOKENIZERS_PARALLELISM"] = "false"
+    _tokenizer = AutoTokenizer.from_pretrained(tokenizer_name_or_path)
+
+
+def iter_batches(shard_path, text_field, batch_size):
+    with gzip.open(shard_path, "rt", encoding="utf-8") as f:
+        batch = []
+        for line in f:
+            batch.append(json.loads(line)[text_field])
+            if len(batch) == batch_size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+
+def tokenize_shard(shard_path, output_dir, text_field="text", batch_size=1000):
+    """
+    Tokenizes the documents of a jsonl.gz shard into `{name}.tokens` and `{name}.offsets.npy`,
+    streaming batch by batch so that only the document lengths are kept in memory.
+
+    Returns:
+        dict: Name, number of documents and number of tokens of the shard.
+    """
+    name = os.path.basename(shard_path).split(".")[0]
+    dtype = get_token_dtype(len(_tokenizer))
+    tokens_path = os.path.join(output_dir, f"{name}.tokens")
+    lengths = []
+    # written under temporary names, a shard is complete once both files are renamed
+    with open(f"{tokens_path}.tmp", "wb") as f:
+        for batch in iter_batches(shard_path, text_field, batch_size):
+            # same tokenization as ConstantLengthDataset (default special tokens, no truncation)
+            for input_ids in _tokenizer(batch, truncation=False)["input_ids"]:
+                np.asarray(input_ids, dtype=dtype).tofile(f)
+                lengths.append(len(input_ids))
+    offsets = np.zeros(len(lengths) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=offsets[1:])
+    with open(os.path.join(output_dir, f"{name}.offsets.npy.tmp"), "wb") as f:
+        np.save(f, offsets)
+    os.replace(f"{tokens_path}.tmp", tokens_path)
+    os.replace(os.path.join(output_dir, f"{name}.offsets.npy.tmp"), os.path.join(output_dir, f"{name}.offsets.npy"))
+    return {"name": name, "documents": len(lengths), "tokens": int(offsets[-1])}
+
+
+def pretokenize(data_folder, tokenizer_name_or_path, output_dir, text_field="text", num_proc=None, batch_size=1000):
+    shards = sorted(
+        os.path.join(data_folder, file) for file in os.listdir(data_folder) if file.endswith(".jsonl.gz")
+    )
+    if not shards:
+        raise ValueError(f"No jsonl.gz shards in {data_folder}.")
+    tokenizer = AutoTokenizer.from_pretrained(tokenizer_name_or_path)
+    if tokenizer.eos_token_id is None:
+        raise ValueError(f"The tokenizer {tokenizer_name_or_path} has no eos token to separate the documents.")
+    os.makedirs(output_dir, exist_ok=True)
+
+    num_proc = min(num_proc or os.cpu_count() or 1, len(shards))
+    with Pool(num_proc, initializer=init_worker, initargs=(tokenizer_name_or_path,)) as pool:
+        shard_infos = pool.map(
+            partial(tokenize_shard, output_dir=output_dir, text_field=text_field, batch_size=batch_size),
+            shards,
+            chunksize=1,
+        )
+
+    index = {
+        "tokenizer": tokenizer_name_or_path,
+        "vocab_size": len(tokenizer),
+        "dtype": np.dtype(get_token_dtype(len(tokenizer))).name,
+        "eos_token_id": tokenizer.eos_token_id,
+        "text_field": text_field,
+        "shards": shard_infos,
+    }
+    with open(os.path.join(output_dir, INDEX_FILE), "w") as f:
+        json.dump(index, f, indent=2)
+    documents = sum(shard["documents"] for shard in shard_infos)
+    tokens = sum(shard["tokens"] for shard in shard_infos)
+    print(f"Tokenized {documents} documents into {tokens} {index['dtype']} tokens in {output_dir}")
+    return index
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--data_folder", default="../dataset_creation/hf_stack", help="jsonl.gz shards to tokenize")
+    parser.add_argument("--tokenizer", default="Rogarcia18/hugcoder", help="tokenizer the model is trained with")
+    parser.add_argument("--output_dir", default="hug_stack_tokens", help="folder of the token shards")
+    parser.add_argument("--text_field", default="text")
+    parser.add_argument("--num_proc", type=int, default=None, help="processes, one per core by default")
+    parser.add_argument("--batch_size", type=int, default=1000, help="documents tokenized at once")
+    args = parser.parse_args()
+    pretokenize(args.data_folder, args.tokenizer, args.output_dir, args.text_field, args.num_proc, args.batch_size)
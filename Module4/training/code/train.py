@@ -17,9 +17,14 @@
 Pretrain 7B transformers based decoder model on code/text dataset
 """
 
+import itertools
+import json
 import os
+import queue
 import random
 import sys
+import threading
+import time
 
 import numpy as np
 import torch
@@ -27,8 +32,9 @@ from typing import Optional
 from tqdm import tqdm
 from dataclasses import dataclass, field
 
-from torch.utils.data import IterableDataset
-from datasets import load_dataset
+from torch.utils.data import IterableDataset, get_worker_info
+from datasets import Dataset, load_dataset
+from accelerate.data_loader import IterableDatasetShard
 
 from transformers import (
     AutoModelForCausalLM,
@@ -41,6 +47,7 @@ from transformers import (
 )
 
 import fim
+from pretokenize import INDEX_FILE
 
 os.environ["WANDB_PROJECT"] = "training_llm_from_scratch"
 
@@ -91,6 +98,19 @@ class DataTrainingArguments:
         default="train",
         metadata={"help": "Comma separate list of the splits to use from the dataset."},
     )
+    prefetch_buffers: Optional[int] = field(
+        default=1,
+        metadata={
+            "help": "Buffers tokenized and packed ahead of the trainer on a background thread, 0 disables it."
+        },
+    )
+    pretokenized_dir: Optional[str] = field(
+        default=None,
+        metadata={
+            "help": "Token shards written by pretokenize.py, used instead of `dataset_name` "
+            "(nothing is tokenized during training)."
+        },
+    )
 
 
 def chars_token_ratio(dataset, tokenizer, data_column, nb_examples=400):
@@ -105,6 +125,91 @@ def chars_token_ratio(dataset, tokenizer, data_column, nb_examples=400):
     return total_characters / total_tokens
 
 
+def get_shard(rank=0, world_size=1):
+    """
+    Shard read by the calling process: every DataLoader worker of every rank gets its own one.
+
+    Returns:
+        tuple: (shard index, number of shards), with the shards of a rank next to each other.
+    """
+    worker_info = get_worker_info()
+    worker_id, num_workers = (worker_info.id, worker_info.num_workers) if worker_info else (0, 1)
+    return rank * num_workers + worker_id, world_size * num_workers
+
+
+class ProducerError:
+    def __init__(self, error):
+        self.error = error
+
+
+def prefetch(iterator, max_items, stats, name="", log_every=10):
+    """
+    Runs `iterator` on a background thread, at most `max_items` items ahead of the consumer (a bounded queue).
+
+    The time the consumer waits for each item (the stalls) and the time spent producing them are added
+    to `stats`, and printed every `log_every` items. An exception of the producer is raised in the consumer.
+    """
+    items = queue.Queue(maxsize=max_items)
+    stop = threading.Event()
+    done = object()
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                items.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+
+    def produce():
+        try:
+            while not stop.is_set():
+                start = time.perf_counter()
+                item = next(iterator, done)
+                stats["produce_seconds"] += time.perf_counter() - start
+                put(item)
+                if item is done:
+                    return
+        except Exception as e:
+            put(ProducerError(e))
+
+    producer = threading.Thread(target=produce, daemon=True)
+    producer.start()
+    try:
+        while True:
+            start = time.perf_counter()
+            item = items.get()
+            wait = time.perf_counter() - start
+            if item is done:
+                return
+            if isinstance(item, ProducerError):
+                raise item.error
+            stats["buffers"] += 1
+            stats["wait_seconds"] += wait
+            stats["max_wait_seconds"] = max(stats["max_wait_seconds"], wait)
+            if log_every and stats["buffers"] % log_every == 0:
+                print(
+                    f"Prefetch {name}: waited {stats['wait_seconds']:.2f}s (max {stats['max_wait_seconds']:.2f}s) "
+                    f"for {stats['buffers']} buffers, producing them took {stats['produce_seconds']:.2f}s"
+                )
+            yield item
+    finally:
+        stop.set()
+        producer.join()
+
+
+class ShardedIterable:
+    """Every `num_shards`-th example of an iterable dataset, starting at `shard` (the others are not tokenized)"""
+
+    def __init__(self, dataset, shard, num_shards):
+        self.dataset = dataset
+        self.shard = shard
+        self.num_shards = num_shards
+
+    def __iter__(self):
+        return itertools.islice(iter(self.dataset), self.shard, None, self.num_shards)
+
+
 class ConstantLengthDataset(IterableDataset):
     """
     Iterable dataset that returns constant length chunks of tokens from stream of text files.
@@ -118,6 +223,11 @@ class ConstantLengthDataset(IterableDataset):
             fim_rate (float): Rate (0.0 to 1.0) that sample will be permuted with FIM.
             fim_spm_rate (float): Rate (0.0 to 1.0) of FIM permuations that will use SPM.
             seed (int): Seed for random number generator.
+            rank (int): Rank of this process, it only reads and tokenizes its shard of the dataset.
+            world_size (int): Number of processes the dataset is split between, each DataLoader
+                worker of a process then reads a shard of its slice.
+            prefetch_buffers (int): Number of buffers tokenized and packed ahead of the consumer on a
+                background thread, 0 to do it on the consumer's thread when a buffer runs dry.
     """
 
     def __init__(
@@ -132,6 +242,9 @@ class ConstantLengthDataset(IterableDataset):
         fim_rate=0.5,
         fim_spm_rate=0.5,
         seed=0,
+        rank=0,
+        world_size=1,
+        prefetch_buffers=1,
     ):
         self.tokenizer = tokenizer
         self.concat_token_id = tokenizer.eos_token_id
@@ -144,6 +257,10 @@ class ConstantLengthDataset(IterableDataset):
         self.fim_rate = fim_rate
         self.fim_spm_rate = fim_spm_rate
         self.seed = seed
+        self.rank = rank
+        self.world_size = world_size
+        self.prefetch_buffers = prefetch_buffers
+        self.prefetch_stats = None
 
         (
             self.suffix_tok_id,
@@ -155,13 +272,26 @@ class ConstantLengthDataset(IterableDataset):
             print("FIM is not supported by tokenizer, disabling FIM")
             self.fim_rate = 0
 
-    def __iter__(self):
-        # The __iter__ method makes this class an iterable, so it can be used in a for-loop or with iter().
-        # 'iterator = iter(self.dataset)' creates an iterator from the dataset, allowing us to fetch items one by one.
-        iterator = iter(self.dataset)
+    def get_shard_dataset(self, shard, num_shards):
+        """Examples of a shard: a contiguous slice of a `datasets.Dataset`, every `num_shards`-th example otherwise"""
+        if num_shards == 1:
+            return self.dataset
+        if isinstance(self.dataset, Dataset):
+            dataset = self.dataset.shard(num_shards=num_shards, index=shard, contiguous=True)
+            if len(dataset) == 0:
+                raise ValueError(f"Shard {shard} of {num_shards} is empty, use fewer ranks or DataLoader workers.")
+            return dataset
+        return ShardedIterable(self.dataset, shard, num_shards)
+
+    def iter_buffers(self, dataset, np_rng):
+        """
+        Producer of the examples: fills a buffer of texts, tokenizes it in one call, applies FIM and
+        packs the tokens into shuffled `seq_length` examples, one list of examples per buffer.
+        """
+        # 'iterator = iter(dataset)' creates an iterator from the dataset, allowing us to fetch items one by one.
+        iterator = iter(dataset)
         # 'more_examples = True' is a flag used to control when to stop yielding data from the dataset.
         more_examples = True
-        np_rng = np.random.RandomState(seed=self.seed)
         while more_examples:
             buffer, buffer_len = [], 0
             while True:
@@ -172,10 +302,12 @@ class ConstantLengthDataset(IterableDataset):
                     buffer_len += len(buffer[-1])
                 except StopIteration:
                     if self.infinite:
-                        iterator = iter(self.dataset)
+                        iterator = iter(dataset)
                     else:
                         more_examples = False
                         break
+            if not buffer:
+                break
             tokenized_inputs = self.tokenizer(buffer, truncation=False)["input_ids"]
             all_token_ids = []
 
@@ -199,17 +331,209 @@ class ConstantLengthDataset(IterableDataset):
             for i in range(0, len(all_token_ids), self.seq_length):
                 input_ids = all_token_ids[i : i + self.seq_length]
                 if len(input_ids) == self.seq_length:
-                    examples.append(input_ids)
+                    examples.append(
+                        {
+                            "input_ids": torch.LongTensor(input_ids),
+                            "labels": torch.LongTensor(input_ids),
+                        }
+                    )
             random.shuffle(examples)
+            yield examples
+
+    def __iter__(self):
+        # The __iter__ method makes this class an iterable, so it can be used in a for-loop or with iter().
+        # each process (rank and DataLoader worker) only reads and tokenizes its own shard of the dataset
+        shard, num_shards = get_shard(self.rank, self.world_size)
+        dataset = self.get_shard_dataset(shard, num_shards)
+        # a different FIM stream per shard, the same one as before with a single process
+        np_rng = np.random.RandomState(seed=self.seed + shard)
+        buffers = self.iter_buffers(dataset, np_rng)
+        if self.prefetch_buffers > 0:
+            # the next buffers are tokenized and packed in the background while this one is consumed
+            self.prefetch_stats = {"buffers": 0, "wait_seconds": 0.0, "max_wait_seconds": 0.0, "produce_seconds": 0.0}
+            buffers = prefetch(buffers, self.prefetch_buffers, self.prefetch_stats, name=f"shard {shard}")
+        for examples in buffers:
             for example in examples:
                 self.current_size += 1
-                yield {
-                    "input_ids": torch.LongTensor(example),
-                    "labels": torch.LongTensor(example),
-                }
+                yield example
+
+
+def load_token_shards(token_dir):
+    """
+    Memory maps the token shards written by pretokenize.py.
+
+    Returns:
+        tuple: The index, the (tokens, offsets) arrays of each shard and the cumulative
+        number of documents of the shards (global document i is in the shard `searchsorted`).
+    """
+    with open(os.path.join(token_dir, INDEX_FILE)) as f:
+        index = json.load(f)
+    shards = []
+    for shard in index["shards"]:
+        tokens_path = os.path.join(token_dir, f"{shard['name']}.tokens")
+        # np.memmap cannot map an empty file
+        tokens = (
+            np.memmap(tokens_path, dtype=index["dtype"], mode="r")
+            if shard["tokens"]
+            else np.empty(0, dtype=index["dtype"])
+        )
+        offsets = np.load(os.path.join(token_dir, f"{shard['name']}.offsets.npy"))
+        shards.append((tokens, offsets))
+    doc_ends = np.cumsum([shard["documents"] for shard in index["shards"]])
+    return index, shards, doc_ends
+
+
+class PretokenizedConstantLengthDataset(IterableDataset):
+    """
+    Iterable dataset that returns constant length chunks of tokens from the memory mapped token shards
+    of pretokenize.py, with the same packing and FIM permutations as `ConstantLengthDataset` but no tokenizer.
+    The documents are shuffled at every epoch and the tokens left over at the end of a chunk start the next one.
+        Args:
+            token_dir (str): Folder of the token shards.
+            documents (np.ndarray): Global indices of the documents of this dataset, all of them if None.
+            infinite (bool): If True the iterator is reset after dataset reaches end else stops.
+            seq_length (int): Length of token sequences to return.
+            fim_token_ids (tuple): Suffix, prefix, middle and pad token ids of `fim.get_fim_token_ids`.
+            fim_rate (float): Rate (0.0 to 1.0) that sample will be permuted with FIM.
+            fim_spm_rate (float): Rate (0.0 to 1.0) of FIM permuations that will use SPM.
+            seed (int): Seed for random number generator.
+            rank (int): Rank of this process, it only reads its shard of the documents.
+            world_size (int): Number of processes the documents are split between (then between DataLoader workers).
+    """
+
+    def __init__(
+        self,
+        token_dir,
+        documents=None,
+        infinite=False,
+        seq_length=1024,
+        fim_token_ids=(None, None, None, None),
+        fim_rate=0.5,
+        fim_spm_rate=0.5,
+        seed=0,
+        rank=0,
+        world_size=1,
+    ):
+        self.token_dir = token_dir
+        index, _, doc_ends = load_token_shards(token_dir)
+        self.concat_token_id = index["eos_token_id"]
+        self.documents = np.arange(doc_ends[-1]) if documents is None else np.asarray(documents)
+        self.seq_length = seq_length
+        self.infinite = infinite
+        self.current_size = 0
+        self.fim_rate = fim_rate
+        self.fim_spm_rate = fim_spm_rate
+        self.seed = seed
+        self.rank = rank
+        self.world_size = world_size
+        (
+            self.suffix_tok_id,
+            self.prefix_tok_id,
+            self.middle_tok_id,
+            self.pad_tok_id,
+        ) = fim_token_ids
+        if not self.suffix_tok_id and self.fim_rate > 0:
+            print("FIM is not supported by tokenizer, disabling FIM")
+            self.fim_rate = 0
+
+    def iter_documents(self, documents, shards, doc_ends, np_rng):
+        """Tokens of the documents in a random order, one epoch"""
+        for document in np_rng.permutation(documents):
+            shard = int(np.searchsorted(doc_ends, document, side="right"))
+            local = document - (doc_ends[shard - 1] if shard else 0)
+            tokens, offsets = shards[shard]
+            yield tokens[offsets[local] : offsets[local + 1]]
+
+    def __iter__(self):
+        # mapped here rather than in __init__: memmaps would be copied when the dataset is pickled to workers
+        _, shards, doc_ends = load_token_shards(self.token_dir)
+        shard, num_shards = get_shard(self.rank, self.world_size)
+        documents = self.documents[shard::num_shards]
+        if len(documents) == 0:
+            raise ValueError(f"Shard {shard} of {num_shards} is empty, use fewer ranks or DataLoader workers.")
+        np_rng = np.random.RandomState(seed=self.seed + shard)
+        concat = np.array([self.concat_token_id], dtype=np.int64)
+        buffer, buffer_len = [], 0
+        while True:
+            for tokens in self.iter_documents(documents, shards, doc_ends, np_rng):
+                tokens = tokens.astype(np.int64)
+                # optionally do FIM permutations
+                if self.fim_rate > 0:
+                    tokens, np_rng = fim.permute(
+                        tokens,
+                        np_rng,
+                        self.suffix_tok_id,
+                        self.prefix_tok_id,
+                        self.middle_tok_id,
+                        self.pad_tok_id,
+                        fim_rate=self.fim_rate,
+                        fim_spm_rate=self.fim_spm_rate,
+                        truncate_or_pad=False,
+                    )
+                    tokens = np.asarray(tokens, dtype=np.int64)
+                buffer += [tokens, concat]
+                buffer_len += len(tokens) + 1
+                if buffer_len < self.seq_length:
+                    continue
+                all_token_ids = np.concatenate(buffer)
+                num_examples = len(all_token_ids) // self.seq_length
+                for i in range(num_examples):
+                    example = torch.from_numpy(all_token_ids[i * self.seq_length : (i + 1) * self.seq_length])
+                    self.current_size += 1
+                    yield {"input_ids": example, "labels": example.clone()}
+                buffer = [all_token_ids[num_examples * self.seq_length :]]
+                buffer_len = len(buffer[0])
+            if not self.infinite:
+                break
+
+
+def create_pretokenized_datasets(tokenizer, args, seed, rank=0, world_size=1):
+    """Train and validation datasets of the token shards in `args.pretokenized_dir`, split by document"""
+    index, _, doc_ends = load_token_shards(args.pretokenized_dir)
+    if index["eos_token_id"] != tokenizer.eos_token_id or index["vocab_size"] != len(tokenizer):
+        raise ValueError(
+            f"{args.pretokenized_dir} was tokenized with {index['tokenizer']}, not with the training tokenizer."
+        )
+    documents = np.random.RandomState(seed).permutation(doc_ends[-1])
+    num_valid = int(round(len(documents) * args.test_size))
+    train_documents, valid_documents = documents[num_valid:], documents[:num_valid]
+    print(
+        f"Size of the train set: {len(train_documents)}. Size of the validation set: {len(valid_documents)}"
+    )
+    fim_token_ids = fim.get_fim_token_ids(tokenizer)
+    train_dataset = PretokenizedConstantLengthDataset(
+        args.pretokenized_dir,
+        train_documents,
+        infinite=True,
+        seq_length=args.max_seq_length,
+        fim_token_ids=fim_token_ids,
+        fim_rate=args.fim_rate,
+        fim_spm_rate=args.fim_spm_rate,
+        seed=seed,
+        rank=rank,
+        world_size=world_size,
+    )
+    valid_dataset = PretokenizedConstantLengthDataset(
+        args.pretokenized_dir,
+        valid_documents,
+        infinite=False,
+        seq_length=args.max_seq_length,
+        fim_token_ids=fim_token_ids,
+        fim_rate=args.fim_rate,
+        fim_spm_rate=args.fim_spm_rate,
+        seed=seed,
+    )
+    return train_dataset, valid_dataset
 
 
-def create_datasets(tokenizer, args, seed):
+def create_datasets(tokenizer, args, seed, rank=0, world_size=1):
+    """
+    Train and validation datasets. The (infinite) train dataset is split between the `world_size` ranks.
+    The validation dataset is read in full by every rank (and split between its DataLoader workers), so
+    that all ranks run the same number of evaluation steps.
+    """
+    if args.pretokenized_dir:
+        return create_pretokenized_datasets(tokenizer, args, seed, rank, world_size)
     dataset = load_dataset(args.dataset_name, split=args.splits)
     dataset = dataset.train_test_split(
         test_size=args.test_size, seed=seed, shuffle=True
@@ -231,6 +555,9 @@ def create_datasets(tokenizer, args, seed):
         fim_rate=args.fim_rate,
         fim_spm_rate=args.fim_spm_rate,
         seed=seed,
+        rank=rank,
+        world_size=world_size,
+        prefetch_buffers=args.prefetch_buffers,
     )
     valid_dataset = ConstantLengthDataset(
         tokenizer,
@@ -242,10 +569,29 @@ def create_datasets(tokenizer, args, seed):
         fim_rate=args.fim_rate,
         fim_spm_rate=args.fim_spm_rate,
         seed=seed,
+        prefetch_buffers=args.prefetch_buffers,
     )
     return train_dataset, valid_dataset
 
 
+class RankShardedTrainer(Trainer):
+    """
+    Trainer for iterable datasets that already yield the slice of their rank (`world_size` > 1).
+
+    Accelerate would otherwise have every rank read the whole dataset and keep one batch out of
+    `world_size` (`IterableDatasetShard`): the shard wrapper of their dataloaders is made a passthrough.
+    Batches must not be dispatched from the main process (`dispatch_batches=False`).
+    """
+
+    def get_train_dataloader(self):
+        dataloader = super().get_train_dataloader()
+        dataset = getattr(dataloader, "dataset", None)
+        if isinstance(dataset, IterableDatasetShard) and getattr(dataset.dataset, "world_size", 1) > 1:
+            dataset.num_processes = 1
+            dataset.process_index = 0
+        return dataloader
+
+
 def main(model_args, data_args, training_args):
     # Set seed for reproducibility
     set_seed(training_args.seed)
@@ -254,8 +600,13 @@ def main(model_args, data_args, training_args):
     tokenizer = AutoTokenizer.from_pretrained(model_args.tokenizer_model_name_or_path)
 
     # load the datasets
+    # every rank tokenizes its own slice of the train data, spread over its `dataloader_num_workers`
     train_dataset, eval_dataset = create_datasets(
-        tokenizer, data_args, training_args.seed
+        tokenizer,
+        data_args,
+        training_args.seed,
+        rank=training_args.process_index,
+        world_size=training_args.world_size,
     )
     train_dataset.start_iteration = 0
 
@@ -280,8 +631,11 @@ def main(model_args, data_args, training_args):
             "use_reentrant": model_args.use_reentrant
         }
 
+    # the ranks read their own batches instead of receiving slices of the batches read by rank 0
+    training_args.accelerator_config.dispatch_batches = False
+
     # trainer
-    trainer = Trainer(
+    trainer = RankShardedTrainer(
         model=model,
         args=training_args,
         train_dataset=train_dataset,
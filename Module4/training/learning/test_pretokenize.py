@@ -0,0 +1,71 @@
+# File to test that the token shards of pretokenize.py pack the same tokens as the tokenizer, split by document
+import gzip
+import json
+import os
+import sys
+import tempfile
+from argparse import Namespace
+from collections import Counter
+# Add the code directory (training/code) to sys.path
+code_dir = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "code")
+sys.path.append(code_dir)
+from transformers import AutoTokenizer
+from pretokenize import pretokenize
+from train import PretokenizedConstantLengthDataset, create_pretokenized_datasets
+
+TOKENIZER = os.path.join(os.path.dirname(os.path.dirname(code_dir)), "tokenizer_creation", "hugcoder")
+NUM_SHARDS = 2
+
+
+def write_shards(folder, num_documents=30):
+    """`NUM_SHARDS` jsonl.gz shards like the ones of hf_stack, returns the texts in global document order"""
+    texts = [f"def function_{i}():\n    return {i}\n" * (i % 3 + 1) for i in range(num_documents)]
+    os.makedirs(folder)
+    per_shard = (num_documents + NUM_SHARDS - 1) // NUM_SHARDS
+    for shard in range(NUM_SHARDS):
+        with gzip.open(os.path.join(folder, f"{shard:05d}.jsonl.gz"), "wt", encoding="utf-8") as f:
+            for text in texts[shard * per_shard : (shard + 1) * per_shard]:
+                f.write(json.dumps({"text": text}) + "\n")
+    return texts
+
+
+def read_documents(dataset, eos_token_id):
+    """Tokens of each document packed by `dataset`, as a multiset (sequences of one token keep every token)"""
+    dataset.seq_length, dataset.infinite = 1, False
+    documents, current = Counter(), []
+    for example in dataset:
+        token = int(example["input_ids"][0])
+        if token == eos_token_id:
+            documents[tuple(current)] += 1
+            current = []
+        else:
+            current.append(token)
+    assert not current
+    return documents
+
+
+# TESTING FUNCTION
+def test_pretokenized_dataset():
+    tokenizer = AutoTokenizer.from_pretrained(TOKENIZER)
+    with tempfile.TemporaryDirectory() as folder:
+        texts = write_shards(os.path.join(folder, "hf_stack"))
+        token_dir = os.path.join(folder, "tokens")
+        index = pretokenize(os.path.join(folder, "hf_stack"), TOKENIZER, token_dir, num_proc=NUM_SHARDS)
+        assert [shard["documents"] for shard in index["shards"]] == [15, 15]
+        expected = [tuple(tokenizer(text)["input_ids"]) for text in texts]
+
+        # every document is packed once, with the tokens of the tokenizer followed by eos
+        dataset = PretokenizedConstantLengthDataset(token_dir, fim_rate=0)
+        assert read_documents(dataset, tokenizer.eos_token_id) == Counter(expected)
+
+        # the train and validation documents are disjoint and cover the dataset
+        args = Namespace(pretokenized_dir=token_dir, test_size=0.2, max_seq_length=16, fim_rate=0, fim_spm_rate=0)
+        train_dataset, valid_dataset = create_pretokenized_datasets(tokenizer, args, seed=0)
+        train, valid = set(train_dataset.documents.tolist()), set(valid_dataset.documents.tolist())
+        assert len(valid) == 6 and not train & valid and train | valid == set(range(len(texts)))
+        assert read_documents(valid_dataset, tokenizer.eos_token_id) == Counter(expected[i] for i in valid)
+        assert read_documents(train_dataset, tokenizer.eos_token_id) == Counter(expected[i] for i in train)
+
+
+if __name__ == "__main__":
+    test_pretokenized_dataset()
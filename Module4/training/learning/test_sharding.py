@@ -0,0 +1,70 @@
+# File to test that the ranks and DataLoader workers of a simulated world read disjoint slices covering the dataset
+import os
+import sys
+from collections import Counter
+# Add the code directory (training/code) to sys.path
+code_dir = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "code")
+sys.path.append(code_dir)
+from datasets import Dataset
+from torch.utils.data import DataLoader
+from transformers import AutoTokenizer
+from train import ConstantLengthDataset, ShardedIterable
+
+TOKENIZER = os.path.join(os.path.dirname(os.path.dirname(code_dir)), "tokenizer_creation", "hugcoder")
+WORLD_SIZE = 2
+NUM_WORKERS = 2
+
+
+def get_documents(num_documents=40):
+    return Dataset.from_dict({"text": [f"def function_{i}():\n    return {i}\n" * (i % 3 + 1) for i in range(num_documents)]})
+
+
+# TESTING FUNCTION
+def test_shards_are_disjoint():
+    tokenizer = AutoTokenizer.from_pretrained(TOKENIZER)
+    documents = get_documents()
+    dataset = ConstantLengthDataset(tokenizer, documents, content_field="text", fim_rate=0)
+    num_shards = WORLD_SIZE * NUM_WORKERS
+    shards = [set(dataset.get_shard_dataset(shard, num_shards)["text"]) for shard in range(num_shards)]
+    assert all(shards)
+    assert sum(len(shard) for shard in shards) == len(documents)
+    assert set().union(*shards) == set(documents["text"])
+
+    # same for any iterable dataset
+    examples = [{"text": str(i)} for i in range(10)]
+    shards = [[example["text"] for example in ShardedIterable(examples, shard, 3)] for shard in range(3)]
+    assert sorted(sum(shards, [])) == sorted(example["text"] for example in examples)
+
+
+def test_world_covers_dataset_once():
+    tokenizer = AutoTokenizer.from_pretrained(TOKENIZER)
+    documents = get_documents()
+    expected = Counter()
+    for text in documents["text"]:
+        expected.update(tokenizer(text)["input_ids"] + [tokenizer.eos_token_id])
+
+    # sequences of a single token: nothing is left over at the end of a buffer
+    tokens_per_rank = []
+    for rank in range(WORLD_SIZE):
+        dataset = ConstantLengthDataset(
+            tokenizer,
+            documents,
+            seq_length=1,
+            num_of_sequences=64,
+            content_field="text",
+            fim_rate=0,
+            rank=rank,
+            world_size=WORLD_SIZE,
+        )
+        loader = DataLoader(dataset, batch_size=None, num_workers=NUM_WORKERS)
+        tokens_per_rank.append(Counter(int(example["input_ids"][0]) for example in loader))
+
+    assert all(tokens_per_rank)
+    # every document is tokenized by exactly one process of the world
+    assert sum(tokens[tokenizer.eos_token_id] for tokens in tokens_per_rank) == len(documents)
+    assert sum(tokens_per_rank, Counter()) == expected
+
+
+if __name__ == "__main__":
+    test_shards_are_disjoint()
+    test_world_covers_dataset_once()
@@ -25,6 +25,7 @@ accelerate launch --config_file "configs/fsdp_config.yaml"  code/train.py \
 --output_dir "hugcoder_dummy" \
 --per_device_train_batch_size 1 \
 --per_device_eval_batch_size 1 \
+--dataloader_num_workers 4 \
 --gradient_accumulation_steps 32 \
 --gradient_checkpointing True \
 --use_reentrant False \